@@ -1,22 +1,68 @@
 #!/usr/bin/python3
 #
 # BED4SV.py
-# v1.4 (adapted for Python 3.6)
-# Last edit 2024/11/30
+# v1.9 (adapted for Python 3.6)
+# Last edit 2026/10/17
 #
 # It processes a COSMIC VCF or capture probes BED file, generating a modified
 # BED for use with SomatoSim to simulate somatic mutations.
 # Fixes the RAM usage for big files.
+# Guided mode samples from a sidecar index of eligible COSMIC records.
+# Stochastic mode samples from a sidecar index of the capture regions.
+# Output BEDs are sorted by contig and position, with distinct sites.
+# Every draw comes from a child stream of the root seed of the sample, recorded
+# in a sidecar next to the BED, so stochastic draws can be split across workers.
 
 import argparse
+import array
+import bisect
+import hashlib
+import heapq
+import itertools
+import math
+import mmap
+import multiprocessing
+import operator
+import os
 import random
 import gzip
+import io
+import struct
 import sys
-from typing import IO, List, TextIO
+from typing import IO, Any, Callable, Dict, Iterable, Iterator, List, \
+    Optional, Sequence, Tuple, TypeVar
+
+import numpy as np
+
+import bgzf
+from bgzf import bgzf_blocks, default_threads, is_bgzf, open_input
+from tracing import span
+
+INDEX_SUFFIX = '.b4sv.idx'
+INDEX_MAGIC = b'B4SVIDX1'
+INDEX_HEADER = struct.Struct('<8sQqII')
+INDEX_PLAIN, INDEX_GZIP, INDEX_BGZF = 0, 1, 2
+
+PROBES_SUFFIX = '.b4sv.probes'
+PROBES_MAGIC = b'B4SVPRB1'
+PROBES_HEADER = struct.Struct('<8sQqQII')
+
+# Sidecar of every output BED holding its root seed. SomatoSim reads the BED
+# itself, so it is left without a header.
+SEED_SUFFIX = '.seed'
+
+# Sites drawn per shard of a stochastic draw. Shards are fixed by the number
+# of sites, not by the number of workers, so the draw is the same with any
+# number of workers.
+SHARD_SITES = 1 << 16
+
+T = TypeVar('T')
 
 def open_file(input: str) -> IO:
     """
     Handles the opening of files, either uncompressed or compressed (.gz).
+    BGZF files (as COSMIC and most BED distributions are) are decompressed
+    in parallel, see bgzf.open_input.
 
     Parameters
     ----------
@@ -28,28 +74,27 @@ def open_file(input: str) -> IO:
     IO:
         File opened.
     """
-    if input.endswith('.gz'):
-        return gzip.open(input, 'rt')
-    else:
-        return open(input, 'rt')
-
-import gzip
+    return open_input(input, 'rt')
 
 def n_lines_in_file(input: str) -> int:
     """
     Count the number of non-header lines using block reading for large files.
+    Lines split across blocks are carried over, so they are counted once.
     """
     lineas = 0
     tamano_bloque = 4096 * 4096  # Block size
-    open_func = gzip.open if input.endswith('.gz') else open
+    pending = b''
 
-    with open_func(input, 'rb') as archivo:
+    with open_input(input, 'rb') as archivo:
         while True:
             bloque = archivo.read(tamano_bloque)
             if not bloque:
                 break
-            lines = bloque.split(b'\n')  # Split block into lines
+            lines = (pending + bloque).split(b'\n')  # Split block into lines
+            pending = lines.pop()  # Last line may continue in the next block
             lineas += sum(1 for line in lines if not line.startswith(b"##"))
+    if pending and not pending.startswith(b"##"):
+        lineas += 1
     return lineas
 
 
@@ -71,44 +116,819 @@ def is_valid(contig_name: str) -> bool:
     return not any(keyword in contig_name for keyword in \
         ['alt', 'random', 'Un', 'chrUn', 'hap', 'gl', 'ki', 'fix'])
 
-def random_lines_selector(input: TextIO, n_lines_in_file: int,
-                            n_lines_required: int) -> List[str]:
+def is_eligible_record(line: str) -> bool:
     """
-    Picks random reads from a file without loading the whole file into memory.
+    Determines if a COSMIC VCF record can be used for guided simulation, that
+    is, a single-base ALT on a valid contig.
 
     Parameters
     ----------
-    input: TextIO
-        File object for the lines in the VCF or BED file from which lines
-        are going to be picked.
+    line : str
+        A line from the VCF file.
+
+    Returns
+    -------
+    bool
+        True if eligible, False otherwise
+    """
+    if line.startswith("#"):
+        return False
+    attr = line.split()
+    return len(attr) > 4 and is_valid(attr[0]) and len(attr[4]) == 1
+
+def index_kind(input: str) -> int:
+    """
+    Returns the kind of offsets an index over the file holds: byte offsets for
+    plain text, uncompressed offsets for GNU zip and virtual offsets for BGZF.
+    """
+    if input.endswith('.gz'):
+        return INDEX_BGZF if is_bgzf(input) else INDEX_GZIP
+    return INDEX_PLAIN
+
+def indexed_lines(input: str, kind: int) -> Iterator[Tuple[int, bytes]]:
+    """
+    Reads a file line by line along with the offset where each line starts,
+    as described by index_kind.
+    """
+    if kind == INDEX_BGZF:
+        with open(input, 'rb') as handle:
+            pending, start = b'', 0
+            for coffset, data in bgzf_blocks(handle,
+                                             threads=default_threads()):
+                position = 0
+                while True:
+                    end = data.find(b'\n', position)
+                    if end < 0:
+                        break
+                    if not pending:
+                        start = (coffset << 16) | position
+                    yield start, pending + data[position:end + 1]
+                    pending = b''
+                    position = end + 1
+                if position < len(data):
+                    if not pending:
+                        start = (coffset << 16) | position
+                    pending += data[position:]
+            if pending:
+                yield start, pending
+    else:
+        open_func = gzip.open if kind == INDEX_GZIP else open
+        with open_func(input, 'rb') as handle:
+            offset = 0
+            for line in handle:
+                yield offset, line
+                offset += len(line)
+
+def build_offset_index(input: str, index: str) -> Tuple[int, Sequence[int]]:
+    """
+    Scans a COSMIC VCF once, storing the offset of every eligible record in a
+    sidecar index keyed by the size and modification time of the VCF.
+
+    Parameters
+    ----------
+    input : str
+        Path to the VCF or GNU zip (GZ) VCF file.
+
+    index : str
+        Path to the sidecar index.
+
+    Returns
+    -------
+    Tuple[int, Sequence[int]]
+        Kind of offsets (see index_kind) and the offsets themselves.
+    """
+    kind = index_kind(input)
+    offsets = array.array('Q')
+    for offset, line in indexed_lines(input, kind):
+        if is_eligible_record(line.decode('utf-8', 'replace')):
+            offsets.append(offset)
 
-    n_lines_in_file: int
-        Number of lines in the entire file.
+    stat = os.stat(input)
+    tmp = f"{index}.{os.getpid()}.tmp"
+    try:
+        with open(tmp, 'wb') as handle:
+            handle.write(INDEX_HEADER.pack(INDEX_MAGIC, stat.st_size,
+                                           stat.st_mtime_ns, kind, 0))
+            stored = array.array('Q', offsets)
+            if sys.byteorder == 'big':
+                stored.byteswap()
+            stored.tofile(handle)
+        os.replace(tmp, index)
+    except OSError as e:
+        print(f"WARNING: Failed to write the index {index}: {e}",
+              file=sys.stderr)
+    return kind, offsets
+
+def load_offset_index(input: str,
+                      index: str) -> Optional[Tuple[int, Sequence[int]]]:
+    """
+    Memory-maps a sidecar index built by build_offset_index.
+
+    Returns
+    -------
+    Optional[Tuple[int, Sequence[int]]]
+        Kind of offsets and the offsets themselves, or None if the index is
+        missing or no longer matches the size and modification time of the
+        input.
+    """
+    try:
+        stat = os.stat(input)
+        with open(index, 'rb') as handle:
+            magic, size, mtime, kind, _ = INDEX_HEADER.unpack(
+                handle.read(INDEX_HEADER.size))
+            if magic != INDEX_MAGIC or size != stat.st_size or \
+                mtime != stat.st_mtime_ns:
+                return None
+            if os.fstat(handle.fileno()).st_size == INDEX_HEADER.size:
+                return kind, array.array('Q')
+            mapped = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, struct.error):
+        return None
+
+    offsets = memoryview(mapped)[INDEX_HEADER.size:]
+    if sys.byteorder == 'big':
+        swapped = array.array('Q', bytes(offsets))
+        swapped.byteswap()
+        return kind, swapped
+    return kind, offsets.cast('Q')
+
+def fetch_records(input: str, kind: int, offsets: Sequence[int]) -> List[str]:
+    """
+    Reads the lines starting at the given offsets. Offsets are visited in file
+    order so a compressed input is only walked forward.
+    """
+    records = []
+    if kind == INDEX_BGZF:
+        with open(input, 'rb') as handle:
+            for voffset in sorted(offsets):
+                position = voffset & 0xFFFF
+                pieces = []
+                for _, data in bgzf_blocks(handle, voffset >> 16):
+                    end = data.find(b'\n', position)
+                    if end >= 0:
+                        pieces.append(data[position:end])
+                        break
+                    pieces.append(data[position:])
+                    position = 0
+                records.append(b''.join(pieces).decode().strip())
+    else:
+        open_func = gzip.open if kind == INDEX_GZIP else open
+        with open_func(input, 'rb') as handle:
+            for offset in sorted(offsets):
+                handle.seek(offset)
+                records.append(handle.readline().decode().strip())
+    return records
+
+def open_offset_index(input_file: str) -> Tuple[int, Sequence[int]]:
+    """
+    Loads the sidecar offset index of a COSMIC VCF, building it if it is
+    missing or stale.
+    """
+    index = input_file + INDEX_SUFFIX
+    loaded = load_offset_index(input_file, index)
+    if loaded is None:
+        loaded = build_offset_index(input_file, index)
+    return loaded
+
+def random_lines_selector(input_file: str, n_lines_required: int,
+                          index: Optional[Tuple[int, Sequence[int]]] = None,
+                          min_distance: int = 0,
+                          max_rounds: int = 100,
+                          seed: Optional[int] = None) -> List[str]:
+    """
+    Picks random eligible records from a COSMIC VCF without loading the whole
+    file into memory. Records are drawn from the sidecar offset index, which
+    is built on the first run and reused while the VCF is unchanged. Records
+    at the position of another pick, or closer than min_distance to it, are
+    dropped and replaced by new draws. Every round of draws comes from its
+    own child stream of the root seed.
+
+    Parameters
+    ----------
+    input_file: str
+        Path to the VCF or GNU zip (GZ) VCF file from which lines are going
+        to be picked.
 
     n_lines_required: int
         Number of lines to be picked.
 
+    index: Optional[Tuple[int, Sequence[int]]]
+        Offset index already loaded with open_offset_index. If None, it is
+        loaded here.
+
+    min_distance: int
+        Minimum distance between two picks on the same contig.
+
+    max_rounds: int
+        Maximum number of rounds of new draws before giving up.
+
+    seed: Optional[int]
+        Root seed of the draws. A new one is drawn if None.
+
     Returns
     -------
     List[str]:
-        List of lines containing random picked lines from the VCF or BED file.
-    """
-    selected = set()
-    while len(selected) < n_lines_required:
-        position = random.randint(0, n_lines_in_file - 1)
-        input.seek(position)
-        input.readline()
-        line = input.readline()
-        attr = line.strip().split()
-        if len(attr) > 4 and not line.startswith("#") and \
-            is_valid(attr[0]) and len(attr[4]) == 1:
-            selected.add(line.strip())
-    return selected
+        List of lines containing random picked lines from the VCF file,
+        sorted by contig (in file order) and position.
+    """
+    kind, offsets = index or open_offset_index(input_file)
+
+    if len(offsets) < n_lines_required:
+        raise ValueError(f"Only {len(offsets)} eligible records available "
+                         f"for {n_lines_required} requested")
+
+    root = new_root_seed() if seed is None else seed
+    rounds = itertools.count()
+    drawn = set()
+    rank = {}
+
+    def draw(k: int) -> List[Tuple[str, int, str]]:
+        rng = child_stream(root, 'records', next(rounds))
+        picks = [i for i in rng.sample(range(len(offsets)),
+                                       min(k, len(offsets)))
+                 if i not in drawn]
+        drawn.update(picks)
+        chosen = sorted(offsets[i] for i in picks)
+        sites = []
+        for offset, record in zip(chosen, fetch_records(input_file, kind,
+                                                        chosen)):
+            fields = record.split('\t')
+            rank[fields[0]] = min(rank.get(fields[0], offset), offset)
+            sites.append((fields[0], int(fields[1]), record))
+        return sites
+
+    sites = topped_up_sites(draw(n_lines_required), draw, n_lines_required,
+                            min_distance, rank, max_rounds)
+    return [record for _, _, record in sites]
+
+def new_root_seed() -> int:
+    """
+    Draws a root seed from the OS entropy pool, for unseeded runs.
+    """
+    return int.from_bytes(os.urandom(8), 'big')
+
+def stream_seed(root: int, *keys: Any) -> int:
+    """
+    Derives the seed of a child stream from a root seed and a path of keys
+    (e.g. the round and the shard of a draw), as numpy's SeedSequence does.
+    The path is hashed, so every path gets an independent stream that does
+    not depend on the order, or the process, it is spawned in.
+    """
+    path = '/'.join(str(key) for key in (root,) + keys)
+    return int.from_bytes(hashlib.sha256(path.encode()).digest(), 'big')
+
+def child_stream(root: int, *keys: Any) -> random.Random:
+    """
+    Returns the random number generator of a child stream of a root seed
+    (see stream_seed).
+    """
+    return random.Random(stream_seed(root, *keys))
+
+def open_uniform(rng: random.Random) -> float:
+    """
+    Draws a uniform number in the open interval (0, 1), safe to take logs of.
+    """
+    u = rng.random()
+    while u == 0.0:
+        u = rng.random()
+    return u
+
+def reservoir_sampler(items: Iterable[T], k: int,
+                      rng: Optional[random.Random] = None
+                      ) -> List[Tuple[int, T]]:
+    """
+    Draws k items uniformly without replacement in a single pass, keeping
+    only k items in memory (Li's Algorithm L).
+
+    Parameters
+    ----------
+    items : Iterable[T]
+        Items to sample from, read only once.
+
+    k : int
+        Number of items to be picked.
+
+    rng : Optional[random.Random]
+        Random number generator to draw from (default: a new, unseeded one).
+
+    Returns
+    -------
+    List[Tuple[int, T]]
+        Position in the stream and item of every pick, in no particular
+        order. Fewer than k pairs are returned if the stream is shorter.
+    """
+    rng = rng or random.Random()
+    iterator = enumerate(items)
+    reservoir = []
+    if k <= 0:
+        return reservoir
+    for pair in iterator:
+        reservoir.append(pair)
+        if len(reservoir) == k:
+            break
+    if len(reservoir) < k:
+        return reservoir
+
+    w = math.exp(math.log(open_uniform(rng)) / k)
+    next_pick = k + int(math.log(open_uniform(rng)) / math.log(1 - w))
+    for i, item in iterator:
+        if i == next_pick:
+            reservoir[rng.randrange(k)] = (i, item)
+            w *= math.exp(math.log(open_uniform(rng)) / k)
+            next_pick = i + 1 + int(math.log(open_uniform(rng)) /
+                                    math.log(1 - w))
+    return reservoir
+
+def weighted_reservoir_sampler(items: Iterable[Tuple[float, T]], k: int,
+                               rng: Optional[random.Random] = None
+                               ) -> Tuple[List[T], int]:
+    """
+    Draws k items with replacement and probability proportional to their
+    weight in a single pass, keeping only k items in memory.
+
+    Every slot of the reservoir is an independent size-one weighted
+    reservoir. A slot is only replaced once the running total weight crosses
+    a threshold drawn for it, so the expected work per slot is logarithmic
+    in the stream length.
+
+    Parameters
+    ----------
+    items : Iterable[Tuple[float, T]]
+        Weight and item pairs, read only once. Items with a weight of zero
+        or less are skipped.
+
+    k : int
+        Number of items to be picked.
+
+    rng : Optional[random.Random]
+        Random number generator to draw from (default: a new, unseeded one).
+
+    Returns
+    -------
+    Tuple[List[T], int]
+        The k picks (empty if no item had a positive weight) and the number
+        of items with a positive weight seen in the stream.
+    """
+    rng = rng or random.Random()
+    slots = []
+    thresholds = []
+    total = 0.0
+    count = 0
+    for weight, item in items:
+        if weight <= 0:
+            continue
+        count += 1
+        total += weight
+        if count == 1:
+            slots = [item] * k
+            thresholds = [(total / open_uniform(rng), j) for j in range(k)]
+            heapq.heapify(thresholds)
+            continue
+        while thresholds and thresholds[0][0] < total:
+            _, j = heapq.heappop(thresholds)
+            slots[j] = item
+            heapq.heappush(thresholds, (total / open_uniform(rng), j))
+    return slots, count
+
+def parse_probe(line: str) -> Optional[Tuple[str, int, int]]:
+    """
+    Parses a capture BED line into its contig, start and end.
+
+    Returns
+    -------
+    Optional[Tuple[str, int, int]]
+        None for headers, empty regions and regions on contigs that are not
+        valid (see is_valid).
+    """
+    attr = line.split()
+    if len(attr) < 3 or attr[0].startswith(('#', 'track', 'browser')) or \
+        not is_valid(attr[0]):
+        return None
+    start, end = int(attr[1]), int(attr[2])
+    if end <= start:
+        return None
+    return sys.intern(attr[0]), start, end
+
+def _padding(size: int) -> bytes:
+    return b'\x00' * (-size % 8)
+
+class ProbeIndex:
+    """
+    Capture regions of a BED in a compact binary layout, read straight from
+    a memory map: a table of contig names, then one column per field (contig
+    code, start, end, running maximum end per contig and cumulative length)
+    and the first region of every contig. Regions are grouped by contig, in
+    order of first appearance, and sorted by start within a contig, which is
+    the file order of a sorted BED.
+
+    The buffer is read-only, so forked workers share its pages instead of
+    holding a copy of the regions each.
+    """
+
+    def __init__(self, buffer: Any) -> None:
+        self.buffer = buffer
+        view = memoryview(buffer)
+        _, self.size, self.mtime, count, n_contigs, names_size = \
+            PROBES_HEADER.unpack_from(view)
+        position = PROBES_HEADER.size
+        names = bytes(view[position:position + names_size])
+        self.names = [name.decode() for name in names.split(b'\x00')[:-1]]
+        position += names_size + len(_padding(names_size))
+
+        columns = []
+        for typecode, length in (('I', count), ('q', count), ('q', count),
+                                 ('q', count), ('q', count),
+                                 ('q', n_contigs + 1)):
+            size = length * array.array(typecode).itemsize
+            column = view[position:position + size]
+            if sys.byteorder == 'big':
+                column = array.array(typecode, bytes(column))
+                column.byteswap()
+            else:
+                column = column.cast(typecode)
+            columns.append(column)
+            position += size + len(_padding(size))
+        self.codes, self.starts, self.ends, self.max_ends, \
+            self.cumulative, self.offsets = columns
+        self.contigs = ContigColumn(self.names, self.codes)
+        self.by_name = {name: code for code, name in enumerate(self.names)}
+
+    def __len__(self) -> int:
+        return len(self.codes)
+
+    def total(self) -> int:
+        """
+        Returns the number of target bases (overlapping regions counted once
+        per region).
+        """
+        return self.cumulative[-1] if len(self.cumulative) else 0
+
+    def in_target(self, contig: str, position: int, padding: int = 0) -> bool:
+        """
+        Checks if a 0-based position falls within padding bases of any
+        region.
+        """
+        code = self.by_name.get(contig)
+        if code is None:
+            return False
+        low, high = self.offsets[code], self.offsets[code + 1]
+        i = bisect.bisect_right(self.starts, position + padding, low, high)
+        return i > low and self.max_ends[i - 1] + padding > position
+
+class ContigColumn:
+    """
+    Contig name of every region of a ProbeIndex, decoded from its code on
+    access.
+    """
+
+    def __init__(self, names: List[str], codes: Sequence[int]) -> None:
+        self.names = names
+        self.codes = codes
+
+    def __len__(self) -> int:
+        return len(self.codes)
+
+    def __getitem__(self, i: int) -> str:
+        return self.names[self.codes[i]]
+
+def build_probe_index(input: str, index: str) -> ProbeIndex:
+    """
+    Parses a capture BED once (see parse_probe) and stores its regions in a
+    sidecar probe index keyed by the size and modification time of the BED.
+
+    Parameters
+    ----------
+    input : str
+        Path to the BED file (or gzipped BED file).
+
+    index : str
+        Path to the sidecar index.
+
+    Returns
+    -------
+    ProbeIndex
+        Regions of the BED, kept in memory if the index cannot be written.
+    """
+    codes = {}
+    regions = []
+    with open_file(input) as BED_in:
+        for line in BED_in:
+            probe = parse_probe(line)
+            if probe:
+                code = codes.setdefault(probe[0], len(codes))
+                regions.append((code, probe[1], probe[2]))
+    regions.sort()
+
+    offsets = array.array('q', [0] * (len(codes) + 1))
+    starts, ends = array.array('q'), array.array('q')
+    max_ends, cumulative = array.array('q'), array.array('q')
+    total = 0
+    for i, (code, start, end) in enumerate(regions):
+        offsets[code + 1] = i + 1
+        if i and regions[i - 1][0] == code:
+            max_ends.append(max(max_ends[-1], end))
+        else:
+            max_ends.append(end)
+        starts.append(start)
+        ends.append(end)
+        total += end - start
+        cumulative.append(total)
+
+    stat = os.stat(input)
+    names = b''.join(name.encode() + b'\x00' for name in codes)
+    out = bytearray(PROBES_HEADER.pack(PROBES_MAGIC, stat.st_size,
+                                       stat.st_mtime_ns, len(regions),
+                                       len(codes), len(names)))
+    out += names + _padding(len(names))
+    for column in (array.array('I', (code for code, _, _ in regions)),
+                   starts, ends, max_ends, cumulative, offsets):
+        if sys.byteorder == 'big':
+            column.byteswap()
+        data = column.tobytes()
+        out += data + _padding(len(data))
+
+    tmp = f"{index}.{os.getpid()}.tmp"
+    try:
+        with open(tmp, 'wb') as handle:
+            handle.write(out)
+        os.replace(tmp, index)
+    except OSError as e:
+        print(f"WARNING: Failed to write the index {index}: {e}",
+              file=sys.stderr)
+    return ProbeIndex(bytes(out))
+
+def load_probe_index(input: str, index: str) -> Optional[ProbeIndex]:
+    """
+    Memory-maps a sidecar probe index built by build_probe_index.
+
+    Returns
+    -------
+    Optional[ProbeIndex]
+        Regions of the BED, or None if the index is missing or no longer
+        matches the size and modification time of the input.
+    """
+    try:
+        stat = os.stat(input)
+        with open(index, 'rb') as handle:
+            magic, size, mtime, _, _, _ = PROBES_HEADER.unpack(
+                handle.read(PROBES_HEADER.size))
+            if magic != PROBES_MAGIC or size != stat.st_size or \
+                mtime != stat.st_mtime_ns:
+                return None
+            mapped = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+        return ProbeIndex(mapped)
+    except (OSError, ValueError, TypeError, struct.error):
+        return None
+
+def open_probe_index(input_file: str) -> ProbeIndex:
+    """
+    Loads the sidecar probe index of a capture BED, building it if it is
+    missing or stale.
+    """
+    index = input_file + PROBES_SUFFIX
+    loaded = load_probe_index(input_file, index)
+    if loaded is None:
+        loaded = build_probe_index(input_file, index)
+    return loaded
+
+def spaced_sites(sites: Iterable[tuple], min_distance: int,
+                 rank: Optional[Dict[str, int]] = None) -> List[tuple]:
+    """
+    Sorts sites by contig order and position, dropping exact duplicates and
+    every site closer than min_distance to the previous site kept on the
+    same contig.
+
+    Parameters
+    ----------
+    sites : Iterable[tuple]
+        Sites whose first two items are the contig and position; any further
+        items are kept along.
+
+    min_distance : int
+        Minimum distance between two sites on the same contig.
+
+    rank : Optional[Dict[str, int]]
+        Sort key of every contig, e.g. its order in the input. Contigs are
+        ranked by first appearance in sites if None.
+
+    Returns
+    -------
+    List[tuple]
+        Sites kept, in genomic order.
+    """
+    by_contig = {}
+    for site in sites:
+        by_contig.setdefault(site[0], []).append(site)
+    if rank is None:
+        rank = {contig: i for i, contig in enumerate(by_contig)}
+    gap = max(min_distance, 1)
+    after = operator.itemgetter(slice(1, None))
+    kept = []
+    # Contigs are sorted apart, so sites are compared without a key
+    # function call each
+    for contig in sorted(by_contig, key=rank.__getitem__):
+        last = None
+        for site in sorted(by_contig[contig], key=after):
+            if last is not None and site[1] - last < gap:
+                continue
+            kept.append(site)
+            last = site[1]
+    return kept
+
+def topped_up_sites(sites: List[tuple], draw: Callable[[int], List[tuple]],
+                    number: int, min_distance: int = 0,
+                    rank: Optional[Dict[str, int]] = None,
+                    max_rounds: int = 100) -> List[tuple]:
+    """
+    Sorts and spaces sites (see spaced_sites), replacing every site dropped
+    with new draws until number distinct sites are placed.
+
+    Parameters
+    ----------
+    sites : List[tuple]
+        Sites drawn so far.
+
+    draw : Callable[[int], List[tuple]]
+        Draws the given number of new sites.
+
+    number : int
+        Number of sites to be placed.
+
+    min_distance, rank :
+        As in spaced_sites.
+
+    max_rounds : int
+        Maximum number of rounds of new draws before giving up.
+
+    Returns
+    -------
+    List[tuple]
+        Exactly number sites, in genomic order.
+    """
+    sites = spaced_sites(sites, min_distance, rank)
+    for _ in range(max_rounds):
+        if len(sites) >= number:
+            return sites[:number]
+        sites = spaced_sites(sites + draw(number - len(sites)), min_distance,
+                             rank)
+    if len(sites) >= number:
+        return sites[:number]
+    raise ValueError(f"Could not place {number} distinct sites at least "
+                     f"{min_distance} bp apart")
+
+_DRAW = {}
+
+def draw_shard(task: Tuple[int, int, int]
+               ) -> Tuple[array.array, array.array]:
+    """
+    Draws a shard of target bases for site_sampler from the capture regions
+    it shares, in one batched call of a numpy Generator seeded from the child
+    stream of the shard. Runs in the calling process or in a forked worker.
+
+    Parameters
+    ----------
+    task : Tuple[int, int, int]
+        Round of draws, shard within the round and number of sites. Together
+        with the root seed, they name the child stream the shard is drawn
+        from.
+
+    Returns
+    -------
+    Tuple[array.array, array.array]
+        Region and 0-based position of every site, in genomic order. Arrays
+        are returned, rather than tuples, as they are cheap to send back
+        from a worker.
+    """
+    r, shard, k = task
+    settings = _DRAW
+    gen = np.random.default_rng(stream_seed(settings['root'], 'sites', r,
+                                            shard))
+    if settings['replacement']:
+        offsets = gen.integers(0, settings['total'], size=k)
+    else:
+        offsets = gen.choice(settings['total'], size=k, replace=False)
+    offsets.sort()
+    cumulative = settings['cumulative']
+    found = np.searchsorted(cumulative, offsets, side='right')
+    previous = np.where(found > 0, cumulative[found - 1], 0)
+    positions = settings['starts'][found] + offsets - previous
+    return array.array('q', found.astype(np.int64).tobytes()), \
+        array.array('q', positions.astype(np.int64).tobytes())
+
+def site_sampler(contigs: Sequence[str], starts: Sequence[int],
+                 ends: Sequence[int], number: int, replacement: bool = True,
+                 min_distance: int = 0, max_rounds: int = 100,
+                 cumulative: Optional[Sequence[int]] = None,
+                 rank: Optional[Dict[str, int]] = None,
+                 seed: Optional[int] = None, workers: int = 1
+                 ) -> List[Tuple[str, int]]:
+    """
+    Draws target bases uniformly over the capture regions, so every region is
+    weighted by its length. Bases are drawn as offsets into the concatenated
+    regions, one batched call of a numpy Generator per shard, and mapped back
+    to their region with numpy.searchsorted over the cumulative region
+    lengths. Duplicate sites, and sites closer than min_distance, are
+    dropped and replaced by new draws.
+
+    Every round of draws is split into shards of SHARD_SITES sites, each
+    drawn from its own child stream of the root seed (see draw_shard), so
+    the shards can be drawn by several workers and the sites are the same
+    whatever the number of workers.
+
+    Parameters
+    ----------
+    contigs, starts, ends : Sequence
+        Capture regions, as held by a ProbeIndex.
+
+    number : int
+        Number of sites to be picked.
+
+    replacement : bool
+        If False, a target base is never drawn twice within a shard of
+        draws.
+
+    min_distance : int
+        Minimum distance between two sites on the same contig.
+
+    max_rounds : int
+        Maximum number of rounds of new draws before giving up.
+
+    cumulative : Optional[Sequence[int]]
+        Cumulative region lengths, if already computed.
+
+    rank : Optional[Dict[str, int]]
+        Order of the contigs (see spaced_sites).
+
+    seed : Optional[int]
+        Root seed of the draws. A new one is drawn if None.
+
+    workers : int
+        Worker processes drawing the shards. Draws are made in the calling
+        process if it is a worker itself.
+
+    Returns
+    -------
+    List[Tuple[str, int]]
+        Contig and 0-based position of every site, sorted by contig order
+        and position.
+    """
+    starts = np.asarray(starts, dtype=np.int64)
+    if cumulative is None:
+        cumulative = np.cumsum(np.asarray(ends, dtype=np.int64) - starts)
+    cumulative = np.asarray(cumulative, dtype=np.int64)
+    total = int(cumulative[-1]) if len(cumulative) else 0
+    if total < number or total == 0:
+        raise ValueError(f"Only {total} target bases available for "
+                         f"{number} requested")
+
+    if rank is None:
+        rank = {}
+        for contig in contigs:
+            rank.setdefault(contig, len(rank))
+
+    _DRAW.update(contigs=contigs, starts=starts, cumulative=cumulative,
+                 total=total, replacement=replacement,
+                 root=new_root_seed() if seed is None else seed)
+    rounds = itertools.count()
+    pool = None
+
+    def draw(k: int) -> List[Tuple[str, int]]:
+        r = next(rounds)
+        tasks = [(r, shard, min(SHARD_SITES, k - shard * SHARD_SITES))
+                 for shard in range(-(-k // SHARD_SITES))]
+        shards = pool.map(draw_shard, tasks) if pool else \
+            map(draw_shard, tasks)
+        return [(contigs[i], position) for regions, positions in shards
+                for i, position in zip(regions, positions)]
+
+    # Workers are forked so they inherit the capture regions; pool workers
+    # (e.g. of a batch) cannot have workers of their own.
+    workers = min(workers, -(-number // SHARD_SITES))
+    if workers > 1 and not multiprocessing.current_process().daemon:
+        pool = multiprocessing.get_context('fork').Pool(workers)
+    try:
+        return topped_up_sites(draw(number), draw, number, min_distance,
+                               rank, max_rounds)
+    finally:
+        if pool:
+            pool.terminate()
+
+def write_seed(output: str, root: int) -> None:
+    """
+    Records the root seed the sites and VAFs of an output BED were drawn
+    from in its sidecar (<output>.seed).
+    """
+    with open(output + SEED_SUFFIX, 'w') as seed_out:
+        seed_out.write(f'{root}\n')
 
 def guided(input_file: str, output: str, vaf_low: float, vaf_high: float,
-           number: int, seed: int) -> int:
+           number: int, seed: int, streaming: bool = False,
+           index: Optional[Tuple[int, Sequence[int]]] = None,
+           min_distance: int = 0) -> int:
     """
     Generates a modified BED file using a COSMIC VCF as a guide for simulation.
+    Sites are written sorted by contig and position, each position once, and
+    the root seed of the draws is recorded in a sidecar (see write_seed).
 
     Parameters
     ----------
@@ -130,46 +950,88 @@ def guided(input_file: str, output: str, vaf_low: float, vaf_high: float,
         Number of variants to include in the output BED file.
 
     seed : int
-        Seed for the random number generator to allow reproducibility of
-        results.
+        Root seed of the random number generators to allow reproducibility
+        of results. A new one is drawn, and recorded in the sidecar, if None.
+
+    streaming : bool
+        If True, picks the variants with a single sequential pass over the
+        VCF instead of using the sidecar offset index.
+
+    index : Optional[Tuple[int, Sequence[int]]]
+        Offset index already loaded with open_offset_index, shared by the
+        samples of a batch.
+
+    min_distance : int
+        Minimum distance between two sites on the same contig. Not available
+        in streaming mode.
 
     Returns
     -------
     int
         Returns 0 on successful execution, or 1 if an error occurs.
     """
-    total_lines = n_lines_in_file(input_file)
     try:
-        if seed:
-            random.seed(seed)
+        root = new_root_seed() if seed is None else seed
 
-        VCF_in = open_file(input_file)
+        if streaming:
+            with open_file(input_file) as VCF_in:
+                records = (line.strip() for line in VCF_in
+                           if is_eligible_record(line))
+                # Records at the same position as the previous one are
+                # skipped, so a sorted VCF yields distinct positions
+                distinct = (next(group) for _, group in itertools.groupby(
+                    records, key=lambda line: line.split('\t', 2)[:2]))
+                picks = reservoir_sampler(distinct, number,
+                                          child_stream(root, 'stream'))
+            if len(picks) < number:
+                raise ValueError(f"Only {len(picks)} eligible records "
+                                 f"available for {number} requested")
+            rank = {}
+            sites = []
+            for i, line in sorted(picks):
+                fields = line.split('\t')
+                rank.setdefault(fields[0], i)
+                sites.append((fields[0], int(fields[1]), line))
+            sites = spaced_sites(sites, 0, rank)
+            if len(sites) < number:
+                raise ValueError(f"Only {len(sites)} distinct positions "
+                                 f"among the {number} records picked; the "
+                                 f"VCF is not sorted")
+            selection = [line for _, _, line in sites]
+        else:
+            selection = random_lines_selector(input_file, number, index,
+                                              min_distance, seed=root)
         BED_out = open(output + '.bed', 'w')
 
-        selection = random_lines_selector(VCF_in, total_lines, number)
-
         if vaf_low is not None and vaf_high is not None:
+            vafs = child_stream(root, 'vaf')
             for i, line in enumerate(selection, 1):
                 fields = line.strip().split('\t')
-                vaf = round(random.uniform(vaf_low, vaf_high), 3)
+                vaf = round(vafs.uniform(vaf_low, vaf_high), 3)
                 BED_out.write(
                     f'chr{fields[0]}\t{int(fields[1])-1}\t{int(fields[1])}\t{vaf}\t{fields[4]}'
                 )
                 if i < number:
                     BED_out.write('\n')
 
-        VCF_in.close()
         BED_out.close()
+        write_seed(output, root)
         return 0
 
     except Exception as e:
         print(f"ERROR: An unexpected error occurred: {e}", file=sys.stderr)
         return 1
 
-def stochastic(input: str, output: str, vaf_low: float, vaf_high: float, 
-               number: int, seed: int) -> int:
+def stochastic(input: str, output: str, vaf_low: float, vaf_high: float,
+               number: int, seed: int, streaming: bool = False,
+               replacement: bool = True, min_distance: int = 0,
+               probes: Optional[ProbeIndex] = None, workers: int = 1) -> int:
     """
     Generates a modified BED file stochastically using a capture BED file.
+    Sites are drawn uniformly over the target bases, so longer regions are
+    proportionally more likely to be mutated, and written sorted by contig
+    (in BED order) and position, each position once, and the root seed of the
+    draws is recorded in a sidecar (see write_seed).
 
     Parameters
     ----------
@@ -191,8 +1053,29 @@ def stochastic(input: str, output: str, vaf_low: float, vaf_high: float,
         Number of variants to include in the output BED file.
 
     seed : int
-        Seed for the random number generator to allow reproducibility of
-        results.
+        Root seed of the random number generators to allow reproducibility
+        of results. A new one is drawn, and recorded in the sidecar, if None.
+
+    streaming : bool
+        If True, picks the regions with a single sequential pass over the
+        BED, keeping only the picked regions in memory, instead of using the
+        sidecar probe index.
+
+    replacement : bool
+        If False, a target base is never picked twice. Not available in
+        streaming mode.
+
+    min_distance : int
+        Minimum distance between two sites on the same contig. Not available
+        in streaming mode.
+
+    probes : Optional[ProbeIndex]
+        Probe index already loaded with open_probe_index, shared by the
+        samples of a batch.
+
+    workers : int
+        Worker processes drawing the sites (see site_sampler). The output
+        does not depend on it. Not available in streaming mode.
 
     Returns
     -------
@@ -200,11 +1083,11 @@ def stochastic(input: str, output: str, vaf_low: float, vaf_high: float,
         Returns 0 on successful execution, or 1 if an error occurs.
     """
     try:
-        if seed:
-            random.seed(seed)
+        root = new_root_seed() if seed is None else seed
+        rng = child_stream(root, 'stream')
 
         try:
-            BED_in = open_file(input)
+            BED_in = open_file(input) if streaming else io.StringIO()
             BED_out = open(output + '.bed', 'w')
         except Exception as e:
             print(f"ERROR: Failed to open input or output files: {e}",
@@ -212,8 +1095,16 @@ def stochastic(input: str, output: str, vaf_low: float, vaf_high: float,
             return 1
 
         try:
-            filtered_lines = [line for line in BED_in if \
-                                is_valid(line.split()[0])]
+            if streaming:
+                parsed = (parse_probe(line) for line in BED_in)
+                picked, available = weighted_reservoir_sampler(
+                    ((probe[2] - probe[1], (i, probe))
+                     for i, probe in enumerate(parsed) if probe), number,
+                    rng)
+            else:
+                if probes is None:
+                    probes = open_probe_index(input)
+                available = len(probes)
         except Exception as e:
             print(f"ERROR: Failed to process the input BED file: {e}",
                     file=sys.stderr)
@@ -221,7 +1112,7 @@ def stochastic(input: str, output: str, vaf_low: float, vaf_high: float,
             BED_out.close()
             return 1
 
-        if len(filtered_lines) < number:
+        if available == 0:
             print(
             "ERROR: Not enough regions available for the requested selection.",
             file=sys.stderr
@@ -231,7 +1122,30 @@ def stochastic(input: str, output: str, vaf_low: float, vaf_high: float,
             return 1
 
         try:
-            selection = random.choices(filtered_lines, k=number)
+            if streaming:
+                # Contigs are ordered by their first region picked, and
+                # duplicate sites are replaced by sites drawn from the picked
+                # regions again
+                rank = {}
+                for i, (contig, _, _) in sorted(picked):
+                    rank.setdefault(contig, i)
+
+                def draw(k: int) -> List[Tuple[str, int]]:
+                    return [(contig, rng.randrange(start, end))
+                            for _, (contig, start, end)
+                            in rng.choices(picked, k=k)]
+
+                selection = topped_up_sites(
+                    [(contig, rng.randrange(start, end))
+                     for _, (contig, start, end) in picked],
+                    draw, number, rank=rank)
+            else:
+                selection = site_sampler(probes.contigs, probes.starts,
+                                         probes.ends, number, replacement,
+                                         min_distance,
+                                         cumulative=probes.cumulative,
+                                         rank=probes.by_name, seed=root,
+                                         workers=workers)
         except Exception as e:
             print(f"ERROR: Failed during random selection: {e}",
                   file=sys.stderr)
@@ -240,18 +1154,15 @@ def stochastic(input: str, output: str, vaf_low: float, vaf_high: float,
             return 1
 
         try:
-            for i, line in enumerate(selection, 1):
-                attr = line.strip().split()
-                x = random.choice(range(int(attr[1]), int(attr[2]) + 1))
-
-                if vaf_low is not None and vaf_high is not None:
-                    vaf = round(random.uniform(vaf_low, vaf_high), 3)
-                    BED_out.write(f'{attr[0]}\t{x}\t{x+1}\t{vaf}')
-                else:
-                    BED_out.write(f'{attr[0]}\t{x}\t{x+1}')
-
-                if i < number:
-                    BED_out.write('\n')
+            if vaf_low is not None and vaf_high is not None:
+                vafs = child_stream(root, 'vaf')
+                rows = [f'{contig}\t{x}\t{x+1}\t'
+                        f'{round(vafs.uniform(vaf_low, vaf_high), 3)}'
+                        for contig, x in selection]
+            else:
+                rows = [f'{contig}\t{x}\t{x+1}' for contig, x in selection]
+            BED_out.write('\n'.join(rows))
+            write_seed(output, root)
         except Exception as e:
             print(f"ERROR: Failed during writing output: {e}", file=sys.stderr)
             BED_in.close()
@@ -266,22 +1177,171 @@ def stochastic(input: str, output: str, vaf_low: float, vaf_high: float,
         print(f"ERROR: An unexpected error occurred: {e}", file=sys.stderr)
         return 1
 
+def read_samples(samples_file: str) -> List[Tuple[str, Optional[int]]]:
+    """
+    Reads a batch sample sheet: one sample per line, with the output prefix
+    and, optionally, the seed separated by whitespace.
+    """
+    samples = []
+    with open(samples_file) as sheet:
+        for line in sheet:
+            attr = line.split()
+            if not attr or attr[0].startswith('#'):
+                continue
+            samples.append((attr[0], int(attr[1]) if len(attr) > 1 else None))
+    return samples
+
+_BATCH = {}
+
+def batch_sample(sample: Tuple[str, Optional[int]]) -> Tuple[str, int]:
+    """
+    Generates the BED of a single sample of a batch from the shared data
+    loaded by batch. Runs in the parent process or in a forked worker.
+    """
+    prefix, seed = sample
+    settings = _BATCH
+    output = os.path.join(settings['output_dir'], prefix)
+    if settings['method'] == 0:
+        with span("bed4sv_guided", prefix):
+            status = guided(settings['input'], output, settings['vaf_low'],
+                            settings['vaf_high'], settings['number'], seed,
+                            index=settings['shared'],
+                            min_distance=settings['min_distance'])
+    else:
+        with span("bed4sv_stochastic", prefix):
+            status = stochastic(settings['input'], output, settings['vaf_low'],
+                                settings['vaf_high'], settings['number'], seed,
+                                replacement=settings['replacement'],
+                                min_distance=settings['min_distance'],
+                                probes=settings['shared'],
+                                workers=settings['workers'])
+    return prefix, status
+
+def batch(input: str, output_dir: str, samples: List[Tuple[str, Optional[int]]],
+          method: int, vaf_low: float, vaf_high: float, number: int,
+          jobs: int = 1, **options: Any) -> int:
+    """
+    Generates the BEDs of several samples in a single process. The COSMIC
+    offset index or the capture regions are loaded once and shared by every
+    sample, and by the worker processes if more than one job is requested.
+
+    Parameters
+    ----------
+    input : str
+        Path to the COSMIC VCF (guided) or capture BED (stochastic).
+
+    output_dir : str
+        Directory where every <prefix>.bed is written.
+
+    samples : List[Tuple[str, Optional[int]]]
+        Output prefix and seed of every sample (see read_samples).
+
+    method : int
+        0 for guided, 1 for stochastic.
+
+    vaf_low, vaf_high, number :
+        As in guided and stochastic.
+
+    jobs : int
+        Number of worker processes.
+
+    options :
+        min_distance, and replacement and workers for stochastic mode.
+
+    Returns
+    -------
+    int
+        Returns 0 if every sample succeeded, or 1 otherwise.
+    """
+    try:
+        if method == 0:
+            shared = open_offset_index(input)
+        else:
+            shared = open_probe_index(input)
+    except Exception as e:
+        print(f"ERROR: Failed to load the input file: {e}", file=sys.stderr)
+        return 1
+
+    _BATCH.update(input=input, output_dir=output_dir, method=method,
+                  vaf_low=vaf_low, vaf_high=vaf_high, number=number,
+                  shared=shared, replacement=options.get('replacement', True),
+                  min_distance=options.get('min_distance', 0),
+                  workers=options.get('workers', 1))
+
+    # Workers are forked so they inherit the shared data instead of
+    # receiving a pickled copy.
+    if jobs > 1 and len(samples) > 1:
+        context = multiprocessing.get_context('fork')
+        with context.Pool(min(jobs, len(samples))) as pool:
+            results = pool.map(batch_sample, samples)
+    else:
+        results = [batch_sample(sample) for sample in samples]
+
+    failed = [prefix for prefix, status in results if status != 0]
+    for prefix in failed:
+        print(f"ERROR: Failed to generate the BED for {prefix}",
+              file=sys.stderr)
+    return 1 if failed else 0
+
 def main() -> None:
     parser = argparse.ArgumentParser(description='BED generator')
     parser.add_argument('-i', '--input', dest='input',
                         required=True, type=str, default=None)
     parser.add_argument('-o', '--output', dest='output',
-                        required=True, type=str)
+                        required=True, type=str,
+                        help='Output prefix, or output directory with '
+                             '--samples')
     parser.add_argument('-n', '--variants-number', dest='number',
                         required=True, type=int)
     parser.add_argument('-s', '--seed', dest='seed',
-                        required=False, type=int)
+                        required=False, type=int,
+                        help='Root seed, recorded in <output>.seed (default: '
+                             'drawn from the OS)')
     parser.add_argument('--vaf-low', dest='vaf_low',
                         required=False, type=float)
     parser.add_argument('--vaf-high', dest='vaf_high',
                         required=False, type=float)
+    parser.add_argument('--streaming', dest='streaming',
+                        required=False, action='store_true',
+                        help='Single pass over the input with memory bounded '
+                             'by the number of variants')
+    parser.add_argument('--no-replacement', dest='replacement',
+                        required=False, action='store_false',
+                        help='Never pick the same target base twice '
+                             '(stochastic mode)')
+    parser.add_argument('--min-distance', dest='min_distance',
+                        required=False, type=int, default=0,
+                        help='Minimum distance between sites on the same '
+                             'contig (default: 0, distinct positions only)')
+    parser.add_argument('--samples', dest='samples',
+                        required=False, type=str,
+                        help='Sample sheet with one "prefix [seed]" per line; '
+                             'writes every <prefix>.bed in a single run')
+    parser.add_argument('-j', '--jobs', dest='jobs',
+                        required=False, type=int, default=1,
+                        help='Worker processes for --samples')
+    parser.add_argument('-w', '--workers', dest='workers',
+                        required=False, type=int, default=1,
+                        help='Worker processes drawing the sites of a sample '
+                             '(stochastic mode); the output is the same with '
+                             'any number of workers')
+    parser.add_argument('-t', '--threads', dest='threads',
+                        required=False, type=int, default=None,
+                        help='Threads to decompress BGZF inputs (default: '
+                             'one per CPU, up to 32)')
     args = parser.parse_args()
 
+    if args.threads:
+        bgzf.THREADS = args.threads
+
+    if args.streaming and (not args.replacement or args.min_distance > 0):
+        parser.error("--no-replacement and --min-distance are not available "
+                     "with --streaming")
+    if args.streaming and args.workers > 1:
+        parser.error("--workers is not available with --streaming")
+    if args.streaming and args.samples:
+        parser.error("--streaming is not available with --samples")
+
     print("                            BED4SV                            \n" \
           "--------------------------------------------------------------")
 
@@ -298,10 +1358,19 @@ def main() -> None:
     print(f"\nInput File: {args.input}\nNumber of Mutations to be selected: {number}\n"
           f"Lowest VAF: {vaf_low}\nHighest VAF: {vaf_high}\n")
 
-    if method == 0:
-        guided(args.input, output, vaf_low, vaf_high, number, seed)
+    if args.samples:
+        samples = read_samples(args.samples)
+        print(f"Samples: {len(samples)}\n")
+        sys.exit(batch(args.input, output, samples, method, vaf_low, vaf_high,
+                       number, args.jobs, replacement=args.replacement,
+                       min_distance=args.min_distance, workers=args.workers))
+    elif method == 0:
+        guided(args.input, output, vaf_low, vaf_high, number, seed,
+               args.streaming, min_distance=args.min_distance)
     else:
-        stochastic(args.input, output, vaf_low, vaf_high, number, seed)
+        stochastic(args.input, output, vaf_low, vaf_high, number, seed,
+                   args.streaming, args.replacement, args.min_distance,
+                   workers=args.workers)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,593 @@
+#!/usr/bin/python3
+#
+# analysis_benchmark.py
+# v1.0
+# Last edit 2026/10/17
+#
+# Benchmarks the analysis stage (vcf_generator, vcf_compare and matrix_gen)
+# end to end, offline. A project tree is synthesised from a capture BED with
+# SomatoSim outputs, per-caller VCFs of a given sensitivity and false
+# positive rate, and placeholder BAMs whose coverage is reported by a local
+# stand-in for bedtools. The stages run as pipeline.py would run them, are
+# timed, and their TSVs are checked against the injected truth.
+
+import argparse
+import json
+import os
+import random
+import shutil
+import stat
+import subprocess
+import sys
+import time
+from typing import Dict, List, Tuple
+
+from BED4SV import site_sampler
+from benchmark import BASES, TOY_BED, generate_somatosim_output, revision
+from bgzf import BGZFWriter
+from callable_bases import CACHE_NAME, load_targets
+from pipeline import METHODS, project_stages
+from vcf_comparer import AF_RANGES, VCS
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Labels of the AF ranges in the detailed matrix, in AF_RANGES order
+AF_LABELS = ["< 0.02", "0.02 - 0.05", "0.05 - 0.1", "> 0.1"]
+
+# Depth of the uncallable stretch of every target region, and the callable
+# depth range around it (callable_bases counts depths above 10)
+LOW_DEPTH = 4
+DEPTH_RANGE = (30, 200)
+
+# Stand-in for bedtools genomecov: prints the BedGraph kept next to the BAM
+BEDTOOLS = """#!/bin/sh
+# bedtools stand-in: genomecov -ibam <bam> -bg
+exec cat "$3.bedgraph"
+"""
+
+STAGES = ["truth_vcfs"] + [f"{stage}_{method.lower()}"
+                           for stage in ("compare", "matrices")
+                           for method in METHODS]
+
+class Truth:
+    """
+    Expected counts of the analysis of a synthetic project.
+
+    Parameters
+    ----------
+    callable : Dict[Tuple[str, str], int]
+        Callable bases of every (method, sample).
+
+    calls : Dict[Tuple[str, str, str], dict]
+        Per (method, sample, caller): 'TP', 'FN', 'FP', 'on' and 'off'
+        target calls, 'ranges' with the (variants, called) of every AF
+        range, and 'found' with the position, AF and DP of every true call.
+    """
+
+    def __init__(self) -> None:
+        self.callable = {}
+        self.calls = {}
+
+def merged_regions(bed_file: str) -> Tuple[List[str], List[int], List[int]]:
+    """
+    Reads a capture BED into merged regions (see load_targets), as the
+    contig, start and end columns site_sampler draws from.
+    """
+    contigs, starts, ends = [], [], []
+    for contig, intervals in load_targets(bed_file).items():
+        for start, end in intervals:
+            contigs.append(contig)
+            starts.append(start)
+            ends.append(end)
+    return contigs, starts, ends
+
+def write_bedgraph(path: str, regions: Tuple[List[str], List[int], List[int]],
+                   rng: random.Random) -> int:
+    """
+    Writes the coverage of a placeholder BAM: every target region is
+    covered at a callable depth except for a short stretch at LOW_DEPTH.
+
+    Returns
+    -------
+    int
+        Callable bases of the BAM.
+    """
+    callable = 0
+    with open(path, 'w') as bedgraph:
+        for contig, start, end in zip(*regions):
+            low = rng.randint(0, (end - start) // 10)
+            low_start = rng.randint(start, end - low)
+            depth = rng.randint(*DEPTH_RANGE)
+            for left, right, value in [(start, low_start, depth),
+                                       (low_start, low_start + low, LOW_DEPTH),
+                                       (low_start + low, end, depth)]:
+                if right > left:
+                    bedgraph.write(f"{contig}\t{left}\t{right}\t{value}\n")
+            callable += end - start - low
+    return callable
+
+def read_simulation(path: str) -> List[Tuple[str, int, str, str, float, float,
+                                             int]]:
+    """
+    Reads a SomatoSim simulation_output.txt into the contig, 1-based
+    position, REF, ALT, input and output VAF and output depth of every
+    variant.
+    """
+    variants = []
+    with open(path) as simulation:
+        simulation.readline()
+        for line in simulation:
+            fields = line.split()
+            variants.append((fields[0], int(fields[2]), fields[7], fields[8],
+                             float(fields[3]), float(fields[5]),
+                             int(fields[6])))
+    return variants
+
+def caller_record(caller: str, contig: str, pos: int, ref: str, alt: str,
+                  af: float, dp: int) -> str:
+    """
+    Formats a call the way the caller reports its AF and DP (see the
+    normalisers of vcf_cache.py).
+    """
+    ao = max(1, round(af * dp))
+    if caller == "FreeBayes":
+        info, fmt, sample = f"DP={dp};AO={ao}", "GT:DP:AO", f"0/1:{dp}:{ao}"
+    elif caller == "LoFreq":
+        info, fmt, sample = f"DP={dp};AF={af:.4f}", "", ""
+    elif caller == "Mutect2":
+        info, fmt, sample = f"DP={dp}", "GT:AF:DP", f"0/1:{af:.3f}:{dp}"
+    elif caller == "Strelka2":
+        tiers = {base: 0 for base in BASES}
+        tiers[ref] += dp - ao
+        tiers[alt] += ao
+        info = "SOMATIC"
+        fmt = "DP:AU:CU:GU:TU"
+        sample = ":".join([str(dp)] + [f"{tiers[base]},{tiers[base]}"
+                                       for base in BASES])
+    else:
+        info, fmt, sample = f"ADP={dp}", "GT:DP:FREQ", \
+            f"0/1:{dp}:{100 * af:.2f}%"
+    fields = [contig, str(pos), ".", ref, alt, ".", "PASS", info]
+    if fmt:
+        fields += [fmt, sample]
+    return "\t".join(fields) + "\n"
+
+def write_caller_vcf(path: str, caller: str, rank: Dict[str, int],
+                     records: List[Tuple[str, int, str, str, float, int]]
+                     ) -> None:
+    """
+    Writes the BGZF VCF of a caller, sorted by contig and position.
+    """
+    header = ["##fileformat=VCFv4.2", f"##source={caller}",
+              "#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\tSAMPLE"]
+    with BGZFWriter(path) as vcf:
+        vcf.write(("\n".join(header) + "\n").encode())
+        for record in sorted(records, key=lambda r: (rank[r[0]], r[1])):
+            vcf.write(caller_record(caller, *record).encode())
+
+def off_target_sites(regions: Tuple[List[str], List[int], List[int]],
+                     k: int, exclude: set, rng: random.Random
+                     ) -> List[Tuple[str, int]]:
+    """
+    Draws k distinct 1-based positions in the gaps between the merged target
+    regions of every contig.
+    """
+    contigs, starts, ends = regions
+    gaps = [(contigs[i], ends[i], starts[i + 1])
+            for i in range(len(contigs) - 1)
+            if contigs[i] == contigs[i + 1] and starts[i + 1] > ends[i]]
+    sites = set()
+    while len(sites) < k:
+        contig, start, end = rng.choice(gaps)
+        site = (contig, rng.randrange(start, end) + 1)
+        if site not in exclude:
+            sites.add(site)
+    return sorted(sites)
+
+def synthesise_project(project: str, bed_file: str, samples: int,
+                       variants: int, sensitivity: float,
+                       false_positives: int, off_target: float,
+                       seed: int = 1) -> Truth:
+    """
+    Lays out a project as create_directories.sh does and fills it with the
+    inputs of the analysis stage.
+
+    Parameters
+    ----------
+    project : str
+        Project directory, replaced if it exists.
+
+    bed_file : str
+        Capture BED the variants, calls and coverage are placed in.
+
+    samples : int
+        Samples of every simulation method.
+
+    variants : int
+        Variants simulated per sample.
+
+    sensitivity : float
+        Chance of every caller calling each simulated variant.
+
+    false_positives : int
+        False positive calls per sample and caller.
+
+    off_target : float
+        Share of the false positives placed outside the capture regions.
+
+    seed : int
+        Seed of every random draw.
+
+    Returns
+    -------
+    Truth
+        Counts the analysis should find.
+    """
+    if os.path.exists(project):
+        shutil.rmtree(project)
+    subprocess.run(["bash", "scripts/create_directories.sh", project],
+                   cwd=ROOT, check=True, stdout=subprocess.DEVNULL)
+
+    rng = random.Random(seed)
+    regions = merged_regions(bed_file)
+    rank = {}
+    for contig in regions[0]:
+        rank.setdefault(contig, len(rank))
+    with open(os.path.join(project, "Reference", "reference.fa.fai"),
+              'w') as fai:
+        for contig in rank:
+            length = max(end for name, end in zip(regions[0], regions[2])
+                         if name == contig) + 1000
+            fai.write(f"{contig}\t{length}\t0\t60\t61\n")
+
+    truth = Truth()
+    for method in METHODS:
+        mutated = os.path.join(project, "BAMs_mutated", method)
+        for i in range(samples):
+            # Named like the real samples (<sample>.<coverage>x), which
+            # detailed_matrix relies on to find the truth-only lines
+            prefix = f"SAMPLE{i:05d}.100x"
+            os.makedirs(os.path.join(mutated, prefix))
+            simulation = os.path.join(mutated, prefix,
+                                      "simulation_output.txt")
+            sites = site_sampler(*regions, variants, rank=rank,
+                                 seed=rng.getrandbits(64))
+            generate_somatosim_output(simulation, variants,
+                                      rng.getrandbits(32), sites=sites)
+            simulated = read_simulation(simulation)
+            truth_sites = {(contig, pos) for contig, pos, *_ in simulated}
+
+            bam = os.path.join(mutated, f"{prefix}.bam")
+            with open(bam, 'wb') as placeholder:
+                placeholder.write(b"BAM\x01")
+            truth.callable[(method, prefix)] = write_bedgraph(
+                bam + ".bedgraph", regions, rng)
+
+            for caller in VCS:
+                found = {}
+                ranges = [[0, 0] for _ in AF_RANGES]
+                records = []
+                for contig, pos, ref, alt, iaf, af, dp in simulated:
+                    index = next(j for j, (_, upper) in enumerate(AF_RANGES)
+                                 if iaf < upper)
+                    ranges[index][0] += 1
+                    if rng.random() < sensitivity:
+                        ranges[index][1] += 1
+                        found[(contig, pos)] = (af, dp)
+                        records.append((contig, pos, ref, alt, af, dp))
+
+                n_off = round(false_positives * off_target)
+                n_on = false_positives - n_off
+                pool = [(contig, start + 1) for contig, start in site_sampler(
+                    *regions, n_on + variants, rank=rank,
+                    seed=rng.getrandbits(64))
+                        if (contig, start + 1) not in truth_sites]
+                fps = rng.sample(pool, n_on) + off_target_sites(
+                    regions, n_off, truth_sites, rng)
+                for contig, pos in fps:
+                    ref = rng.choice(BASES)
+                    alt = rng.choice([base for base in BASES if base != ref])
+                    records.append((contig, pos, ref, alt,
+                                    round(rng.uniform(0.01, 0.1), 3),
+                                    rng.randint(*DEPTH_RANGE)))
+
+                write_caller_vcf(
+                    os.path.join(project, "VCFs", method, caller,
+                                 f"{prefix}.{caller.lower()}.vcf.gz"),
+                    caller, rank, records)
+                truth.calls[(method, prefix, caller)] = {
+                    'TP': len(found), 'FN': variants - len(found),
+                    'FP': n_on, 'on': len(found) + n_on, 'off': n_off,
+                    'ranges': ranges, 'found': found}
+    return truth
+
+def analysis_stages(project: str, bed_file: str, variants: int) -> list:
+    """
+    Returns the analysis stages of pipeline.py for a synthetic project, in
+    the order they depend on each other.
+    """
+    stages = {stage.name: stage for stage in project_stages(
+        project, os.path.join(project, "Reference", "reference.fa"),
+        os.path.join(project, "FASTQs"), os.path.join(project, "COSMIC.vcf"),
+        bed_file, variants)}
+    return [stages[name] for name in STAGES]
+
+def reset_outputs(project: str) -> None:
+    """
+    Removes everything the analysis stage writes or caches, so the next run
+    starts cold.
+    """
+    for method in METHODS:
+        vcfs = os.path.join(project, "VCFs", method)
+        for name in os.listdir(os.path.join(vcfs, "REFs")):
+            os.remove(os.path.join(vcfs, "REFs", name))
+        for caller in VCS:
+            shutil.rmtree(os.path.join(vcfs, caller, ".calls"),
+                          ignore_errors=True)
+        cache = os.path.join(project, "BAMs_mutated", method, CACHE_NAME)
+        if os.path.exists(cache):
+            os.remove(cache)
+    analysis = os.path.join(project, "Analysis")
+    shutil.rmtree(analysis)
+    os.makedirs(analysis)
+
+def run_stage(stage, env: Dict[str, str]) -> Tuple[float, int]:
+    """
+    Runs a stage from the repository root and returns its latency (seconds)
+    and the peak RSS (KiB) of its largest process.
+    """
+    with open(stage.log, 'w') as log:
+        start = time.perf_counter()
+        process = subprocess.Popen(stage.command, cwd=ROOT, env=env,
+                                   stdout=log, stderr=subprocess.STDOUT)
+        _, status, usage = os.wait4(process.pid, 0)
+        latency = time.perf_counter() - start
+        process.returncode = os.waitstatus_to_exitcode(status) \
+            if hasattr(os, 'waitstatus_to_exitcode') else status >> 8
+    if process.returncode != 0:
+        raise RuntimeError(f"Stage {stage.name} failed, see {stage.log}")
+    return latency, usage.ru_maxrss
+
+def read_tsv(path: str) -> List[Dict[str, str]]:
+    """
+    Reads a TSV with a header line into one dict per row.
+    """
+    with open(path) as tsv:
+        header = tsv.readline().rstrip('\n').split('\t')
+        return [dict(zip(header, line.rstrip('\n').split('\t')))
+                for line in tsv if line.strip()]
+
+def check_results(project: str, truth: Truth) -> List[str]:
+    """
+    Checks the general, detailed and match tables of every method against
+    the injected truth.
+
+    Returns
+    -------
+    List[str]
+        A message for every mismatch, empty if everything matches.
+    """
+    errors = []
+
+    def expect(label: str, found, expected) -> None:
+        if str(found) != str(expected):
+            errors.append(f"{label}: {found} (expected {expected})")
+
+    def rows(path: str) -> List[Dict[str, str]]:
+        # matrix_gen logs its errors without failing, leaving tables out
+        try:
+            return read_tsv(path)
+        except OSError as e:
+            errors.append(f"{path}: {e.strerror}")
+            return []
+
+    for method in METHODS:
+        lower = method.lower()
+        stem = os.path.join(project, "Analysis", f"raw_{lower}_")
+        seen = set()
+        for row in rows(stem + "general_results.tsv"):
+            key = (method, row["File"], row["Caller"])
+            calls = truth.calls.get(key)
+            if calls is None:
+                errors.append(f"{'/'.join(key)}: unexpected general row")
+                continue
+            seen.add(key)
+            expected = {"TP": calls['TP'], "FN": calls['FN'],
+                        "FP": calls['FP'],
+                        "TN": truth.callable[(method, row["File"])],
+                        "On Target": calls['on'], "Off Target": calls['off']}
+            for column, value in expected.items():
+                expect(f"{'/'.join(key)} {column}", row.get(column), value)
+        for key in sorted(set(k for k in truth.calls if k[0] == method) - seen):
+            errors.append(f"{'/'.join(key)}: missing general row")
+
+        for row in rows(stem + "detailed_results.tsv"):
+            key = (method, row["File"], row["Caller"])
+            calls = truth.calls.get(key)
+            if calls is None:
+                errors.append(f"{'/'.join(key)}: unexpected detailed row")
+                continue
+            total, called = calls['ranges'][AF_LABELS.index(row["AF"])]
+            label = f"{'/'.join(key)} AF {row['AF']}"
+            expect(f"{label} total_variants", row["total_variants"], total)
+            expect(f"{label} total_called", row["total_called"], called)
+
+        hits = {}
+        for row in rows(stem + "matches.tsv"):
+            key = (method, row["Sample"], row["Caller"])
+            calls = truth.calls.get(key)
+            if calls is None or row["Called"] != "1":
+                continue
+            hits[key] = hits.get(key, 0) + 1
+            af, dp = calls['found'].get((row["Chrom"], int(row["Pos"])),
+                                        (None, None))
+            label = f"{'/'.join(key)} {row['Chrom']}:{row['Pos']}"
+            if af is None:
+                errors.append(f"{label}: called but not injected")
+                continue
+            expect(f"{label} cDP", row["cDP"], dp)
+            # Callers round the AF they report, FreeBayes to whole reads
+            if not abs(float(row["cAF"]) - af) <= 1 / dp + 1e-3:
+                errors.append(f"{label} cAF: {row['cAF']} (expected {af})")
+        for key, calls in truth.calls.items():
+            if key[0] == method:
+                expect(f"{'/'.join(key)} matched calls", hits.get(key, 0),
+                       calls['TP'])
+    return errors
+
+def run_analysis(work_dir: str, bed_file: str = TOY_BED, samples: int = 4,
+                 variants: int = 100, sensitivity: float = 0.8,
+                 false_positives: int = 20, off_target: float = 0.25,
+                 repeats: int = 1, seed: int = 1) -> dict:
+    """
+    Synthesises a project and times its analysis stage.
+
+    Parameters
+    ----------
+    work_dir : str
+        Directory for the project, a copy of the capture BED and the
+        bedtools stand-in.
+
+    bed_file, samples, variants, sensitivity, false_positives, off_target,
+    seed :
+        As in synthesise_project.
+
+    repeats : int
+        Cold runs of the analysis stage, each one after removing every output
+        and cache of the previous run. A last warm run follows, reusing them.
+
+    Returns
+    -------
+    dict
+        Run metadata, one result per stage (in the format of benchmark.py,
+        so results can be compared with its compare command) and the
+        mismatches against the injected truth.
+    """
+    work_dir = os.path.abspath(work_dir)
+    bed_file = os.path.abspath(bed_file)
+    project = os.path.join(work_dir, "project")
+    bin_dir = os.path.join(work_dir, "bin")
+    os.makedirs(bin_dir, exist_ok=True)
+    bedtools = os.path.join(bin_dir, "bedtools")
+    with open(bedtools, 'w') as script:
+        script.write(BEDTOOLS)
+    os.chmod(bedtools, os.stat(bedtools).st_mode | stat.S_IXUSR)
+
+    # The comparison builds a sidecar probe index next to the capture BED,
+    # so it reads a copy kept in the work directory
+    capture = os.path.join(work_dir, "capture.bed")
+    shutil.copyfile(bed_file, capture)
+
+    start = time.perf_counter()
+    truth = synthesise_project(project, capture, samples, variants,
+                               sensitivity, false_positives, off_target, seed)
+    print(f"synthesis\t{time.perf_counter() - start:.3f} s", file=sys.stderr)
+
+    env = dict(os.environ, PATH=bin_dir + os.pathsep + os.environ["PATH"])
+    env.pop("CS4B_TRACE", None)
+    stages = analysis_stages(project, capture, variants)
+    size = f"{samples}x{variants}"
+    items = samples * len(METHODS) * len(VCS)
+    timings = {stage.name: [] for stage in stages}
+    peaks = {stage.name: 0 for stage in stages}
+    warm = {}
+    errors = []
+    for run in range(max(repeats, 1) + 1):
+        if run < max(repeats, 1):
+            reset_outputs(project)
+        for stage in stages:
+            latency, rss = run_stage(stage, env)
+            if run < max(repeats, 1):
+                timings[stage.name].append(latency)
+                peaks[stage.name] = max(peaks[stage.name], rss)
+            else:
+                warm[stage.name] = latency
+        errors += [f"run {run + 1}: {error}"
+                   for error in check_results(project, truth)]
+
+    results = []
+    for stage in stages:
+        latencies = timings[stage.name]
+        median = sorted(latencies)[len(latencies) // 2]
+        results.append({
+            'benchmark': stage.name, 'size': size, 'items': items,
+            'unit': "comparisons", 'repeats': len(latencies),
+            'latencies_s': [round(latency, 6) for latency in latencies],
+            'median_s': round(median, 6),
+            'min_s': round(min(latencies), 6),
+            'warm_s': round(warm[stage.name], 6),
+            'throughput_per_s': round(items / median, 3) if median else None,
+            'peak_rss_kb': peaks[stage.name]
+        })
+        print(f"{stage.name}\t{size}\t{median:.3f} s (warm "
+              f"{warm[stage.name]:.3f} s)\t{peaks[stage.name]} KiB",
+              file=sys.stderr)
+
+    return {'revision': revision(),
+            'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'cpus': os.cpu_count(),
+            'seed': seed,
+            'parameters': {'bed': bed_file, 'samples': samples,
+                           'variants': variants, 'sensitivity': sensitivity,
+                           'false_positives': false_positives,
+                           'off_target': off_target},
+            'results': results,
+            'errors': errors}
+
+def main():
+    parser = argparse.ArgumentParser(description='analysis_benchmark')
+    parser.add_argument('-o', '--output', dest='output',
+                        required=True, type=str,
+                        help='JSON file for the results')
+    parser.add_argument('-w', '--work-dir', dest='work_dir',
+                        required=False, type=str,
+                        default='benchmark_data/analysis',
+                        help='Directory for the synthetic project')
+    parser.add_argument('-b', '--bed', dest='bed',
+                        required=False, type=str, default=TOY_BED,
+                        help='Capture BED (default: the toy probes BED)')
+    parser.add_argument('-n', '--samples', dest='samples',
+                        required=False, type=int, default=4,
+                        help='Samples per simulation method')
+    parser.add_argument('-v', '--variants', dest='variants',
+                        required=False, type=int, default=100,
+                        help='Variants simulated per sample')
+    parser.add_argument('--sensitivity', dest='sensitivity',
+                        required=False, type=float, default=0.8,
+                        help='Share of the variants every caller calls')
+    parser.add_argument('--false-positives', dest='false_positives',
+                        required=False, type=int, default=20,
+                        help='False positive calls per sample and caller')
+    parser.add_argument('--off-target', dest='off_target',
+                        required=False, type=float, default=0.25,
+                        help='Share of the false positives outside the '
+                             'capture regions')
+    parser.add_argument('-r', '--repeats', dest='repeats',
+                        required=False, type=int, default=1,
+                        help='Cold runs of the analysis stage')
+    parser.add_argument('--seed', dest='seed',
+                        required=False, type=int, default=1)
+    args = parser.parse_args()
+
+    if not 0 <= args.sensitivity <= 1 or not 0 <= args.off_target <= 1:
+        parser.error("--sensitivity and --off-target must be between 0 "
+                     "and 1")
+
+    try:
+        results = run_analysis(args.work_dir, args.bed, args.samples,
+                               args.variants, args.sensitivity,
+                               args.false_positives, args.off_target,
+                               args.repeats, args.seed)
+    except (OSError, RuntimeError, ValueError,
+            subprocess.CalledProcessError) as e:
+        print(f"ERROR: Benchmark failed: {e}", file=sys.stderr)
+        sys.exit(1)
+    with open(args.output, 'w') as output:
+        json.dump(results, output, indent=1)
+
+    for error in results['errors']:
+        print(f"ERROR: {error}", file=sys.stderr)
+    sys.exit(1 if results['errors'] else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,473 @@
+#!/usr/bin/python3
+#
+# benchmark.py
+# v1.1
+# Last edit 2026/10/17
+#
+# Benchmarks the Python stages (BED4SV guided and stochastic modes,
+# vcf_generator and matrix_gen) on deterministic synthetic inputs of several
+# sizes, measuring latency, throughput and peak memory. Results are saved as
+# JSON so revisions can be compared with the compare command.
+
+import argparse
+import gzip
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+from typing import Callable, List, Optional, Sequence, Tuple
+
+from vcf_comparer import AF_RANGES, VCS, venn_lines
+from vcf_generator import GRCH38_CONTIGS
+
+# Number of VCF records, BED intervals, SomatoSim variants and samples of
+# raw results of every size
+SIZES = {
+    "small": {"vcf": 10 ** 4, "bed": 10 ** 3, "somatosim": 10 ** 3,
+              "samples": 10},
+    "medium": {"vcf": 10 ** 6, "bed": 10 ** 5, "somatosim": 10 ** 4,
+               "samples": 100},
+    "large": {"vcf": 10 ** 7, "bed": 10 ** 6, "somatosim": 10 ** 5,
+              "samples": 1000}
+}
+
+BENCHMARKS = ["guided_plain", "guided_gz", "stochastic",
+              "create_vcf_from_somatosim", "general_matrix",
+              "detailed_matrix"]
+
+TOY_BED = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..",
+                       "toy_dataset", "Probes_IDT_xGen_v2_chr22.bed")
+
+BASES = "ACGT"
+WRITE_BATCH = 10000
+
+# Mutations drawn per sample, as sim_guided and sim_stochastic request
+SELECTED = 500
+
+def write_lines(path: str, lines: Sequence[str],
+                compress: bool = False) -> None:
+    """
+    Writes lines to a plain or GNU zip file.
+    """
+    with (gzip.open(path, 'wt') if compress else open(path, 'w')) as output:
+        for start in range(0, len(lines), WRITE_BATCH):
+            output.write("".join(lines[start:start + WRITE_BATCH]))
+
+def spread(total: int, contigs: Sequence[Tuple[str, int]]) -> List[int]:
+    """
+    Splits a number of records across contigs in proportion to their length.
+    """
+    genome = sum(length for _, length in contigs)
+    counts = [total * length // genome for _, length in contigs]
+    counts[0] += total - sum(counts)
+    return counts
+
+def generate_cosmic_vcf(path: str, records: int, seed: int = 1,
+                        compress: bool = False) -> None:
+    """
+    Generates a COSMIC-like VCF (GRCh38 contigs without the chr prefix,
+    sorted, about 10% of records with multi-base ALT and hence not eligible
+    for guided simulation).
+    """
+    rng = random.Random(seed)
+    contigs = [(name[3:] if name != "chrM" else "MT", length)
+               for name, length in GRCH38_CONTIGS]
+    lines = ["##fileformat=VCFv4.1\n",
+             "##source=COSMICv99\n",
+             "##reference=GRCh38\n",
+             '##INFO=<ID=GENE,Number=1,Type=String,Description="Gene name">\n',
+             '##INFO=<ID=STRAND,Number=1,Type=String,Description="Gene strand">\n',
+             '##INFO=<ID=LEGACY_ID,Number=1,Type=String,Description="Legacy COSMIC ID">\n',
+             '##INFO=<ID=CNT,Number=1,Type=Integer,Description="How many samples have this mutation">\n',
+             "#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n"]
+    record_id = 0
+    for (contig, length), count in zip(contigs, spread(records, contigs)):
+        step = max(1, length // (count + 1))
+        pos = 0
+        for _ in range(count):
+            pos += rng.randint(1, 2 * step - 1) if step > 1 else 1
+            ref = rng.choice(BASES)
+            alt = rng.choice([base for base in BASES if base != ref])
+            if rng.random() < 0.1:
+                alt += rng.choice(BASES)
+            record_id += 1
+            lines.append(f"{contig}\t{pos}\tCOSV{50000000 + record_id}\t{ref}\t"
+                         f"{alt}\t.\t.\tGENE=GENE{record_id % 20000};"
+                         f"STRAND={'+' if record_id % 2 else '-'};"
+                         f"LEGACY_ID=COSM{record_id};CNT={rng.randint(1, 50)}\n")
+    write_lines(path, lines, compress)
+
+def toy_shapes(template: str = TOY_BED) -> Tuple[List[int], List[int]]:
+    """
+    Returns the interval lengths and gaps between consecutive intervals of
+    the toy capture BED, or a fixed spread when it is not available.
+    """
+    lengths, gaps = [], []
+    try:
+        with open(template) as bed:
+            previous = None
+            for line in bed:
+                attr = line.split()
+                if len(attr) < 3 or line.startswith('#'):
+                    continue
+                start, end = int(attr[1]), int(attr[2])
+                lengths.append(end - start)
+                if previous is not None and start > previous:
+                    gaps.append(start - previous)
+                previous = end
+    except OSError:
+        pass
+    return lengths or list(range(100, 1000, 50)), \
+        gaps or list(range(1000, 20000, 500))
+
+def generate_probe_bed(path: str, intervals: int, seed: int = 1,
+                       template: str = TOY_BED) -> None:
+    """
+    Generates a capture BED in the format of the toy probes BED, resampling
+    the interval lengths and gaps of the toy BED across the GRCh38 contigs.
+    Gaps are shrunk when needed for every interval to fit in the genome.
+    """
+    rng = random.Random(seed)
+    lengths, gaps = toy_shapes(template)
+    contigs = [(name, length) for name, length in GRCH38_CONTIGS
+               if name != "chrM"]
+    genome = sum(length for _, length in contigs)
+    expected = intervals * (sum(lengths) / len(lengths) +
+                            sum(gaps) / len(gaps))
+    scale = min(1.0, 0.9 * genome / expected)
+
+    lines = ["#chrom\tchromStart\tchromEnd\tname\tscore\tstrand\n"]
+    for (contig, _), count in zip(contigs, spread(intervals, contigs)):
+        end = 0
+        gene, exon = 0, 0
+        for _ in range(count):
+            start = end + max(1, int(rng.choice(gaps) * scale))
+            end = start + rng.choice(lengths)
+            if exon == 0 or rng.random() < 0.2:
+                gene, exon = gene + 1, 0
+            exon += 1
+            lines.append(f"{contig}\t{start}\t{end}\t{contig.upper()}G{gene}_"
+                         f"{exon}\t0\t{rng.choice('+-')}\n")
+    write_lines(path, lines)
+
+def generate_somatosim_output(path: str, variants: int, seed: int = 1,
+                              sites: Optional[Sequence[Tuple[str, int]]] = None
+                              ) -> None:
+    """
+    Generates a SomatoSim simulation_output.txt, in the unsorted order
+    SomatoSim reports variants. Variants are placed at random across the
+    GRCh38 contigs, or at the given contigs and 0-based positions.
+    """
+    rng = random.Random(seed)
+    contigs = [(name, length) for name, length in GRCH38_CONTIGS
+               if name != "chrM"]
+    if sites is not None:
+        sites = list(sites)
+        rng.shuffle(sites)
+        variants = len(sites)
+    lines = ["chrom\tstart\tend\tinput_VAF\tinput_cov\toutput_VAF\t"
+             "output_cov\tref\talt\n"]
+    for i in range(variants):
+        if sites is None:
+            contig, length = rng.choice(contigs)
+            start = rng.randrange(length - 1)
+        else:
+            contig, start = sites[i]
+        input_vaf = round(rng.uniform(0.005, 0.2), 3)
+        input_cov = rng.randint(60, 200)
+        output_cov = max(1, input_cov - rng.randint(0, 5))
+        output_vaf = round(max(1 / output_cov, input_vaf +
+                               rng.gauss(0, 0.01)), 3)
+        ref = rng.choice(BASES)
+        alt = rng.choice([base for base in BASES if base != ref])
+        lines.append(f"{contig}\t{start}\t{start + 1}\t{input_vaf}\t"
+                     f"{input_cov}\t{output_vaf}\t{output_cov}\t{ref}\t{alt}\n")
+    write_lines(path, lines)
+
+def generate_raw_results(general_path: str, detailed_path: str, samples: int,
+                         variants: int = 100, seed: int = 1) -> None:
+    """
+    Generates raw general and detailed results for a number of samples, as
+    vcf_compare writes them, with every caller finding a random share of the
+    truth set.
+    """
+    rng = random.Random(seed)
+    general, detailed = [], []
+    for sample in range(samples):
+        # Named like the real samples (<sample>.<coverage>x), which
+        # detailed_matrix relies on to find the truth-only lines
+        prefix = f"SAMPLE{sample:05d}.100x"
+        base = f"VCFs/Guided/REFs/{prefix}"
+        truth = f"{base}_all.vcf.gz"
+        per_range = spread(variants, [(name, 1) for name, _ in AF_RANGES])
+        general.append(f"FL\t{prefix}\t{rng.randint(30000000, 40000000)}\n")
+        detailed.append(f"FL\t{prefix}\t\n")
+
+        for vc in VCS:
+            caller_file = f"VCFs/Guided/{vc}/{prefix}.{vc.lower()}.vcf.gz"
+            found = [rng.randint(0, total) for total in per_range]
+            tp = sum(found)
+            called = tp + rng.randint(0, 50)
+            general += [line + "\n" for line in venn_lines(
+                vc, truth, variants, caller_file, called, tp, variants - tp,
+                called - tp)]
+            for (name, _), total, hits in zip(AF_RANGES, per_range, found):
+                detailed.append(name + "\n")
+                detailed += [line + "\n" for line in venn_lines(
+                    vc, base + name + ".vcf.gz", total, caller_file, called,
+                    hits, total - hits, called - hits)]
+                detailed.append("\n")
+
+    write_lines(general_path, general)
+    write_lines(detailed_path, detailed)
+
+def measure(function: Callable, args: Sequence) -> Tuple[float, int]:
+    """
+    Runs a function in a forked child and returns its latency (seconds) and
+    peak RSS (KiB), so every measurement starts from the same memory state.
+    """
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        status = 0
+        try:
+            start = time.perf_counter()
+            function(*args)
+            message = {'latency': time.perf_counter() - start}
+        except BaseException as e:
+            message = {'error': f"{type(e).__name__}: {e}"}
+            status = 1
+        os.write(write_fd, json.dumps(message).encode())
+        os._exit(status)
+
+    os.close(write_fd)
+    with os.fdopen(read_fd) as pipe:
+        message = json.loads(pipe.read() or '{"error": "no result"}')
+    _, _, usage = os.wait4(pid, 0)
+    if 'error' in message:
+        raise RuntimeError(message['error'])
+    return message['latency'], usage.ru_maxrss
+
+def noop() -> None:
+    pass
+
+def benchmark_cases(name: str, size: str, work_dir: str,
+                    seed: int) -> Tuple[Callable, Sequence, int, str]:
+    """
+    Generates (once) the input of a benchmark and returns the function to
+    measure, its arguments, the number of input items and their unit.
+    """
+    counts = SIZES[size]
+    quiet = os.path.join(work_dir, "out")
+    os.makedirs(quiet, exist_ok=True)
+
+    if name in ("guided_plain", "guided_gz"):
+        from BED4SV import guided
+        suffix = ".vcf.gz" if name == "guided_gz" else ".vcf"
+        path = os.path.join(work_dir, f"cosmic_{counts['vcf']}{suffix}")
+        if not os.path.exists(path):
+            generate_cosmic_vcf(path, counts['vcf'], seed,
+                                compress=suffix == ".vcf.gz")
+        return guided, (path, os.path.join(quiet, name), 0.02, 0.2,
+                        SELECTED, seed), counts['vcf'], "records"
+
+    if name == "stochastic":
+        from BED4SV import stochastic
+        path = os.path.join(work_dir, f"probes_{counts['bed']}.bed")
+        if not os.path.exists(path):
+            generate_probe_bed(path, counts['bed'], seed)
+        return stochastic, (path, os.path.join(quiet, name), 0.02, 0.2,
+                            SELECTED, seed), counts['bed'], "intervals"
+
+    if name == "create_vcf_from_somatosim":
+        from vcf_generator import create_vcf_from_somatosim
+        path = os.path.join(work_dir,
+                            f"simulation_output_{counts['somatosim']}.txt")
+        if not os.path.exists(path):
+            generate_somatosim_output(path, counts['somatosim'], seed)
+        return create_vcf_from_somatosim, \
+            (path, os.path.join(quiet, "truth")), counts['somatosim'], \
+            "variants"
+
+    general = os.path.join(work_dir, f"raw_general_{counts['samples']}.txt")
+    detailed = os.path.join(work_dir, f"raw_detailed_{counts['samples']}.txt")
+    if not (os.path.exists(general) and os.path.exists(detailed)):
+        generate_raw_results(general, detailed, counts['samples'], seed=seed)
+
+    from matrix_gen import detailed_matrix, general_matrix
+    if name == "general_matrix":
+        return general_matrix, (general, os.path.join(quiet, "general.tsv")), \
+            counts['samples'], "samples"
+    return detailed_matrix, (detailed, os.path.join(quiet, "detailed.tsv")), \
+        counts['samples'], "samples"
+
+def revision() -> Optional[str]:
+    """
+    Returns the git revision of the repository, or None outside git.
+    """
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+            cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run_benchmarks(names: Sequence[str], sizes: Sequence[str], work_dir: str,
+                   repeats: int = 3, seed: int = 1) -> dict:
+    """
+    Runs every benchmark at every size.
+
+    Parameters
+    ----------
+    names : Sequence[str]
+        Benchmarks to run (see BENCHMARKS).
+
+    sizes : Sequence[str]
+        Input sizes (see SIZES).
+
+    work_dir : str
+        Directory for the generated inputs, which are reused by later runs,
+        and the outputs.
+
+    repeats : int
+        Timed runs of every benchmark, after a first (cold) run that also
+        builds any index or cache.
+
+    seed : int
+        Seed of the input generators and of the sampling.
+
+    Returns
+    -------
+    dict
+        Run metadata and one result per benchmark and size.
+    """
+    os.makedirs(work_dir, exist_ok=True)
+    _, baseline = measure(noop, ())
+    results = []
+    for size in sizes:
+        for name in names:
+            function, args, items, unit = benchmark_cases(name, size,
+                                                          work_dir, seed)
+            cold, peak = measure(function, args)
+            latencies = []
+            for _ in range(repeats):
+                latency, rss = measure(function, args)
+                latencies.append(latency)
+                peak = max(peak, rss)
+            median = sorted(latencies)[len(latencies) // 2] \
+                if latencies else cold
+            results.append({
+                'benchmark': name, 'size': size, 'items': items,
+                'unit': unit, 'repeats': repeats,
+                'cold_s': round(cold, 6),
+                'latencies_s': [round(latency, 6) for latency in latencies],
+                'median_s': round(median, 6),
+                'min_s': round(min(latencies, default=cold), 6),
+                'throughput_per_s': round(items / median, 3) if median else None,
+                'peak_rss_kb': peak
+            })
+            print(f"{name}\t{size}\t{median:.3f} s\t{peak} KiB",
+                  file=sys.stderr)
+
+    return {'revision': revision(),
+            'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'seed': seed,
+            'baseline_rss_kb': baseline,
+            'results': results}
+
+def compare(old: dict, new: dict) -> List[str]:
+    """
+    Formats the change of median latency and peak RSS of every benchmark
+    and size present in two result files.
+    """
+    before = {(entry['benchmark'], entry['size']): entry
+              for entry in old['results']}
+    lines = ["\t".join(["Benchmark", "Size", "Old_s", "New_s", "Speedup",
+                        "Old_RSS_KiB", "New_RSS_KiB"])]
+    for entry in new['results']:
+        previous = before.get((entry['benchmark'], entry['size']))
+        if previous is None:
+            continue
+        speedup = previous['median_s'] / entry['median_s'] \
+            if entry['median_s'] else float('inf')
+        lines.append("\t".join(map(str, [
+            entry['benchmark'], entry['size'], previous['median_s'],
+            entry['median_s'], round(speedup, 3), previous['peak_rss_kb'],
+            entry['peak_rss_kb']])))
+    return lines
+
+def comma_list(choices: Sequence[str]) -> Callable[[str], List[str]]:
+    def parse(text: str) -> List[str]:
+        values = [value for value in text.split(",") if value]
+        unknown = [value for value in values if value not in choices]
+        if unknown:
+            raise argparse.ArgumentTypeError(
+                f"unknown value(s) {', '.join(unknown)}; choose from "
+                f"{', '.join(choices)}")
+        return values
+    return parse
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark')
+    commands = parser.add_subparsers(dest='command')
+
+    run_parser = commands.add_parser('run', help='Run the benchmarks')
+    run_parser.add_argument('-o', '--output', dest='output',
+                            required=True, type=str,
+                            help='JSON file for the results')
+    run_parser.add_argument('-w', '--work-dir', dest='work_dir',
+                            required=False, type=str,
+                            default='benchmark_data',
+                            help='Directory for the generated inputs')
+    run_parser.add_argument('-s', '--sizes', dest='sizes',
+                            required=False, type=comma_list(list(SIZES)),
+                            default=["small", "medium"],
+                            help='Comma-separated sizes (default: '
+                                 'small,medium)')
+    run_parser.add_argument('-b', '--benchmarks', dest='benchmarks',
+                            required=False, type=comma_list(BENCHMARKS),
+                            default=BENCHMARKS,
+                            help='Comma-separated benchmarks (default: all)')
+    run_parser.add_argument('-r', '--repeats', dest='repeats',
+                            required=False, type=int, default=3)
+    run_parser.add_argument('--seed', dest='seed',
+                            required=False, type=int, default=1)
+
+    compare_parser = commands.add_parser('compare', help='Compare two result '
+                                                         'files')
+    compare_parser.add_argument('old', type=str)
+    compare_parser.add_argument('new', type=str)
+    args = parser.parse_args()
+
+    if args.command == 'run':
+        try:
+            results = run_benchmarks(args.benchmarks, args.sizes,
+                                     args.work_dir, args.repeats, args.seed)
+        except RuntimeError as e:
+            print(f"ERROR: Benchmark failed: {e}", file=sys.stderr)
+            sys.exit(1)
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=1)
+
+    elif args.command == 'compare':
+        try:
+            with open(args.old) as old, open(args.new) as new:
+                lines = compare(json.load(old), json.load(new))
+        except (OSError, ValueError) as e:
+            print(f"ERROR: Failed to read results: {e}", file=sys.stderr)
+            sys.exit(1)
+        print("\n".join(lines))
+
+    else:
+        parser.print_help()
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,334 @@
+#!/usr/bin/python3
+#
+# bgzf.py
+# v1.1
+# Last edit 2026/10/17
+#
+# BGZF (blocked GNU zip) reading and writing, and tabix (TBI) indexing, so
+# truth sets can be written compressed and indexed without bgzip, bcftools or
+# tabix, and large BGZF inputs (COSMIC VCFs, capture BEDs) can be
+# decompressed on several cores.
+
+import collections
+import gzip
+import io
+import os
+import struct
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, IO, Iterator, List, Optional, Sequence, Tuple
+
+# Uncompressed bytes per block, as bgzip uses
+BLOCK_SIZE = 0xff00
+
+EOF_BLOCK = bytes.fromhex("1f8b08040000000000ff0600424302001b0003000000000000000000")
+
+# Threads used to decompress BGZF inputs, None for one per CPU (up to 32)
+THREADS = None
+
+# Blocks read ahead per decompression thread
+READ_AHEAD = 4
+
+TBI_VCF = 2
+TBI_WINDOW = 14
+TBI_PSEUDO_BIN = 37450
+
+def compress_block(data: bytes, level: int = 6) -> bytes:
+    """
+    Compresses up to 64 KiB of data into a single BGZF block.
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    payload = compressor.compress(data) + compressor.flush()
+    header = b'\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00'
+    return header + struct.pack('<H', len(payload) + 25) + payload + \
+        struct.pack('<II', zlib.crc32(data) & 0xffffffff, len(data))
+
+def default_threads() -> int:
+    """
+    Returns the threads used to decompress BGZF inputs.
+    """
+    return THREADS or min(32, os.cpu_count() or 1)
+
+def is_bgzf(input: str) -> bool:
+    """
+    Checks if a GNU zip file is BGZF (as written by bgzip or tabix), whose
+    blocks can be addressed through virtual offsets.
+    """
+    with open(input, 'rb') as handle:
+        header = handle.read(16)
+    return header[:4] == b'\x1f\x8b\x08\x04' and header[12:14] == b'BC' \
+        and header[14:16] == b'\x02\x00'
+
+def raw_blocks(handle: IO, start: int = 0) -> Iterator[Tuple[int, bytes]]:
+    """
+    Reads the compressed blocks of a BGZF file without decompressing them.
+
+    Parameters
+    ----------
+    handle : IO
+        BGZF file opened in binary mode.
+
+    start : int
+        Compressed offset of the first block to be read.
+
+    Returns
+    -------
+    Iterator[Tuple[int, bytes]]
+        Compressed offset and raw deflate payload of every block.
+    """
+    handle.seek(start)
+    offset = start
+    while True:
+        header = handle.read(12)
+        if len(header) < 12:
+            return
+        xlen = struct.unpack_from('<H', header, 10)[0]
+        extra = handle.read(xlen)
+        bsize = None
+        i = 0
+        while i + 4 <= len(extra):
+            slen = struct.unpack_from('<H', extra, i + 2)[0]
+            if extra[i:i + 2] == b'BC':
+                bsize = struct.unpack_from('<H', extra, i + 4)[0]
+            i += 4 + slen
+        if bsize is None:
+            raise ValueError(f"Not a BGZF block at offset {offset}")
+        body = handle.read(bsize + 1 - 12 - xlen)
+        yield offset, body[:-8]
+        offset += bsize + 1
+
+def inflate(payload: bytes) -> bytes:
+    """
+    Decompresses the raw deflate payload of a BGZF block.
+    """
+    return zlib.decompress(payload, -15)
+
+def bgzf_blocks(handle: IO, start: int = 0,
+                threads: int = 1) -> Iterator[Tuple[int, bytes]]:
+    """
+    Reads a BGZF file block by block, in file order. With several threads,
+    blocks are decompressed ahead in a thread pool (zlib releases the GIL),
+    keeping at most READ_AHEAD blocks per thread in flight.
+
+    Parameters
+    ----------
+    handle : IO
+        BGZF file opened in binary mode.
+
+    start : int
+        Compressed offset of the first block to be read.
+
+    threads : int
+        Decompression threads; 1 decompresses in the calling thread.
+
+    Returns
+    -------
+    Iterator[Tuple[int, bytes]]
+        Compressed offset and uncompressed data of every block.
+    """
+    if threads <= 1:
+        for offset, payload in raw_blocks(handle, start):
+            yield offset, inflate(payload)
+        return
+
+    pending = collections.deque()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        try:
+            for offset, payload in raw_blocks(handle, start):
+                pending.append((offset, pool.submit(inflate, payload)))
+                if len(pending) >= threads * READ_AHEAD:
+                    offset, future = pending.popleft()
+                    yield offset, future.result()
+            while pending:
+                offset, future = pending.popleft()
+                yield offset, future.result()
+        finally:
+            for _, future in pending:
+                future.cancel()
+
+class BGZFReader(io.RawIOBase):
+    """
+    Binary stream over the uncompressed contents of a BGZF file, decompressed
+    in parallel by bgzf_blocks. Wrap it in io.BufferedReader and
+    io.TextIOWrapper (as open_input does) to read lines.
+    """
+
+    def __init__(self, path: str, threads: Optional[int] = None,
+                 start: int = 0) -> None:
+        super().__init__()
+        self.handle = open(path, 'rb')
+        self.blocks = bgzf_blocks(self.handle, start,
+                                  threads or default_threads())
+        self.buffer = memoryview(b'')
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, target) -> int:
+        while not self.buffer:
+            try:
+                self.buffer = memoryview(next(self.blocks)[1])
+            except StopIteration:
+                return 0
+        size = min(len(target), len(self.buffer))
+        target[:size] = self.buffer[:size]
+        self.buffer = self.buffer[size:]
+        return size
+
+    def close(self) -> None:
+        if not self.closed:
+            self.blocks.close()
+            self.handle.close()
+        super().close()
+
+def open_input(path: str, mode: str = 'rt',
+               threads: Optional[int] = None) -> IO:
+    """
+    Opens a plain, GNU zip or BGZF file for reading. BGZF files are
+    decompressed in parallel; other GNU zip files fall back to gzip.
+
+    Parameters
+    ----------
+    path : str
+        Path to the file.
+
+    mode : str
+        'rt' for text or 'rb' for binary.
+
+    threads : Optional[int]
+        Decompression threads for BGZF files (default: THREADS, or one per
+        CPU).
+
+    Returns
+    -------
+    IO
+        File opened.
+    """
+    if not path.endswith('.gz'):
+        return open(path, mode)
+    if not is_bgzf(path):
+        return gzip.open(path, mode)
+    stream = io.BufferedReader(BGZFReader(path, threads),
+                               buffer_size=BLOCK_SIZE)
+    return io.TextIOWrapper(stream) if 't' in mode else stream
+
+class BGZFWriter:
+    """
+    Writes a BGZF file, keeping track of the virtual offset (compressed
+    offset of the block << 16 | offset within the block) of the data written
+    so far.
+    """
+
+    def __init__(self, path: str, level: int = 6) -> None:
+        self.handle = open(path, 'wb')
+        self.level = level
+        self.buffer = bytearray()
+        self.block_offset = 0
+
+    def tell(self) -> int:
+        """
+        Returns the virtual offset the next write will start at.
+        """
+        return (self.block_offset << 16) | len(self.buffer)
+
+    def write(self, data: bytes) -> None:
+        self.buffer += data
+        while len(self.buffer) >= BLOCK_SIZE:
+            self._flush_block(BLOCK_SIZE)
+
+    def _flush_block(self, size: int) -> None:
+        block = compress_block(bytes(self.buffer[:size]), self.level)
+        self.handle.write(block)
+        self.block_offset += len(block)
+        del self.buffer[:size]
+
+    def close(self) -> None:
+        if self.buffer:
+            self._flush_block(len(self.buffer))
+        self.handle.write(EOF_BLOCK)
+        self.handle.close()
+
+    def __enter__(self) -> 'BGZFWriter':
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+def reg2bin(beg: int, end: int) -> int:
+    """
+    Returns the UCSC bin of a 0-based, half-open region, as in the SAM/tabix
+    specification.
+    """
+    end -= 1
+    if beg >> 14 == end >> 14:
+        return ((1 << 15) - 1) // 7 + (beg >> 14)
+    if beg >> 17 == end >> 17:
+        return ((1 << 12) - 1) // 7 + (beg >> 17)
+    if beg >> 20 == end >> 20:
+        return ((1 << 9) - 1) // 7 + (beg >> 20)
+    if beg >> 23 == end >> 23:
+        return ((1 << 6) - 1) // 7 + (beg >> 23)
+    if beg >> 26 == end >> 26:
+        return ((1 << 3) - 1) // 7 + (beg >> 26)
+    return 0
+
+def write_tabix(path: str, contigs: Sequence[str],
+                records: Dict[str, List[Tuple[int, int, int, int]]]) -> None:
+    """
+    Writes a tabix (TBI) index for a sorted, BGZF-compressed VCF.
+
+    Parameters
+    ----------
+    path : str
+        Path to the index (<vcf>.gz.tbi).
+
+    contigs : Sequence[str]
+        Contigs with at least one record, in file order.
+
+    records : Dict[str, List[Tuple[int, int, int, int]]]
+        0-based start, end, and virtual offsets where every record starts and
+        ends, per contig and in file order.
+    """
+    names = b''.join(name.encode() + b'\x00' for name in contigs)
+    out = bytearray(b'TBI\x01')
+    out += struct.pack('<8i', len(contigs), TBI_VCF, 1, 2, 0, ord('#'), 0,
+                       len(names))
+    out += names
+
+    for name in contigs:
+        bins = {}
+        linear = []
+        for beg, end, voffset_beg, voffset_end in records[name]:
+            chunks = bins.setdefault(reg2bin(beg, end), [])
+            if chunks and chunks[-1][1] == voffset_beg:
+                chunks[-1][1] = voffset_end
+            else:
+                chunks.append([voffset_beg, voffset_end])
+
+            last_window = (max(end, beg + 1) - 1) >> TBI_WINDOW
+            if len(linear) <= last_window:
+                linear.extend([None] * (last_window + 1 - len(linear)))
+            for window in range(beg >> TBI_WINDOW, last_window + 1):
+                if linear[window] is None:
+                    linear[window] = voffset_beg
+
+        first, last = records[name][0][2], records[name][-1][3]
+        out += struct.pack('<i', len(bins) + 1)
+        for bin_id in sorted(bins):
+            out += struct.pack('<Ii', bin_id, len(bins[bin_id]))
+            for voffset_beg, voffset_end in bins[bin_id]:
+                out += struct.pack('<QQ', voffset_beg, voffset_end)
+        out += struct.pack('<IiQQQQ', TBI_PSEUDO_BIN, 2, first, last,
+                           len(records[name]), 0)
+
+        previous = 0
+        for window, voffset in enumerate(linear):
+            linear[window] = previous if voffset is None else voffset
+            previous = linear[window]
+        out += struct.pack('<i', len(linear))
+        out += struct.pack(f'<{len(linear)}Q', *linear)
+
+    out += struct.pack('<Q', 0)
+
+    with BGZFWriter(path) as index:
+        index.write(bytes(out))
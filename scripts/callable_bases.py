@@ -0,0 +1,211 @@
+#!/usr/bin/python3
+#
+# callable_bases.py
+# v1.0
+# Last edit 2026/10/17
+#
+# Counts the callable bases (TN denominator) of every mutated BAM from its
+# bedtools genomecov profile and keeps the counts in a cache, so the analysis
+# stage only recomputes coverage for BAMs that have changed.
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+DEFAULT_THRESHOLD = 10
+CACHE_NAME = "callable_bases.json"
+
+def load_targets(bed_file: str) -> Dict[str, List[Tuple[int, int]]]:
+    """
+    Reads a capture BED, sorting and merging the regions of every contig so
+    overlapping probes are only counted once.
+    """
+    regions = {}
+    with open(bed_file) as bed:
+        for line in bed:
+            attr = line.split()
+            if len(attr) < 3 or attr[0].startswith(('#', 'track', 'browser')):
+                continue
+            regions.setdefault(attr[0], []).append((int(attr[1]),
+                                                    int(attr[2])))
+
+    targets = {}
+    for contig, intervals in regions.items():
+        merged = []
+        for start, end in sorted(intervals):
+            if merged and start <= merged[-1][1]:
+                merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+            else:
+                merged.append((start, end))
+        targets[contig] = merged
+    return targets
+
+def genomecov(bam: str) -> Iterator[Tuple[str, int, int, int]]:
+    """
+    Runs bedtools genomecov over a BAM, yielding every BedGraph record as
+    contig, start, end and depth.
+    """
+    process = subprocess.Popen(['bedtools', 'genomecov', '-ibam', bam, '-bg'],
+                               stdout=subprocess.PIPE,
+                               universal_newlines=True)
+    for line in process.stdout:
+        attr = line.split()
+        yield attr[0], int(attr[1]), int(attr[2]), int(float(attr[3]))
+    process.stdout.close()
+    if process.wait() != 0:
+        raise RuntimeError(f"bedtools genomecov failed for {bam}")
+
+def count_callable(records: Iterable[Tuple[str, int, int, int]],
+                   threshold: int,
+                   targets: Optional[Dict[str, List[Tuple[int, int]]]] = None
+                   ) -> int:
+    """
+    Adds up the bases covered above a depth threshold.
+
+    Parameters
+    ----------
+    records : Iterable[Tuple[str, int, int, int]]
+        BedGraph records sorted by position within every contig.
+
+    threshold : int
+        Bases are callable if their depth is strictly above this value.
+
+    targets : Optional[Dict[str, List[Tuple[int, int]]]]
+        Merged capture regions (see load_targets). If given, only bases
+        inside them are counted.
+
+    Returns
+    -------
+    int
+        Number of callable bases.
+    """
+    total = 0
+    cursor = {}
+    for contig, start, end, depth in records:
+        if depth <= threshold:
+            continue
+        if targets is None:
+            total += end - start
+            continue
+
+        intervals = targets.get(contig)
+        if not intervals:
+            continue
+        i = cursor.get(contig, 0)
+        while i < len(intervals) and intervals[i][1] <= start:
+            i += 1
+        cursor[contig] = i
+        while i < len(intervals) and intervals[i][0] < end:
+            total += min(end, intervals[i][1]) - max(start, intervals[i][0])
+            i += 1
+    return total
+
+def load_cache(cache_file: str) -> Dict[str, dict]:
+    """
+    Loads a callable bases cache, returning an empty one if it is missing or
+    unreadable.
+    """
+    try:
+        with open(cache_file) as cache:
+            return json.load(cache)
+    except (OSError, ValueError):
+        return {}
+
+def save_cache(cache_file: str, cache: Dict[str, dict]) -> None:
+    """
+    Writes a callable bases cache atomically.
+    """
+    tmp = f"{cache_file}.{os.getpid()}.tmp"
+    with open(tmp, 'w') as output:
+        json.dump(cache, output, indent=1, sort_keys=True)
+    os.replace(tmp, cache_file)
+
+def callable_bases(bam: str, cache_file: str, sample: str,
+                   threshold: int = DEFAULT_THRESHOLD,
+                   bed_file: Optional[str] = None) -> int:
+    """
+    Returns the callable bases of a BAM, computing them only if the cache
+    holds no entry for the same BAM (path, size and modification time),
+    threshold and capture BED.
+
+    Parameters
+    ----------
+    bam : str
+        Path to the mutated BAM.
+
+    cache_file : str
+        Path to the cache (callable_bases.json next to the BAMs).
+
+    sample : str
+        Sample name the count is stored under, as in the FL lines.
+
+    threshold : int
+        Bases are callable if their depth is strictly above this value.
+
+    bed_file : Optional[str]
+        Capture BED to restrict the count to.
+
+    Returns
+    -------
+    int
+        Number of callable bases.
+    """
+    path = os.path.realpath(bam)
+    stat = os.stat(path)
+    key = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns,
+           'threshold': threshold,
+           'bed': os.path.realpath(bed_file) if bed_file else None}
+
+    cache = load_cache(cache_file)
+    entry = cache.get(path)
+    if entry and all(entry.get(k) == v for k, v in key.items()):
+        return entry['callable']
+
+    targets = load_targets(bed_file) if bed_file else None
+    count = count_callable(genomecov(path), threshold, targets)
+
+    # Reload so entries written meanwhile by other samples are kept
+    cache = load_cache(cache_file)
+    cache[path] = dict(key, sample=sample, callable=count)
+    save_cache(cache_file, cache)
+    return count
+
+def read_callable_bases(cache_file: str) -> Dict[str, int]:
+    """
+    Returns the cached callable bases of every sample.
+    """
+    return {entry['sample']: entry['callable']
+            for entry in load_cache(cache_file).values()}
+
+def main():
+    parser = argparse.ArgumentParser(description='callable_bases')
+    parser.add_argument('-b', '--bam', dest='bam',
+                        required=True, type=str)
+    parser.add_argument('-s', '--sample', dest='sample',
+                        required=True, type=str)
+    parser.add_argument('-c', '--cache', dest='cache',
+                        required=False, type=str, default=None,
+                        help=f'Cache file (default: {CACHE_NAME} next to '
+                             'the BAM)')
+    parser.add_argument('-t', '--threshold', dest='threshold',
+                        required=False, type=int, default=DEFAULT_THRESHOLD,
+                        help='Minimum depth, exclusive')
+    parser.add_argument('--bed', dest='bed',
+                        required=False, type=str, default=None,
+                        help='Capture BED to restrict the count to')
+    args = parser.parse_args()
+
+    cache_file = args.cache or os.path.join(os.path.dirname(args.bam),
+                                            CACHE_NAME)
+    try:
+        print(callable_bases(args.bam, cache_file, args.sample,
+                             args.threshold, args.bed))
+    except Exception as e:
+        print(f"ERROR: Failed to count callable bases: {e}", file=sys.stderr)
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
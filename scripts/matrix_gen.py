@@ -1,167 +1,1107 @@
 #!/usr/bin/python3
 #
 # matrix_gen.py
-# v1.3
-# Last edit 2024/11/18
+# v1.9
+# Last edit 2026/10/17
 #
 # Processes both general and detailed comparisons done by vcf-compare
-# to generate matrices that R could process easily.
+# to generate matrices that R could process easily. Raw results can also be
+# read straight from a shard directory written by vcf_comparer.py. In
+# incremental mode only the samples appended to the raw results since the
+# last run are aggregated, and their rows appended to the matrices.
 
 import argparse
+import fcntl
+import gzip
+import hashlib
+import json
 import logging
+import math
+import os
+import re
+import zlib
+from contextlib import contextmanager
+from statistics import NormalDist
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+from callable_bases import read_callable_bases
+from vcf_comparer import shard_lines
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
 
-def metrics(FILE: str, CALLER: str, TP: int, TN: int, FP: int, FN: int) -> list:
+METRICS = ["Sensitivity", "Specificity", "Precision", "Accuracy", "FPR",
+           "FNR", "F1 Score"]
+
+GENERAL_HEADER = ["File", "Caller", "TP", "TN", "FP", "FN"] + METRICS
+DETAILED_HEADER = ["File", "Caller", "AF", "total_variants", "total_called",
+                   "Ratio"]
+AF_LABELS = ["< 0.02", "0.02 - 0.05", "0.05 - 0.1", "> 0.1"]
+
+# Incremental mode keeps a state file next to every matrix
+STATE_SUFFIX = ".state.json"
+STATE_VERSION = 1
+
+# Report bundle: typed, compressed tables of every method and a manifest
+BUNDLE_MANIFEST = "manifest.json"
+BUNDLE_VERSION = 1
+COMPARISON = ("guided", "stochastic")
+SUMMARY_COLUMNS = ["Mean", "Wilson Low", "Wilson High", "Bootstrap Low",
+                   "Bootstrap High"]
+
+# Metrics that are a proportion of counts, as (successes, failures) columns
+# of TP, TN, FP, FN, for Wilson intervals
+PROPORTIONS = {"Sensitivity": (0, 3), "Specificity": (1, 2),
+               "Precision": (0, 2), "FPR": (2, 1), "FNR": (3, 0)}
+
+def ratio(numerator: np.ndarray, denominator: np.ndarray) -> np.ndarray:
+    """
+    Element-wise division that yields 0.0 where the denominator is 0.
+    """
+    numerator = np.asarray(numerator, dtype=float)
+    denominator = np.asarray(denominator, dtype=float)
+    return np.divide(numerator, denominator,
+                     out=np.zeros(np.broadcast(numerator, denominator).shape),
+                     where=denominator > 0)
+
+def metrics(TP: np.ndarray, TN: np.ndarray, FP: np.ndarray,
+            FN: np.ndarray) -> Dict[str, np.ndarray]:
     """
     Calculate various metrics based on True Positives, True Negatives,
-    False Positives, and False Negatives.
+    False Positives, and False Negatives, for whole arrays of counts at once.
+    """
+    sensitivity = ratio(TP, TP + FN)
+    precision = ratio(TP, TP + FP)
+    return {
+        "Sensitivity": sensitivity,
+        "Specificity": ratio(TN, TN + FP),
+        "Precision": precision,
+        "Accuracy": ratio(TP + TN, TP + TN + FP + FN),
+        "FPR": ratio(FP, FP + TN),
+        "FNR": ratio(FN, TP + FN),
+        "F1 Score": ratio(2 * precision * sensitivity, precision + sensitivity)
+    }
+
+def wilson_interval(successes: np.ndarray, trials: np.ndarray,
+                    level: float = 0.95) -> Tuple[np.ndarray, np.ndarray]:
     """
-    sensitivity = TP / (TP + FN) if (TP + FN) > 0 else 0.0
-    specificity = TN / (TN + FP) if (TN + FP) > 0 else 0.0
-    precision = TP / (TP + FP) if (TP + FP) > 0 else 0.0
-    accuracy = (TP + TN) / (TP + TN + FP + FN) if (TP + TN + FP + FN) > 0 else 0.0
-    fpr = FP / (FP + TN) if (FP + TN) > 0 else 0.0
-    fnr = FN / (TP + FN) if (TP + FN) > 0 else 0.0
-    f1_score = (2 * precision * sensitivity) / (precision + sensitivity) \
-                if (precision + sensitivity) > 0 else 0.0
+    Wilson score interval of a proportion, for whole arrays at once. Both
+    bounds are 0.0 where there are no trials.
+    """
+    z = NormalDist().inv_cdf(0.5 + level / 2)
+    successes = np.asarray(successes, dtype=float)
+    trials = np.asarray(trials, dtype=float)
+    p = ratio(successes, trials)
+    denominator = 1 + z ** 2 / np.where(trials > 0, trials, 1)
+    centre = (p + z ** 2 / (2 * np.where(trials > 0, trials, 1))) / denominator
+    margin = z * np.sqrt(ratio(p * (1 - p), trials) +
+                         ratio(z ** 2, 4 * trials ** 2)) / denominator
+    empty = trials == 0
+    return (np.where(empty, 0.0, np.clip(centre - margin, 0, 1)),
+            np.where(empty, 0.0, np.clip(centre + margin, 0, 1)))
+
+def bootstrap_interval(counts: np.ndarray, resamples: int = 2000,
+                       level: float = 0.95,
+                       rng: Optional[np.random.Generator] = None
+                       ) -> Dict[str, Tuple[float, float]]:
+    """
+    Percentile bootstrap interval of every metric of a caller, resampling its
+    samples with replacement and pooling their counts. All resamples are
+    drawn and evaluated in one vectorised operation.
+
+    Parameters
+    ----------
+    counts : np.ndarray
+        TP, TN, FP and FN of every sample, with shape (samples, 4).
+
+    resamples : int
+        Number of bootstrap resamples.
+
+    level : float
+        Confidence level.
 
-    return [FILE, CALLER, TP, TN, FP, FN, sensitivity, specificity, precision,
-            accuracy, fpr, fnr, f1_score]
+    rng : Optional[np.random.Generator]
+        Random number generator, for reproducibility.
 
-def general_matrix(input_file: str, output_file: str) -> None:
+    Returns
+    -------
+    Dict[str, Tuple[float, float]]
+        Lower and upper bound of every metric.
     """
-    Generate a general matrix from the input VCF file and save it to an
-    output file.
+    rng = rng or np.random.default_rng()
+    picks = rng.integers(0, len(counts), size=(resamples, len(counts)))
+    pooled = counts[picks].sum(axis=1)
+    values = metrics(*pooled.T)
+    alpha = (1 - level) / 2
+    return {name: tuple(np.quantile(value, [alpha, 1 - alpha]).tolist())
+            for name, value in values.items()}
+
+@contextmanager
+def read_results(input_file: str, kind: str) -> Iterator[Iterable[str]]:
+    """
+    Opens raw results for reading, either a file or a shard directory
+    written by vcf_comparer.py ('general', 'detailed' or 'matches' results
+    of every shard, merged in a fixed order).
+    """
+    if os.path.isdir(input_file):
+        yield shard_lines(input_file, kind)
+    else:
+        with open(input_file) as input:
+            yield input
+
+def general_counts(input: Iterable[str],
+                   cached_TN: Optional[Dict[str, int]] = None,
+                   targets: Optional[Dict[Tuple[str, str],
+                                          Tuple[int, int]]] = None
+                   ) -> List[Tuple[str, str, int, int, int, int]]:
+    """
+    Reads the TP, TN, FP and FN of every (file, caller) pair from lines of
+    raw general results. TN is taken from cached_TN when it holds the file.
+    If a targets dict is given, the on- and off-target calls of every (file,
+    caller) pair (OT lines, written when calls were restricted to the capture
+    BED) are stored in it.
     """
     vcs = ["FreeBayes", "LoFreq", "Mutect2", "Strelka2", "VarScan2"]
-    matrix = [["File", "Caller", "TP", "TN", "FP", "FN", "Sensitivity",
-               "Specificity", "Precision", "Accuracy", "FPR", "FNR", "F1 Score"]]
+    cached_TN = cached_TN or {}
+    targets = {} if targets is None else targets
+    rows = []
 
-    try:
-        with open(input_file) as input, open(output_file, 'w') as output:
-            TP = TN = FP = FN = 0
-            FILE = ""
-            CALLER = ""
+    TP = TN = FP = FN = 0
+    FILE = ""
+    CALLER = ""
 
-            for line in input:
-                line = line.strip()
-                if not line or line.startswith("#"):
-                    continue
-
-                if line.startswith("FL"):
-                    if FILE:
-                        matrix.append(metrics(FILE, CALLER, TP, TN, FP, FN))
-                    attr = line.split()
-                    FILE = attr[1]
-                    CALLER = ""
-                    TN = int(attr[2])
-                    TP = FP = FN = 0
-
-                elif any(vc in line for vc in vcs):
-                    attr = line.split()
-                    if CALLER != attr[0]:
-                        if CALLER:
-                            matrix.append(metrics(FILE, CALLER, TP, TN, FP, FN))
-                        CALLER = attr[0]
-                        TP = FP = FN = 0
-
-                    if len(attr) > 4:
-                        TP = int(attr[1])
-                    elif attr[2].endswith("_all.vcf.gz"):
-                        FN = int(attr[1])
-                    else:
-                        FP = int(attr[1])
+    for line in input:
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
 
+        if line.startswith("FL"):
             if FILE and CALLER:
-                matrix.append(metrics(FILE, CALLER, TP, TN, FP, FN))
+                rows.append((FILE, CALLER, TP, TN, FP, FN))
+            attr = line.split()
+            FILE = attr[1]
+            CALLER = ""
+            TN = cached_TN.get(FILE, int(attr[2]) if len(attr) > 2 else 0)
+            TP = FP = FN = 0
+
+        elif line.startswith("OT"):
+            attr = line.split()
+            targets[(FILE, attr[1])] = (int(attr[2]), int(attr[3]))
+
+        elif any(vc in line for vc in vcs):
+            attr = line.split()
+            if CALLER != attr[0]:
+                if CALLER:
+                    rows.append((FILE, CALLER, TP, TN, FP, FN))
+                CALLER = attr[0]
+                TP = FP = FN = 0
+
+            if len(attr) > 4:
+                TP = int(attr[1])
+            elif attr[2].endswith("_all.vcf.gz"):
+                FN = int(attr[1])
+            else:
+                FP = int(attr[1])
 
+    if FILE and CALLER:
+        rows.append((FILE, CALLER, TP, TN, FP, FN))
+
+    return rows
+
+def read_general_counts(input_file: str,
+                        cached_TN: Optional[Dict[str, int]] = None,
+                        targets: Optional[Dict[Tuple[str, str],
+                                               Tuple[int, int]]] = None
+                        ) -> List[Tuple[str, str, int, int, int, int]]:
+    """
+    Reads the TP, TN, FP and FN of every (file, caller) pair from raw general
+    results (see general_counts).
+    """
+    with read_results(input_file, 'general') as input:
+        return general_counts(input, cached_TN, targets)
+
+def general_table(rows: List[Tuple[str, str, int, int, int, int]],
+                  targets: Dict[Tuple[str, str], Tuple[int, int]]
+                  ) -> List[list]:
+    """
+    Builds the general matrix, header included, from the counts of every
+    (file, caller) pair. If calls were restricted to the capture BED, the
+    on- and off-target calls are added as the last columns.
+    """
+    matrix = [list(GENERAL_HEADER)]
+    counts = np.array([row[2:] for row in rows],
+                      dtype=np.int64).reshape(-1, 4)
+    values = metrics(*counts.T)
+    columns = [values[name].tolist() for name in METRICS]
+    for i, row in enumerate(rows):
+        matrix.append(list(row) + [column[i] for column in columns])
+    if targets:
+        matrix[0] += ["On Target", "Off Target"]
+        for row in matrix[1:]:
+            row += list(targets.get((row[0], row[1]), ("NA", "NA")))
+    return matrix
+
+def general_matrix(input_file: str, output_file: str,
+                   callable_cache: Optional[str] = None,
+                   summary_file: Optional[str] = None,
+                   resamples: int = 2000, level: float = 0.95,
+                   seed: Optional[int] = None) -> None:
+    """
+    Generate a general matrix from the input VCF file and save it to an
+    output file. If a callable bases cache (see callable_bases.py) is given,
+    TN is read from it instead of the FL lines. If a summary file is given,
+    per-caller aggregates with confidence intervals are saved to it too
+    (see summary_matrix). If calls were restricted to the capture BED, the
+    on- and off-target calls are added as the last columns.
+    """
+    try:
+        cached_TN = read_callable_bases(callable_cache) if callable_cache else {}
+        targets = {}
+        rows = read_general_counts(input_file, cached_TN, targets)
+        matrix = general_table(rows, targets)
+
+        with open(output_file, 'w') as output:
             for row in matrix:
                 output.write("\t".join(map(str, row)) + "\n")
 
+        if summary_file:
+            summary_matrix(rows, summary_file, resamples, level, seed)
+
     except Exception as e:
         logging.error(f"Error while processing general_matrix: {e}")
 
-def detailed_matrix(input_file: str, output_file: str) -> None:
+def summary_matrix(rows: List[Tuple[str, str, int, int, int, int]],
+                   output_file: str, resamples: int = 2000,
+                   level: float = 0.95, seed: Optional[int] = None) -> None:
     """
-    Generate a detailed matrix from the input VCF file and save it to an output file.
+    Generate a per-caller summary across samples and save it to an output
+    file. For every metric it holds the value on the pooled counts, the mean
+    across samples, the Wilson interval on the pooled counts (proportions
+    only) and a bootstrap interval over samples.
     """
-    AF_RANGES = ["< 0.02", "0.02 - 0.05", "0.05 - 0.1", "> 0.1"]
-    matrix = [["File", "Caller", "AF", "total_variants", "total_called", "Ratio"]]
+    rng = np.random.default_rng(seed)
+    header = ["Caller", "Samples", "TP", "TN", "FP", "FN"]
+    for name in METRICS:
+        header += [name, f"{name} Mean", f"{name} Wilson Low",
+                   f"{name} Wilson High", f"{name} Bootstrap Low",
+                   f"{name} Bootstrap High"]
+    matrix = [header]
+
+    callers = list(dict.fromkeys(row[1] for row in rows))
+    for caller in callers:
+        counts = np.array([row[2:] for row in rows if row[1] == caller],
+                          dtype=np.int64)
+        pooled = counts.sum(axis=0)
+        pooled_values = metrics(*pooled)
+        sample_values = metrics(*counts.T)
+        bootstrap = bootstrap_interval(counts, resamples, level, rng)
 
+        summary = [caller, len(counts)] + pooled.tolist()
+        for name in METRICS:
+            if name in PROPORTIONS:
+                hits, misses = PROPORTIONS[name]
+                low, high = wilson_interval(pooled[hits],
+                                            pooled[hits] + pooled[misses],
+                                            level)
+                wilson = [float(low), float(high)]
+            else:
+                wilson = ["NA", "NA"]
+            summary += [float(pooled_values[name]),
+                        float(sample_values[name].mean())] + wilson + \
+                       list(bootstrap[name])
+        matrix.append(summary)
+
+    with open(output_file, 'w') as output:
+        for row in matrix:
+            output.write("\t".join(map(str, row)) + "\n")
+
+def detailed_rows(input: Iterable[str]) -> Iterator[list]:
+    """
+    Yields the rows of the detailed matrix (see DETAILED_HEADER) from lines
+    of raw detailed results.
+    """
     current_file = ""
     current_caller = ""
     current_af_index = -1
     total_variants = 0
     called_variants = 0
 
-    try:
-        with open(input_file, 'r') as input, open(output_file, 'w') as output:
-            for line in input:
-
-                if line.startswith("FL"):
-                    current_file = line.split()[1]
-                    current_caller = ""
-                    current_af_index = 0
-                    total_variants = 0
-                    called_variants = 0
-
-                elif "_AF_0_to_002" == line.strip():
-                    current_af_index = 0
-
-                elif "_AF_002_to_005" == line.strip():
-                    current_af_index = 1
-
-                elif "_AF_005_to_01" == line.strip():
-                    current_af_index = 2
-
-                elif "_AF_01_to_1" == line.strip():
-                    current_af_index = 3
-
-                elif line == "\n":
-                    if current_file:
-                        matrix.append([
-                            current_file,
-                            current_caller,
-                            AF_RANGES[current_af_index],
-                            total_variants,
-                            called_variants,
-                            round((called_variants / total_variants), 2) \
-                            if total_variants > 0 else 0
-                        ])
-                    total_variants = 0
-                    called_variants = 0
-
-                else:
-                    fields = line.split()
-                    current_caller = fields[0]
-                    if len(fields) > 4:
-                        called_variants += int(fields[1])
-                        total_variants += int(fields[1])
-                    elif "x_AF_" in line:
-                        total_variants += int(fields[1])
+    for line in input:
 
-            for row in matrix:
+        if line.startswith("FL"):
+            current_file = line.split()[1]
+            current_caller = ""
+            current_af_index = 0
+            total_variants = 0
+            called_variants = 0
+
+        elif "_AF_0_to_002" == line.strip():
+            current_af_index = 0
+
+        elif "_AF_002_to_005" == line.strip():
+            current_af_index = 1
+
+        elif "_AF_005_to_01" == line.strip():
+            current_af_index = 2
+
+        elif "_AF_01_to_1" == line.strip():
+            current_af_index = 3
+
+        elif line == "\n":
+            if current_file:
+                yield [
+                    current_file,
+                    current_caller,
+                    AF_LABELS[current_af_index],
+                    total_variants,
+                    called_variants,
+                    round((called_variants / total_variants), 2) \
+                    if total_variants > 0 else 0
+                ]
+            total_variants = 0
+            called_variants = 0
+
+        else:
+            fields = line.split()
+            current_caller = fields[0]
+            if len(fields) > 4:
+                called_variants += int(fields[1])
+                total_variants += int(fields[1])
+            elif "x_AF_" in line:
+                total_variants += int(fields[1])
+
+def detailed_matrix(input_file: str, output_file: str) -> None:
+    """
+    Generate a detailed matrix from the input VCF file and save it to an output file.
+    """
+    try:
+        with read_results(input_file, 'detailed') as input, \
+             open(output_file, 'w') as output:
+            output.write("\t".join(DETAILED_HEADER) + "\n")
+            for row in detailed_rows(input):
                output.write("\t".join(map(str, row)) + "\n")
 
     except Exception as e:
         logging.error(f"Error while processing detailed_matrix: {e}")
 
+def raw_blocks(input_file: str, start: int = 0) -> Iterator[Tuple[int, bytes]]:
+    """
+    Yields the offset and contents of every sample block (an FL line and
+    the lines up to the next one) of raw results, from a block starting at
+    the given offset. The last block is left out until its last line is
+    complete, as the raw results may still be written.
+    """
+    with open(input_file, 'rb') as input:
+        input.seek(start)
+        offset = start
+        block_start = -1
+        block = []
+        for line in input:
+            if line.startswith(b"FL"):
+                if block_start >= 0:
+                    yield block_start, b"".join(block)
+                block_start = offset
+                block = []
+            if block_start >= 0:
+                block.append(line)
+            offset += len(line)
+        if block_start >= 0 and block[-1].endswith(b"\n"):
+            yield block_start, b"".join(block)
+
+def read_state(state_file: str, input_file: str, output_file: str) -> dict:
+    """
+    Loads the state of an incremental matrix, or an empty one if there is no
+    usable state for these raw results and this matrix.
+
+    Returns
+    -------
+    dict
+        'input' raw results, 'header' of the matrix, committed 'size' of the
+        matrix in bytes and 'blocks' aggregated, each with the 'sample',
+        'offset', 'length' and 'crc32' of its raw results, the 'output'
+        offset of its rows in the matrix and the caller (and AF range) of
+        every row in 'rows'.
+    """
+    empty = {'version': STATE_VERSION, 'input': os.path.abspath(input_file),
+             'header': None, 'size': 0, 'blocks': []}
+    try:
+        with open(state_file) as input:
+            state = json.load(input)
+        size = os.path.getsize(output_file)
+    except (OSError, ValueError):
+        return empty
+    if state.get('version') != STATE_VERSION or \
+       state.get('input') != empty['input'] or size < state.get('size', 0):
+        return empty
+    return state
+
+def unchanged_blocks(state: dict, input_file: str) -> int:
+    """
+    Returns how many of the aggregated blocks of a state are unchanged in
+    the raw results. A block is changed if its checksum differs, or if lines
+    were appended to it after it was aggregated.
+    """
+    with open(input_file, 'rb') as input:
+        for i, block in enumerate(state['blocks']):
+            input.seek(block['offset'])
+            data = input.read(block['length'] + 2)
+            if len(data) < block['length'] or \
+               zlib.crc32(data[:block['length']]) != block['crc32'] or \
+               not b"FL".startswith(data[block['length']:]):
+                return i
+    return len(state['blocks'])
+
+def append_matrix(input_file: str, output_file: str,
+                  tabulate: Callable[[List[List[str]]],
+                                     Tuple[List[str], List[List[list]]]],
+                  keys: int, state_file: Optional[str] = None) -> int:
+    """
+    Aggregates the sample blocks appended to raw results since the last run
+    and appends their rows to a matrix. The state file records the blocks
+    already aggregated, so a block whose raw results changed is aggregated
+    again, and the matrix is cut back to its committed size first, so rows
+    appended by an interrupted run are dropped. The matrix is rebuilt if its
+    header changes or the state does not match it.
+
+    Parameters
+    ----------
+    input_file : str
+        Raw results file.
+
+    output_file : str
+        Matrix to append to.
+
+    tabulate : Callable
+        Builds the header of the matrix and the rows of every block from the
+        lines of the blocks.
+
+    keys : int
+        Leading columns of a row after the file that identify it (caller, and
+        AF range in the detailed matrix), recorded in the state.
+
+    state_file : Optional[str]
+        State file (default: the matrix with STATE_SUFFIX).
+
+    Returns
+    -------
+    int
+        Number of blocks aggregated.
+    """
+    state_file = state_file or output_file + STATE_SUFFIX
+    state = read_state(state_file, input_file, output_file)
+    kept = unchanged_blocks(state, input_file)
+    blocks = state['blocks'][:kept]
+    start = blocks[-1]['offset'] + blocks[-1]['length'] if blocks else 0
+
+    new = list(raw_blocks(input_file, start))
+    if not new and kept == len(state['blocks']) and state['header'] and \
+       os.path.getsize(output_file) == state['size']:
+        return 0
+    header, rows = tabulate([data.decode().splitlines(True)
+                             for _, data in new])
+    if not new:
+        header = state['header'] or header
+    elif blocks and header != state['header']:
+        blocks = []
+        new = list(raw_blocks(input_file))
+        header, rows = tabulate([data.decode().splitlines(True)
+                                 for _, data in new])
+
+    append = bool(blocks)
+    size = state['blocks'][kept]['output'] if kept < len(state['blocks']) \
+        else state['size']
+    text = "" if append else "\t".join(header) + "\n"
+    offset = size if append else len(text.encode())
+    for (block_start, data), block_rows in zip(new, rows):
+        lines = "".join("\t".join(map(str, row)) + "\n"
+                        for row in block_rows)
+        blocks.append({'sample': data.split(b"\n", 1)[0].split()[1].decode(),
+                       'offset': block_start, 'length': len(data),
+                       'crc32': zlib.crc32(data), 'output': offset,
+                       'rows': [row[1:1 + keys] for row in block_rows]})
+        text += lines
+        offset += len(lines.encode())
+
+    if append:
+        with open(output_file, 'r+b') as output:
+            output.truncate(size)
+            output.seek(size)
+            output.write(text.encode())
+    else:
+        tmp = f"{output_file}.{os.getpid()}.tmp"
+        with open(tmp, 'wb') as output:
+            output.write(text.encode())
+        os.replace(tmp, output_file)
+
+    state.update(header=header, size=offset, blocks=blocks)
+    tmp = f"{state_file}.{os.getpid()}.tmp"
+    with open(tmp, 'w') as output:
+        json.dump(state, output)
+    os.replace(tmp, state_file)
+    return len(new)
+
+def incremental_general_matrix(input_file: str, output_file: str,
+                               callable_cache: Optional[str] = None,
+                               summary_file: Optional[str] = None,
+                               resamples: int = 2000, level: float = 0.95,
+                               seed: Optional[int] = None) -> None:
+    """
+    Appends the rows of the samples added to raw general results since the
+    last run to the general matrix (see append_matrix), and saves the
+    summary of all its rows again. TN of samples already aggregated is not
+    read again from the callable bases cache.
+    """
+    try:
+        cached_TN = read_callable_bases(callable_cache) if callable_cache else {}
+
+        def tabulate(blocks: List[List[str]]
+                     ) -> Tuple[List[str], List[List[list]]]:
+            targets = {}
+            counts = [general_counts(lines, cached_TN, targets)
+                      for lines in blocks]
+            matrix = general_table([row for rows in counts for row in rows],
+                                   targets)
+            header, rows, split = matrix[0], [], 1
+            for block in counts:
+                rows.append(matrix[split:split + len(block)])
+                split += len(block)
+            return header, rows
+
+        added = append_matrix(input_file, output_file, tabulate, 1)
+        logging.info(f"{added} sample(s) added to {output_file}")
+
+        if summary_file and (added or not os.path.exists(summary_file)):
+            with open(output_file) as input:
+                next(input)
+                rows = [(fields[0], fields[1]) +
+                        tuple(int(value) for value in fields[2:6])
+                        for fields in (line.rstrip("\n").split("\t")
+                                       for line in input)]
+            summary_matrix(rows, summary_file, resamples, level, seed)
+
+    except Exception as e:
+        logging.error(f"Error while processing incremental_general_matrix: "
+                      f"{e}")
+
+def incremental_detailed_matrix(input_file: str, output_file: str) -> None:
+    """
+    Appends the rows of the samples added to raw detailed results since the
+    last run to the detailed matrix (see append_matrix).
+    """
+    try:
+        def tabulate(blocks: List[List[str]]
+                     ) -> Tuple[List[str], List[List[list]]]:
+            return DETAILED_HEADER, [list(detailed_rows(lines))
+                                     for lines in blocks]
+
+        added = append_matrix(input_file, output_file, tabulate, 2)
+        logging.info(f"{added} sample(s) added to {output_file}")
+
+    except Exception as e:
+        logging.error(f"Error while processing incremental_detailed_matrix: "
+                      f"{e}")
+
+def read_match_table(input_file: str) -> Dict[str, np.ndarray]:
+    """
+    Reads a per-variant match table written by vcf_comparer.py, returning
+    every column as an array. Missing VAFs and depths are read as NaN.
+    """
+    samples, callers, values, called = [], [], [], []
+    with read_results(input_file, 'matches') as lines:
+        input = iter(lines)
+        header = next(input, "").rstrip("\n").split("\t")
+        columns = {name: i for i, name in enumerate(header)}
+        numeric = [columns["iAF"], columns["AF"], columns["DP"]]
+        for line in input:
+            fields = line.rstrip("\n").split("\t")
+            if len(fields) < len(header):
+                continue
+            samples.append(fields[columns["Sample"]])
+            callers.append(fields[columns["Caller"]])
+            values.append([float("nan") if fields[i] == "NA" else float(fields[i])
+                           for i in numeric])
+            called.append(fields[columns["Called"]] == "1")
+
+    values = np.array(values, dtype=float).reshape(-1, 3)
+    return {"Sample": np.array(samples), "Caller": np.array(callers),
+            "iAF": values[:, 0], "AF": values[:, 1], "DP": values[:, 2],
+            "Called": np.array(called, dtype=bool)}
+
+def group_codes(*columns: np.ndarray) -> Tuple[List[tuple], np.ndarray]:
+    """
+    Assigns a code to every distinct combination of the given columns, in
+    order of first appearance.
+    """
+    index = {}
+    codes = [index.setdefault(key, len(index)) for key in zip(*columns)]
+    return list(index), np.array(codes, dtype=np.int64)
+
+def binned_counts(codes: np.ndarray, groups: int, values: np.ndarray,
+                  called: np.ndarray, edges: np.ndarray
+                  ) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Counts the truth variants and the called ones of every group and VAF bin
+    with a single histogram pass.
+
+    Parameters
+    ----------
+    codes : np.ndarray
+        Group code of every variant (see group_codes).
+
+    groups : int
+        Number of groups.
+
+    values : np.ndarray
+        VAF of every variant. Variants outside the edges or without a VAF
+        are left out.
+
+    called : np.ndarray
+        Whether every variant was called.
+
+    edges : np.ndarray
+        Increasing bin edges. Bins are closed on the left, the last one on
+        both sides.
+
+    Returns
+    -------
+    Tuple[np.ndarray, np.ndarray]
+        Total and called variants, with shape (groups, bins).
+    """
+    bins = len(edges) - 1
+    index = np.searchsorted(edges, values, side='right') - 1
+    index[values == edges[-1]] = bins - 1
+    valid = (index >= 0) & (index < bins)
+    flat = codes[valid] * bins + index[valid]
+    totals = np.bincount(flat, minlength=groups * bins)
+    hits = np.bincount(flat, weights=called[valid], minlength=groups * bins)
+    return (totals.reshape(groups, bins),
+            hits.astype(np.int64).reshape(groups, bins))
+
+def bin_label(low: float, high: float) -> str:
+    """
+    Formats a VAF bin as detailed_matrix labels its ranges.
+    """
+    if np.isinf(high):
+        return f"> {low:g}"
+    if low == 0:
+        return f"< {high:g}"
+    return f"{low:g} - {high:g}"
+
+def binned_matrix(table: Dict[str, np.ndarray], output_file: str,
+                  edges: np.ndarray, field: str = "iAF") -> None:
+    """
+    Generate a detailed matrix for any VAF bins from a match table and save
+    it to an output file, with the same columns as detailed_matrix.
+    """
+    try:
+        labels, codes = group_codes(table["Sample"], table["Caller"])
+        totals, hits = binned_counts(codes, len(labels), table[field],
+                                     table["Called"], edges)
+        ratios = np.round(ratio(hits, totals), 2)
+        names = [bin_label(low, high) for low, high in zip(edges, edges[1:])]
+
+        with open(output_file, 'w') as output:
+            output.write("\t".join(["File", "Caller", "AF", "total_variants",
+                                    "total_called", "Ratio"]) + "\n")
+            for (sample, caller), total, hit, value in zip(labels, totals,
+                                                           hits, ratios):
+                for row in zip(names, total.tolist(), hit.tolist(),
+                               value.tolist()):
+                    output.write("\t".join(map(str, (sample, caller) + row))
+                                 + "\n")
+
+    except Exception as e:
+        logging.error(f"Error while processing binned_matrix: {e}")
+
+def curve_matrix(table: Dict[str, np.ndarray], output_file: str,
+                 points: int = 100, field: str = "iAF") -> None:
+    """
+    Generate a sensitivity curve over VAF for every caller, pooling all
+    samples, from a match table and save it to an output file. The curve is
+    sampled on equal-width bins between 0 and 1.
+    """
+    try:
+        edges = np.round(np.linspace(0, 1, points + 1), 6)
+        labels, codes = group_codes(table["Caller"])
+        totals, hits = binned_counts(codes, len(labels), table[field],
+                                     table["Called"], edges)
+        sensitivity = ratio(hits, totals)
+        centres = np.round((edges[:-1] + edges[1:]) / 2, 6).tolist()
+
+        with open(output_file, 'w') as output:
+            output.write("\t".join(["Caller", "VAF", "VAF_low", "VAF_high",
+                                    "total_variants", "total_called",
+                                    "Sensitivity"]) + "\n")
+            for (caller,), total, hit, value in zip(labels, totals, hits,
+                                                    sensitivity):
+                for row in zip(centres, edges[:-1].tolist(),
+                               edges[1:].tolist(), total.tolist(),
+                               hit.tolist(), value.tolist()):
+                    output.write("\t".join(map(str, (caller,) + row)) + "\n")
+
+    except Exception as e:
+        logging.error(f"Error while processing curve_matrix: {e}")
+
+def read_matrix(input_file: str) -> List[Dict[str, str]]:
+    """
+    Reads a matrix written by this script as one dict per row.
+    """
+    with open(input_file) as input:
+        header = next(input).rstrip("\n").split("\t")
+        return [dict(zip(header, line.rstrip("\n").split("\t")))
+                for line in input if line.strip()]
+
+def split_file(name: str) -> Tuple[str, str]:
+    """
+    Splits a matrix file name into sample and coverage (e.g. HG005.100x),
+    with "NA" as coverage if there is none.
+    """
+    sample, _, coverage = name.partition(".")
+    return sample, coverage or "NA"
+
+def number(text: str, digits: Optional[int] = None) -> float:
+    """
+    Parses a matrix value, NA as NaN, optionally rounded.
+    """
+    value = float("nan") if text in ("NA", "") else float(text)
+    return round(value, digits) if digits is not None else value
+
+def write_table(bundle_dir: str, name: str, columns: List[Tuple[str, str]],
+                rows: List[list],
+                levels: Optional[Dict[str, List[str]]] = None) -> dict:
+    """
+    Writes a table of a report bundle as a gzip-compressed TSV, replacing it
+    only once complete, and returns its manifest entry.
+
+    Parameters
+    ----------
+    bundle_dir : str
+        Bundle directory.
+
+    name : str
+        Table name; the file is <name>.tsv.gz.
+
+    columns : List[Tuple[str, str]]
+        Name and type ('string', 'integer' or 'double') of every column.
+
+    rows : List[list]
+        Rows of the table. None and NaN are written as NA.
+
+    levels : Optional[Dict[str, List[str]]]
+        Ordered levels of the string columns that are factors.
+
+    Returns
+    -------
+    dict
+        'file', 'rows', 'columns' (name and type), 'levels' and 'sha256' of
+        the table.
+    """
+    def cell(value: object) -> str:
+        if value is None or (isinstance(value, float) and math.isnan(value)):
+            return "NA"
+        return str(value)
+
+    file_name = f"{name}.tsv.gz"
+    text = "\t".join(column for column, _ in columns) + "\n" + \
+        "".join("\t".join(map(cell, row)) + "\n" for row in rows)
+    # mtime=0 keeps the files identical for identical tables
+    data = gzip.compress(text.encode(), mtime=0)
+    tmp = os.path.join(bundle_dir, f"{file_name}.{os.getpid()}.tmp")
+    with open(tmp, 'wb') as output:
+        output.write(data)
+    os.replace(tmp, os.path.join(bundle_dir, file_name))
+    return {'file': file_name, 'rows': len(rows),
+            'columns': [{'name': column, 'type': kind}
+                        for column, kind in columns],
+            'levels': levels or {}, 'sha256': hashlib.sha256(data).hexdigest()}
+
+def read_table(bundle_dir: str, entry: dict) -> List[list]:
+    """
+    Reads a table of a report bundle (see write_table) with typed values,
+    NA as None.
+    """
+    parse = {'string': str, 'integer': int, 'double': float}
+    kinds = [parse[column['type']] for column in entry['columns']]
+    with gzip.open(os.path.join(bundle_dir, entry['file']), 'rt') as input:
+        next(input)
+        return [[None if value == "NA" else kind(value)
+                 for kind, value in zip(kinds, line.rstrip("\n").split("\t"))]
+                for line in input]
+
+def method_tables(method: str, general_file: str, detailed_file: str,
+                  summary_file: Optional[str] = None
+                  ) -> Dict[str, Tuple[List[Tuple[str, str]], List[list],
+                                       Dict[str, List[str]]]]:
+    """
+    Builds the report tables of a simulation method from its matrices.
+
+    Returns
+    -------
+    Dict[str, Tuple]
+        Columns, rows and factor levels of every table, by name:
+        <method>_general (the general matrix with the file split into sample
+        and coverage, rounded to 4 decimals), <method>_metrics (one row per
+        sample, caller and metric), <method>_detailed (the detailed matrix),
+        <method>_af_sensitivity (pooled sensitivity of every caller, one
+        column per AF range) and, if the summary matrix is given,
+        <method>_summary (one row per caller and metric).
+    """
+    tables = {}
+    general = read_matrix(general_file)
+    targets = ["On Target", "Off Target"] \
+        if general and "On Target" in general[0] else []
+    columns = [("Sample", "string"), ("Coverage", "string"),
+               ("Caller", "string")] + \
+        [(name, "integer") for name in GENERAL_HEADER[2:6]] + \
+        [(name, "double") for name in METRICS] + \
+        [(name, "integer") for name in targets]
+    rows, long_rows = [], []
+    for row in general:
+        sample, coverage = split_file(row["File"])
+        rows.append([sample, coverage, row["Caller"]] +
+                    [int(row[name]) for name in GENERAL_HEADER[2:6]] +
+                    [number(row[name], 4) for name in METRICS] +
+                    [None if row[name] == "NA" else int(row[name])
+                     for name in targets])
+        long_rows += [[method, sample, coverage, row["Caller"], name,
+                       number(row[name])] for name in METRICS]
+    tables[f"{method}_general"] = (columns, rows, {})
+    tables[f"{method}_metrics"] = (
+        [("Method", "string"), ("Sample", "string"), ("Coverage", "string"),
+         ("Caller", "string"), ("Metric", "string"), ("Value", "double")],
+        long_rows, {"Metric": METRICS})
+
+    detailed = read_matrix(detailed_file)
+    rows = []
+    pooled = {}
+    for row in detailed:
+        sample, coverage = split_file(row["File"])
+        total, called = int(row["total_variants"]), int(row["total_called"])
+        rows.append([method, sample, coverage, row["Caller"], row["AF"],
+                     total, called, number(row["Ratio"])])
+        counts = pooled.setdefault(row["Caller"], {}).setdefault(row["AF"],
+                                                                 [0, 0])
+        counts[0] += total
+        counts[1] += called
+    tables[f"{method}_detailed"] = (
+        [("Method", "string"), ("Sample", "string"), ("Coverage", "string"),
+         ("Caller", "string"), ("AF", "string"), ("total_variants", "integer"),
+         ("total_called", "integer"), ("Ratio", "double")],
+        rows, {"AF": AF_LABELS})
+    tables[f"{method}_af_sensitivity"] = (
+        [("Method", "string"), ("Caller", "string")] +
+        [(label, "double") for label in AF_LABELS],
+        [[method, caller] +
+         [counts[label][1] / counts[label][0]
+          if counts.get(label, [0])[0] > 0 else None for label in AF_LABELS]
+         for caller, counts in pooled.items()], {})
+
+    if summary_file and os.path.exists(summary_file):
+        rows = [[method, row["Caller"], int(row["Samples"]), name,
+                 number(row[name])] +
+                [number(row[f"{name} {column}"]) for column in SUMMARY_COLUMNS]
+                for row in read_matrix(summary_file) for name in METRICS]
+        tables[f"{method}_summary"] = (
+            [("Method", "string"), ("Caller", "string"),
+             ("Samples", "integer"), ("Metric", "string"), ("Value", "double")]
+            + [(column, "double") for column in SUMMARY_COLUMNS],
+            rows, {"Metric": METRICS})
+
+    return tables
+
+def delta_rows(bundle_dir: str, tables: Dict[str, dict]) -> List[list]:
+    """
+    Compares the pooled metrics and per-AF-range sensitivity of every caller
+    between the methods in COMPARISON, as rows of caller, metric, AF range
+    ("All" for the metrics over all variants), the value of each method and
+    their difference (second minus first).
+    """
+    values = []
+    for method in COMPARISON:
+        value = {}
+        for _, caller, _, metric, pooled, *_ in \
+                read_table(bundle_dir, tables[f"{method}_summary"]):
+            value[(caller, metric, "All")] = pooled
+        for _, caller, *sensitivity in \
+                read_table(bundle_dir, tables[f"{method}_af_sensitivity"]):
+            for label, pooled in zip(AF_LABELS, sensitivity):
+                value[(caller, "Sensitivity", label)] = pooled
+        values.append(value)
+
+    rows = []
+    for key in dict.fromkeys(list(values[0]) + list(values[1])):
+        first, second = values[0].get(key), values[1].get(key)
+        delta = second - first if first is not None and second is not None \
+            else None
+        rows.append(list(key) + [first, second, delta])
+    return rows
+
+def report_bundle(bundle_dir: str, method: str, general_file: str,
+                  detailed_file: str,
+                  summary_file: Optional[str] = None) -> None:
+    """
+    Writes the report tables of a simulation method (see method_tables) to
+    a report bundle, so report.qmd only has to load and plot them. Once the
+    bundle holds every method in COMPARISON, a deltas table compares them.
+    The tables are listed in the manifest with their columns, types and
+    factor levels. The methods can be added by concurrent runs, which take
+    turns through a lock file.
+    """
+    try:
+        os.makedirs(bundle_dir, exist_ok=True)
+        with open(os.path.join(bundle_dir, ".lock"), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+
+            manifest_file = os.path.join(bundle_dir, BUNDLE_MANIFEST)
+            try:
+                with open(manifest_file) as input:
+                    manifest = json.load(input)
+            except (OSError, ValueError):
+                manifest = {}
+            if manifest.get('version') != BUNDLE_VERSION:
+                manifest = {'version': BUNDLE_VERSION, 'tables': {}}
+            tables = manifest['tables']
+
+            for name in [name for name, entry in tables.items()
+                         if entry.get('method') == method]:
+                del tables[name]
+            for name, (columns, rows, levels) in \
+                    method_tables(method, general_file, detailed_file,
+                                  summary_file).items():
+                tables[name] = dict(write_table(bundle_dir, name, columns,
+                                                rows, levels), method=method)
+
+            if all(f"{name}_{kind}" in tables for name in COMPARISON
+                   for kind in ("summary", "af_sensitivity")):
+                first, second = (name.capitalize() for name in COMPARISON)
+                tables["deltas"] = dict(write_table(
+                    bundle_dir, "deltas",
+                    [("Caller", "string"), ("Metric", "string"),
+                     ("AF", "string"), (first, "double"),
+                     (second, "double"), ("Delta", "double")],
+                    delta_rows(bundle_dir, tables),
+                    {"Metric": METRICS, "AF": ["All"] + AF_LABELS}),
+                    method=None)
+
+            manifest['tables'] = dict(sorted(tables.items()))
+            manifest['methods'] = sorted({entry['method']
+                                          for entry in tables.values()
+                                          if entry['method']})
+            tmp = f"{manifest_file}.{os.getpid()}.tmp"
+            with open(tmp, 'w') as output:
+                json.dump(manifest, output, indent=1)
+            os.replace(tmp, manifest_file)
+
+    except Exception as e:
+        logging.error(f"Error while processing report_bundle: {e}")
+
+def parse_edges(text: str) -> np.ndarray:
+    """
+    Parses comma-separated, strictly increasing VAF bin edges.
+    """
+    edges = np.array([float(edge) for edge in text.split(",")])
+    if len(edges) < 2 or np.any(np.diff(edges) <= 0):
+        raise argparse.ArgumentTypeError(
+            "at least two strictly increasing edges are required")
+    return edges
+
 def main():
     parser = argparse.ArgumentParser(description='matrix_gen')
     parser.add_argument('-g', '--general_results', dest='general',
-                        required=True, type=str)
+                        required=True, type=str,
+                        help='Raw general results, or a shard directory')
     parser.add_argument('-d', '--detailed_results', dest='detailed',
-                        required=True, type=str)
+                        required=True, type=str,
+                        help='Raw detailed results, or a shard directory')
+    parser.add_argument('-c', '--callable_bases', dest='callable',
+                        required=False, type=str, default=None)
+    parser.add_argument('-b', '--bootstrap', dest='resamples',
+                        required=False, type=int, default=2000)
+    parser.add_argument('--ci-level', dest='level',
+                        required=False, type=float, default=0.95)
+    parser.add_argument('-s', '--seed', dest='seed',
+                        required=False, type=int, default=None)
+    parser.add_argument('-m', '--match_table', dest='matches',
+                        required=False, type=str, default=None,
+                        help='Per-variant match table from vcf_comparer.py, '
+                             'or a shard directory')
+    parser.add_argument('--vaf-bins', dest='edges',
+                        required=False, type=parse_edges,
+                        default=parse_edges("0,0.02,0.05,0.1,inf"),
+                        help='Comma-separated VAF bin edges for the match '
+                             'table (default: 0,0.02,0.05,0.1,inf)')
+    parser.add_argument('--vaf-field', dest='field',
+                        required=False, choices=["iAF", "AF"], default="iAF",
+                        help='VAF to bin by: input (iAF) or output (AF)')
+    parser.add_argument('--vaf-curve', dest='points',
+                        required=False, type=int, default=100,
+                        help='Bins of the sensitivity curve over VAF, 0 to '
+                             'skip it')
+    parser.add_argument('-i', '--incremental', dest='incremental',
+                        action='store_true',
+                        help='Only aggregate the samples appended to the raw '
+                             'results files since the last run and append '
+                             'their rows to the matrices, keeping a state '
+                             f'file (<matrix>{STATE_SUFFIX}) next to each')
+    parser.add_argument('-r', '--report', dest='report',
+                        required=False, type=str, default=None,
+                        help='Report bundle directory to add the tables of '
+                             'this method to (e.g. Analysis/report)')
+    parser.add_argument('--method', dest='method',
+                        required=False, type=str, default=None,
+                        help='Simulation method in the report bundle '
+                             '(default: from raw_<method>_general_results)')
     args = parser.parse_args()
 
     general_input = args.general
-    general_output = general_input.rsplit('.', 1)[0] + ".tsv"
+    general_stem = os.path.join(general_input, "general_results") \
+        if os.path.isdir(general_input) else general_input.rsplit('.', 1)[0]
+    general_output = general_stem + ".tsv"
+    summary_output = general_stem + "_summary.tsv"
     detailed_input = args.detailed
-    detailed_output = detailed_input.rsplit('.', 1)[0] + ".tsv"
+    detailed_stem = os.path.join(detailed_input, "detailed_results") \
+        if os.path.isdir(detailed_input) else detailed_input.rsplit('.', 1)[0]
+    detailed_output = detailed_stem + ".tsv"
+
+    incremental = args.incremental
+    if incremental and (os.path.isdir(general_input) or
+                        os.path.isdir(detailed_input)):
+        logging.warning("Shard directories are merged in sample order, not "
+                        "appended to; aggregating all samples")
+        incremental = False
+
+    if incremental:
+        incremental_general_matrix(general_input, general_output,
+                                   args.callable, summary_output,
+                                   args.resamples, args.level, args.seed)
+        incremental_detailed_matrix(detailed_input, detailed_output)
+    else:
+        general_matrix(general_input, general_output, args.callable,
+                       summary_output, args.resamples, args.level, args.seed)
+        detailed_matrix(detailed_input, detailed_output)
+
+    if args.report:
+        match = re.search(r"raw_(.+?)_general_results",
+                          os.path.basename(os.path.normpath(general_input)))
+        method = args.method or (match.group(1) if match else
+                                 os.path.basename(general_stem))
+        report_bundle(args.report, method.lower(), general_output,
+                      detailed_output, summary_output)
 
-    general_matrix(general_input, general_output)
-    detailed_matrix(detailed_input, detailed_output)
+    if args.matches:
+        match_stem = os.path.join(args.matches, "matches") \
+            if os.path.isdir(args.matches) else args.matches.rsplit('.', 1)[0]
+        try:
+            table = read_match_table(args.matches)
+        except Exception as e:
+            logging.error(f"Error while reading match table: {e}")
+            return
+        binned_matrix(table, match_stem + "_binned.tsv", args.edges,
+                      args.field)
+        if args.points > 0:
+            curve_matrix(table, match_stem + "_curve.tsv", args.points,
+                         args.field)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,637 @@
+#!/usr/bin/python3
+#
+# pipeline.py
+# v1.3
+# Last edit 2026/10/17
+#
+# Runs the CloneSim4Bench stages (pre-processing, simulation, variant calling,
+# truth VCFs, comparison and matrices) as a dependency graph. Independent
+# stages run concurrently within CPU and memory budgets, and a stage is only
+# rerun when its inputs, parameters or upstream stages have changed.
+
+import argparse
+import glob
+import hashlib
+import json
+import logging
+import os
+import subprocess
+import sys
+import time
+from typing import Dict, List, Optional, Sequence
+
+from tracing import TRACE_NAME
+
+logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+
+METHODS = ["Guided", "Stochastic"]
+
+# Script, output folder and log name of every variant caller
+CALLERS = [("freebayes", "FreeBayes"), ("lofreq", "LoFreq"),
+           ("mutect2", "Mutect2"), ("strelka2", "Strelka2"),
+           ("varscan2", "VarScan2")]
+
+# Final VCFs every caller leaves in its output folder
+CALLER_VCFS = {"freebayes": "*.filtered.vcf.gz", "lofreq": "*.lofreq.vcf.gz",
+               "mutect2": "*.filtered.vcf.gz", "strelka2": "*.filtered.vcf.gz",
+               "varscan2": "*.filtered.vcf.gz"}
+
+# Callers that can split the capture BED into shards (scripts/scatter_gather.py)
+SHARDED_CALLERS = {"freebayes", "lofreq", "mutect2"}
+
+# CPUs and memory (GiB) every stage is expected to use, after the parallel
+# jobs and threads the scripts launch
+RESOURCES = {
+    "pre_processing": (8, 16),
+    "sim": (6, 12),
+    "freebayes": (6, 8),
+    "lofreq": (8, 8),
+    "mutect2": (8, 16),
+    "strelka2": (8, 8),
+    "varscan2": (6, 8),
+    "truth_vcfs": (6, 4),
+    "compare": (4, 4),
+    "matrices": (1, 2)
+}
+
+STATE_DIR = ".pipeline"
+HASH_CACHE = "hashes.json"
+CHUNK_SIZE = 1 << 20
+
+class Stage:
+    """
+    A step of the pipeline: a command, the stages it depends on, and the
+    files that decide whether it has to run again.
+
+    Parameters
+    ----------
+    name : str
+        Unique stage name, also used for its marker.
+
+    command : List[str]
+        Command to run, from the repository root.
+
+    deps : Sequence[str]
+        Stages that must finish before this one.
+
+    inputs : Sequence[str]
+        Files or directories whose contents the stage depends on, besides
+        the outputs of its dependencies (scripts, references, FASTQs...).
+
+    outputs : Sequence[str]
+        Files or directories that must exist once the stage has finished.
+
+    clean : Sequence[str]
+        Glob patterns of partial results removed before the stage runs.
+
+    params : Optional[dict]
+        Parameters that change the results but are not part of the command.
+
+    cpus, memory : int
+        CPUs and memory (GiB) the stage needs.
+
+    log : Optional[str]
+        File the output of the command is written to.
+    """
+
+    def __init__(self, name: str, command: List[str],
+                 deps: Sequence[str] = (), inputs: Sequence[str] = (),
+                 outputs: Sequence[str] = (), clean: Sequence[str] = (),
+                 params: Optional[dict] = None, cpus: int = 1,
+                 memory: int = 0, log: Optional[str] = None) -> None:
+        self.name = name
+        self.command = command
+        self.deps = list(deps)
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.clean = list(clean)
+        self.params = params or {}
+        self.cpus = cpus
+        self.memory = memory
+        self.log = log
+
+class HashCache:
+    """
+    SHA-256 of file contents, cached by path, size and modification time so
+    unchanged files (FASTQs, BAMs) are not read again on every run.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        try:
+            with open(path) as cache:
+                self.entries = json.load(cache)
+        except (OSError, ValueError):
+            self.entries = {}
+
+    def file(self, path: str) -> str:
+        path = os.path.realpath(path)
+        stat = os.stat(path)
+        entry = self.entries.get(path)
+        if entry and entry['size'] == stat.st_size and \
+                entry['mtime_ns'] == stat.st_mtime_ns:
+            return entry['sha256']
+
+        digest = hashlib.sha256()
+        with open(path, 'rb') as handle:
+            for chunk in iter(lambda: handle.read(CHUNK_SIZE), b''):
+                digest.update(chunk)
+        self.entries[path] = {'size': stat.st_size,
+                              'mtime_ns': stat.st_mtime_ns,
+                              'sha256': digest.hexdigest()}
+        return digest.hexdigest()
+
+    def path_hash(self, path: str) -> str:
+        """
+        Hash of a file, of the relative names and contents of every file
+        under a directory, or of every file matching a glob pattern. Hidden
+        files and folders under a directory (caches such as the record sets
+        of vcf_cache.py) are left out. Missing paths hash to a fixed value.
+        """
+        if os.path.isfile(path):
+            return self.file(path)
+        digest = hashlib.sha256()
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs[:] = sorted(name for name in dirs
+                                 if not name.startswith('.'))
+                for name in sorted(files):
+                    if name.startswith('.'):
+                        continue
+                    full = os.path.join(root, name)
+                    digest.update(os.path.relpath(full, path).encode())
+                    digest.update(self.file(full).encode())
+        elif is_pattern(path):
+            for full in sorted(glob.glob(path)):
+                digest.update(os.path.basename(full).encode())
+                digest.update(self.path_hash(full).encode())
+        else:
+            digest.update(b'missing')
+        return digest.hexdigest()
+
+    def save(self) -> None:
+        write_json(self.path, self.entries)
+
+def is_pattern(path: str) -> bool:
+    return any(char in path for char in '*?[')
+
+def exists(path: str) -> bool:
+    """
+    Whether a path, or at least one match of a glob pattern, exists.
+    """
+    return bool(glob.glob(path)) if is_pattern(path) else \
+        os.path.exists(path)
+
+def write_json(path: str, data: dict) -> None:
+    """
+    Writes a JSON file atomically, so an interrupted run never leaves a
+    truncated marker or cache behind.
+    """
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, 'w') as output:
+        json.dump(data, output, indent=1, sort_keys=True)
+        output.flush()
+        os.fsync(output.fileno())
+    os.replace(tmp, path)
+
+def fingerprint(stage: Stage, hashes: HashCache,
+                by_name: Dict[str, Stage]) -> str:
+    """
+    Hash of everything a stage's results depend on: its command, parameters,
+    inputs and the outputs of the stages it depends on. Hashing upstream
+    outputs rather than upstream fingerprints means a rerun that reproduces
+    the same results does not invalidate the stages after it.
+    """
+    digest = hashlib.sha256()
+    digest.update(json.dumps([stage.command, stage.params],
+                             sort_keys=True).encode())
+    paths = stage.inputs + [path for dep in stage.deps
+                            for path in by_name[dep].outputs]
+    for path in paths:
+        digest.update(path.encode())
+        digest.update(hashes.path_hash(path).encode())
+    return digest.hexdigest()
+
+def marker_path(state_dir: str, stage: Stage) -> str:
+    return os.path.join(state_dir, f"{stage.name}.done")
+
+def is_done(state_dir: str, stage: Stage, current: str) -> bool:
+    """
+    A stage is done if its marker records the current fingerprint and all
+    its outputs exist. Markers are only written once a stage has succeeded,
+    so a half-written output never counts as done.
+    """
+    try:
+        with open(marker_path(state_dir, stage)) as marker:
+            recorded = json.load(marker)
+    except (OSError, ValueError):
+        return False
+    return recorded.get('fingerprint') == current and \
+        all(exists(path) for path in stage.outputs)
+
+def topological_order(stages: Sequence[Stage]) -> List[Stage]:
+    """
+    Orders stages so every stage comes after its dependencies, raising
+    ValueError on unknown dependencies or cycles.
+    """
+    by_name = {stage.name: stage for stage in stages}
+    order, state = [], {}
+
+    def visit(stage: Stage) -> None:
+        if state.get(stage.name) == 'done':
+            return
+        if state.get(stage.name) == 'visiting':
+            raise ValueError(f"Dependency cycle at stage {stage.name}")
+        state[stage.name] = 'visiting'
+        for dep in stage.deps:
+            if dep not in by_name:
+                raise ValueError(f"Stage {stage.name} depends on unknown "
+                                 f"stage {dep}")
+            visit(by_name[dep])
+        state[stage.name] = 'done'
+        order.append(stage)
+
+    for stage in stages:
+        visit(stage)
+    return order
+
+def start(stage: Stage, state_dir: str,
+          trace_file: Optional[str] = None) -> subprocess.Popen:
+    """
+    Removes the marker and partial results of a stage and launches it. With
+    a trace file, the stage runs under tracing.py, and so do the per-sample
+    jobs it launches.
+    """
+    try:
+        os.remove(marker_path(state_dir, stage))
+    except FileNotFoundError:
+        pass
+    for pattern in stage.clean:
+        for path in glob.glob(pattern):
+            if os.path.isfile(path):
+                os.remove(path)
+
+    command, env = stage.command, None
+    if trace_file:
+        command = [sys.executable, "scripts/tracing.py", "run",
+                   "-s", stage.name, "--"] + command
+        env = dict(os.environ, CS4B_TRACE=os.path.abspath(trace_file),
+                   CS4B_PYTHON=sys.executable)
+
+    log = open(stage.log, 'w') if stage.log else subprocess.DEVNULL
+    try:
+        return subprocess.Popen(command, stdout=log, stderr=subprocess.STDOUT,
+                                env=env)
+    finally:
+        if stage.log:
+            log.close()
+
+def run(stages: Sequence[Stage], state_dir: str, cpus: int, memory: int,
+        dry_run: bool = False, trace_file: Optional[str] = None,
+        poll: float = 1.0) -> int:
+    """
+    Runs the stages that are not up to date, launching every stage as soon
+    as its dependencies have finished and it fits within the budgets.
+
+    Parameters
+    ----------
+    stages : Sequence[Stage]
+        Stages of the pipeline.
+
+    state_dir : str
+        Directory for markers and the hash cache.
+
+    cpus : int
+        CPUs available. Stages that need more run on their own.
+
+    memory : int
+        Memory available (GiB), 0 for no limit.
+
+    dry_run : bool
+        Only report which stages would run.
+
+    trace_file : Optional[str]
+        JSON-lines file the spans of every stage and per-sample job are
+        appended to (see tracing.py).
+
+    Returns
+    -------
+    int
+        Number of stages that failed or could not run because a dependency
+        failed.
+    """
+    os.makedirs(state_dir, exist_ok=True)
+    if trace_file:
+        os.makedirs(os.path.dirname(os.path.abspath(trace_file)),
+                    exist_ok=True)
+    order = topological_order(stages)
+    hashes = HashCache(os.path.join(state_dir, HASH_CACHE))
+
+    by_name = {stage.name: stage for stage in order}
+
+    # Stages downstream of a stage that has to run are pending too; their
+    # fingerprints are computed again once their dependencies have finished
+    fingerprints = {}
+    pending = []
+    for stage in order:
+        fingerprints[stage.name] = fingerprint(stage, hashes, by_name)
+        if any(dep in pending for dep in stage.deps) or \
+                not is_done(state_dir, stage, fingerprints[stage.name]):
+            pending.append(stage.name)
+    hashes.save()
+
+    if dry_run:
+        for stage in order:
+            status = "run" if stage.name in pending else "up to date"
+            logging.info(f"{stage.name}: {status}")
+        return 0
+
+    finished, failed = set(), set()
+    running = {}
+    free_cpus, free_memory = cpus, memory
+
+    for stage in order:
+        if stage.name not in pending:
+            finished.add(stage.name)
+            logging.info(f"{stage.name}: up to date")
+
+    while pending or running:
+        for name in list(pending):
+            stage = by_name[name]
+            if any(dep in failed for dep in stage.deps):
+                pending.remove(name)
+                failed.add(name)
+                logging.error(f"{name}: skipped, a dependency failed")
+                continue
+            if not all(dep in finished for dep in stage.deps):
+                continue
+
+            need_cpus = min(stage.cpus, cpus)
+            need_memory = min(stage.memory, memory)
+            if running and (need_cpus > free_cpus or
+                            (memory and need_memory > free_memory)):
+                continue
+
+            fingerprints[name] = fingerprint(stage, hashes, by_name)
+            if is_done(state_dir, stage, fingerprints[name]):
+                pending.remove(name)
+                finished.add(name)
+                logging.info(f"{name}: up to date")
+                continue
+
+            logging.info(f"{name}: started")
+            running[name] = start(stage, state_dir, trace_file)
+            pending.remove(name)
+            free_cpus -= need_cpus
+            free_memory -= need_memory
+
+        for name, process in list(running.items()):
+            if process.poll() is None:
+                continue
+            stage = by_name[name]
+            del running[name]
+            free_cpus += min(stage.cpus, cpus)
+            free_memory += min(stage.memory, memory)
+
+            missing = [path for path in stage.outputs if not exists(path)]
+            if process.returncode != 0 or missing:
+                failed.add(name)
+                reason = f"exit status {process.returncode}" \
+                    if process.returncode else f"missing {', '.join(missing)}"
+                logging.error(f"{name}: failed ({reason})")
+                continue
+
+            write_json(marker_path(state_dir, stage),
+                       {'fingerprint': fingerprints[name],
+                        'finished': time.strftime('%Y-%m-%dT%H:%M:%S')})
+            finished.add(name)
+            logging.info(f"{name}: done")
+
+        hashes.save()
+        if running:
+            time.sleep(poll)
+
+    return len(failed)
+
+def project_stages(project: str, reference: str, input_dir: str,
+                   vcf_file: str, bed_file: str,
+                   mutations: int = 100, padding: int = 0,
+                   shards: int = 1) -> List[Stage]:
+    """
+    Builds the stages of a CloneSim4Bench project, mirroring the steps of
+    main.
+
+    Parameters
+    ----------
+    project : str
+        Project directory.
+
+    reference : str
+        Reference FASTA inside the project (REFERENCE folder).
+
+    input_dir : str
+        Directory with the input FASTQs.
+
+    vcf_file : str
+        COSMIC VCF for the guided simulation.
+
+    bed_file : str
+        Probes BED for the stochastic simulation, also used to restrict the
+        compared truth sites and calls to the capture regions. Callable
+        bases (the TN denominator) are still counted over the whole BAM.
+
+    mutations : int
+        Mutations simulated per sample.
+
+    padding : int
+        Bases around the capture regions whose truth sites and calls are
+        still compared.
+
+    shards : int
+        Shards of the capture BED called in parallel per BAM by the callers
+        that support it, 1 to call every BAM at once.
+
+    Returns
+    -------
+    List[Stage]
+        Stages of the project.
+    """
+    def path(*parts: str) -> str:
+        return os.path.join(project, *parts)
+
+    stages = [Stage(
+        "pre_processing",
+        ["bash", "-c",
+         'bash scripts/data_pre_processing -r "$1" -i "$2" -o "$3" && '
+         'rm -rf "$3"/tmp "$3"/BAMs/*sorted.bam* "$3"/BAMs/*dedup.bam* '
+         '"$3"/BAMs/*recal.table',
+         "pre_processing", reference, input_dir, project],
+        inputs=["scripts/data_pre_processing", reference, input_dir],
+        outputs=[path("BAMs", "*.bam*")],
+        cpus=RESOURCES["pre_processing"][0],
+        memory=RESOURCES["pre_processing"][1],
+        log=path("Logs", "pre_processing.log"))]
+
+    for method, script, source in [("Guided", "sim_guided", vcf_file),
+                                   ("Stochastic", "sim_stochastic", bed_file)]:
+        stages.append(Stage(
+            f"sim_{method.lower()}",
+            ["bash", "-c",
+             'bash scripts/"$1" -f "$2" -i "$3" -n "$4" && '
+             'mv "$3"/BAMs_mutated/"$5"/*/*.bam* "$3"/BAMs_mutated/"$5"/',
+             "sim", script, source, project, str(mutations), method],
+            deps=["pre_processing"],
+            inputs=[f"scripts/{script}", "scripts/BED4SV.py", source],
+            outputs=[path("BAMs_mutated", method, "*.bam*")],
+            clean=[path("BAMs_mutated", method, "*.bam*")],
+            params={'mutations': mutations},
+            cpus=RESOURCES["sim"][0], memory=RESOURCES["sim"][1],
+            log=path("Logs", f"{script}.log")))
+
+    for method in METHODS:
+        for script, caller in CALLERS:
+            command = ["bash", f"scripts/{script}",
+                       "-i", path("BAMs_mutated", method),
+                       "-r", reference,
+                       "-o", path("VCFs", method, caller)]
+            inputs = [f"scripts/{script}", reference]
+            if shards > 1 and script in SHARDED_CALLERS:
+                command += ["-b", bed_file, "-s", str(shards),
+                            "-p", str(padding)]
+                inputs += ["scripts/scatter_gather.py", bed_file]
+            stages.append(Stage(
+                f"{script}_{method.lower()}",
+                command,
+                deps=[f"sim_{method.lower()}"],
+                inputs=inputs,
+                outputs=[path("VCFs", method, caller, CALLER_VCFS[script])],
+                clean=[path("VCFs", method, caller, "*.vcf*")],
+                cpus=RESOURCES[script][0], memory=RESOURCES[script][1],
+                log=path("Logs", f"{caller}_{method.lower()}.log")))
+
+    stages.append(Stage(
+        "truth_vcfs",
+        ["python3", "scripts/vcf_generator.py", "-p", project,
+         "-r", reference + ".fai", "-j", str(RESOURCES["truth_vcfs"][0])],
+        deps=[f"sim_{method.lower()}" for method in METHODS],
+        inputs=["scripts/vcf_generator.py", "scripts/bgzf.py",
+                reference + ".fai"],
+        outputs=[path("VCFs", method, "REFs", "*_all.vcf.gz")
+                 for method in METHODS],
+        cpus=RESOURCES["truth_vcfs"][0], memory=RESOURCES["truth_vcfs"][1],
+        log=path("Logs", "vcf_generator.log")))
+
+    for method in METHODS:
+        lower = method.lower()
+        general = path("Analysis", f"raw_{lower}_general_results.txt")
+        detailed = path("Analysis", f"raw_{lower}_detailed_results.txt")
+        matches = path("Analysis", f"raw_{lower}_matches.tsv")
+
+        # Raw results are merged from per-sample, per-caller shards, which
+        # are kept between runs so only changed or failed shards are redone
+        stages.append(Stage(
+            f"compare_{lower}",
+            ["bash", "scripts/vcf_compare", "-i", path("VCFs", method),
+             "-o1", general, "-o2", detailed, "-o3", matches,
+             "-T", bed_file, "-p", str(padding),
+             "-j", str(RESOURCES["compare"][0])],
+            deps=["truth_vcfs"] + [f"{script}_{lower}"
+                                   for script, _ in CALLERS],
+            inputs=["scripts/vcf_compare", "scripts/vcf_comparer.py",
+                    "scripts/vcf_cache.py", "scripts/callable_bases.py",
+                    "scripts/BED4SV.py", bed_file],
+            outputs=[general, detailed, matches],
+            clean=[general, detailed, matches],
+            cpus=RESOURCES["compare"][0], memory=RESOURCES["compare"][1],
+            log=path("Logs", f"vcf_compare_{lower}.log")))
+
+        stages.append(Stage(
+            f"matrices_{lower}",
+            ["python3", "scripts/matrix_gen.py", "-g", general,
+             "-d", detailed,
+             "-c", path("BAMs_mutated", method, "callable_bases.json"),
+             "-m", matches, "-r", path("Analysis", "report")],
+            deps=[f"compare_{lower}"],
+            inputs=["scripts/matrix_gen.py"],
+            outputs=[general.rsplit('.', 1)[0] + ".tsv",
+                     detailed.rsplit('.', 1)[0] + ".tsv",
+                     path("Analysis", "report", f"{lower}_general.tsv.gz")],
+            cpus=RESOURCES["matrices"][0], memory=RESOURCES["matrices"][1],
+            log=path("Logs", f"matrix_gen_{lower}.log")))
+
+    return stages
+
+def total_memory() -> int:
+    """
+    Returns the physical memory in GiB, or 0 if it cannot be read.
+    """
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') >> 30
+    except (ValueError, OSError, AttributeError):
+        return 0
+
+def main():
+    parser = argparse.ArgumentParser(description='pipeline')
+    parser.add_argument('-i', '--input-dir', dest='input',
+                        required=True, type=str,
+                        help='Directory containing input FASTQ files')
+    parser.add_argument('-o', '--output-dir', dest='project',
+                        required=True, type=str,
+                        help='Project directory')
+    parser.add_argument('-r', '--reference', dest='reference',
+                        required=True, type=str,
+                        help='Reference FASTA inside the project')
+    parser.add_argument('-v', '--vcf', dest='vcf',
+                        required=True, type=str,
+                        help='VCF for the guided simulation')
+    parser.add_argument('-b', '--bed', dest='bed',
+                        required=True, type=str,
+                        help='BED for the stochastic simulation')
+    parser.add_argument('-n', '--mutations', dest='mutations',
+                        required=False, type=int, default=100)
+    parser.add_argument('-p', '--padding', dest='padding',
+                        required=False, type=int, default=0,
+                        help='Bases around the capture regions whose truth '
+                             'sites and calls are still compared (default: '
+                             '0)')
+    parser.add_argument('-s', '--shards', dest='shards',
+                        required=False, type=int, default=1,
+                        help='Shards of the capture BED called in parallel '
+                             'per BAM by FreeBayes, LoFreq and Mutect2 '
+                             '(default: 1)')
+    parser.add_argument('-c', '--cpus', dest='cpus',
+                        required=False, type=int, default=os.cpu_count() or 1,
+                        help='CPU budget (default: all CPUs)')
+    parser.add_argument('-m', '--memory', dest='memory',
+                        required=False, type=int, default=total_memory(),
+                        help='Memory budget in GiB, 0 for no limit '
+                             '(default: physical memory)')
+    parser.add_argument('--dry-run', dest='dry_run', action='store_true',
+                        help='Only report which stages would run')
+    parser.add_argument('-t', '--trace', dest='trace',
+                        required=False, type=str, default=None,
+                        help='Trace file (default: Logs/trace.jsonl in the '
+                             'project)')
+    parser.add_argument('--no-trace', dest='no_trace', action='store_true',
+                        help='Do not record performance spans')
+    args = parser.parse_args()
+
+    stages = project_stages(args.project, args.reference, args.input,
+                            args.vcf, args.bed, args.mutations, args.padding,
+                            args.shards)
+    try:
+        trace_file = None if args.no_trace else \
+            args.trace or os.path.join(args.project, "Logs", TRACE_NAME)
+        failures = run(stages, os.path.join(args.project, STATE_DIR),
+                       args.cpus, args.memory, args.dry_run, trace_file)
+    except ValueError as e:
+        print(f"ERROR: {e}", file=sys.stderr)
+        sys.exit(1)
+
+    if failures:
+        print(f"ERROR: {failures} stage(s) failed, see {args.project}/Logs",
+              file=sys.stderr)
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,383 @@
+#!/usr/bin/python3
+#
+# scatter_gather.py
+# v1.1
+# Last edit 2026/10/17
+#
+# Splits a capture BED into shards balanced by target bases, so a variant
+# caller can run one job per (BAM, shard), and gathers the VCFs of the
+# shards back into a single VCF in genomic order. Shards are contiguous runs
+# of whole probes in reference order, so gathering is a streaming merge of
+# already sorted VCFs rather than a full re-sort.
+
+import argparse
+import heapq
+import itertools
+import json
+import os
+import sys
+from typing import Dict, IO, Iterator, List, Optional, Sequence, Tuple
+
+from bgzf import BGZFWriter, open_input, write_tabix
+from vcf_generator import read_contigs
+
+MANIFEST = "shards.json"
+SHARD_NAME = "shard_{:04d}.bed"
+
+def read_probes(bed_file: str, order: Optional[Dict[str, int]] = None
+                ) -> Tuple[List[Tuple[str, int, int, List[str]]], List[str]]:
+    """
+    Reads the probes of a capture BED, sorted by contig and start.
+
+    Parameters
+    ----------
+    bed_file : str
+        Path to the capture BED (or gzipped BED).
+
+    order : Optional[Dict[str, int]]
+        Rank of every contig, e.g. from the reference index. Contigs missing
+        from it are sorted last, in order of appearance.
+
+    Returns
+    -------
+    Tuple[List[Tuple[str, int, int, List[str]]], List[str]]
+        Contig, start, end and remaining columns of every probe, and the
+        contigs in the order used.
+    """
+    probes = []
+    rank = dict(order or {})
+    with open_input(bed_file) as bed:
+        for line in bed:
+            attr = line.rstrip('\n').split('\t')
+            if len(attr) < 3 or attr[0].startswith(('#', 'track', 'browser')):
+                continue
+            rank.setdefault(attr[0], len(rank))
+            probes.append((attr[0], int(attr[1]), int(attr[2]), attr[3:]))
+    probes.sort(key=lambda probe: (rank[probe[0]], probe[1], probe[2]))
+    contigs = sorted({probe[0] for probe in probes}, key=rank.__getitem__)
+    return probes, contigs
+
+def probe_clusters(probes: Sequence[Tuple[str, int, int, List[str]]]
+                   ) -> List[Tuple[int, int, int]]:
+    """
+    Groups sorted probes into clusters of overlapping probes, which must go
+    to the same shard.
+
+    Returns
+    -------
+    List[Tuple[int, int, int]]
+        First and last (exclusive) probe of every cluster and its target
+        bases, counting overlaps once.
+    """
+    clusters = []
+    first = bases = end = 0
+    for i, (contig, start, probe_end, _) in enumerate(probes):
+        if i and contig == probes[first][0] and start < end:
+            bases += max(0, probe_end - end)
+            end = max(end, probe_end)
+            continue
+        if i:
+            clusters.append((first, i, bases))
+        first, end, bases = i, probe_end, probe_end - start
+    if probes:
+        clusters.append((first, len(probes), bases))
+    return clusters
+
+def merged_intervals(probes: Sequence[Tuple[str, int, int, List[str]]],
+                     padding: int = 0) -> List[Tuple[str, int, int]]:
+    """
+    Pads sorted probes and merges the padded intervals that overlap or touch,
+    as bedtools merge does, so callers that visit every region separately
+    never see the same position twice.
+
+    Returns
+    -------
+    List[Tuple[str, int, int]]
+        Contig, start and end of every merged interval, in probe order.
+    """
+    merged = []
+    for contig, start, end, _ in probes:
+        start, end = max(0, start - padding), end + padding
+        if merged and merged[-1][0] == contig and start <= merged[-1][2]:
+            if end > merged[-1][2]:
+                merged[-1] = (contig, merged[-1][1], end)
+            continue
+        merged.append((contig, start, end))
+    return merged
+
+def balanced_cuts(weights: Sequence[int], shards: int) -> List[int]:
+    """
+    Splits a sequence of weights into contiguous runs of about the same total
+    weight: a run ends before the item whose midpoint crosses the next
+    multiple of total / shards.
+
+    Returns
+    -------
+    List[int]
+        Index where every run ends (exclusive), one per non-empty run.
+    """
+    shards = max(1, min(shards, len(weights)))
+    total = sum(weights)
+    cuts = []
+    cumulative = 0
+    for i in range(len(weights) - 1):
+        if len(cuts) == shards - 1:
+            break
+        cumulative += weights[i]
+        target = total * (len(cuts) + 1) / shards
+        # Every later run needs at least one item
+        if cumulative + weights[i + 1] / 2 >= target or \
+            len(weights) - i - 1 == shards - len(cuts) - 1:
+            cuts.append(i + 1)
+    cuts.append(len(weights))
+    return cuts
+
+def scatter(bed_file: str, shards: int, output_dir: str,
+            reference_index: Optional[str] = None,
+            padding: int = 0) -> dict:
+    """
+    Splits a capture BED into shards of about the same target bases, never
+    splitting a probe (or overlapping probes) across shards, and writes them
+    with a manifest (see MANIFEST) to a directory.
+
+    Parameters
+    ----------
+    bed_file : str
+        Path to the capture BED.
+
+    shards : int
+        Number of shards. Fewer are written if there are fewer probes.
+
+    output_dir : str
+        Directory for the shard BEDs and the manifest.
+
+    reference_index : Optional[str]
+        FASTA index (.fai) of the reference, giving the contig order of the
+        caller VCFs. The order of the BED is used if not given.
+
+    padding : int
+        Bases added around every probe in the shard BEDs, so calls near the
+        probes are kept. Padded probes that overlap or touch are merged
+        within a shard (see merged_intervals). Calls in the padding of two
+        neighbouring shards are gathered once.
+
+    Returns
+    -------
+    dict
+        The manifest: contig order, padding and, for every shard, its BED,
+        probes, merged intervals, target bases and first and last probe.
+    """
+    order = {name: i for i, (name, _) in enumerate(
+        read_contigs(reference_index))} if reference_index else None
+    probes, contigs = read_probes(bed_file, order)
+    if not probes:
+        raise ValueError(f"No probes found in {bed_file}")
+    clusters = probe_clusters(probes)
+    cuts = balanced_cuts([bases for _, _, bases in clusters], shards)
+
+    os.makedirs(output_dir, exist_ok=True)
+    manifest = {'bed': os.path.abspath(bed_file), 'padding': padding,
+                'contigs': contigs, 'shards': []}
+    first_cluster = 0
+    for number, cut in enumerate(cuts, 1):
+        first = clusters[first_cluster][0]
+        last = clusters[cut - 1][1]
+        name = SHARD_NAME.format(number)
+        tmp = os.path.join(output_dir, f"{name}.{os.getpid()}.tmp")
+        intervals = merged_intervals(probes[first:last], padding)
+        with open(tmp, 'w') as bed:
+            for contig, start, end in intervals:
+                bed.write(f"{contig}\t{start}\t{end}\n")
+        os.replace(tmp, os.path.join(output_dir, name))
+        manifest['shards'].append({
+            'bed': name, 'probes': last - first,
+            'intervals': len(intervals),
+            'bases': sum(bases for _, _, bases in
+                         clusters[first_cluster:cut]),
+            'first': list(probes[first][:3]),
+            'last': list(probes[last - 1][:3])})
+        first_cluster = cut
+
+    tmp = os.path.join(output_dir, f"{MANIFEST}.{os.getpid()}.tmp")
+    with open(tmp, 'w') as output:
+        json.dump(manifest, output, indent=1)
+    os.replace(tmp, os.path.join(output_dir, MANIFEST))
+    return manifest
+
+def read_header(handle: IO) -> Tuple[List[str], Optional[str]]:
+    """
+    Reads the header lines of a VCF, returning them along with the first
+    record (None if there is none).
+    """
+    header = []
+    for line in handle:
+        if not line.startswith('#'):
+            return header, line
+        header.append(line.rstrip('\n'))
+    return header, None
+
+def shard_records(path: str, rank: Dict[str, int]
+                  ) -> Iterator[Tuple[int, int, str]]:
+    """
+    Streams the records of a shard VCF as (contig rank, position, line),
+    checking they are sorted. Contigs missing from rank are added to it.
+    """
+    with open_input(path) as vcf:
+        _, first = read_header(vcf)
+        last = None
+        for line in itertools.chain([first] if first else [], vcf):
+            fields = line.split('\t', 2)
+            key = (rank.setdefault(fields[0], len(rank)), int(fields[1]))
+            if last is not None and key < last:
+                raise ValueError(f"{path} is not sorted at {fields[0]}:"
+                                 f"{fields[1]}")
+            last = key
+            yield key[0], key[1], line if line.endswith('\n') else line + '\n'
+
+def gather(manifest_file: str, inputs: Sequence[str], output: str) -> int:
+    """
+    Merges the VCFs of the shards of a BED (see scatter) into a single VCF
+    in genomic order. Every shard VCF must be sorted; as shards are
+    contiguous, the merge only interleaves records where the padding of two
+    shards overlaps. Records repeated by two shards (same contig, position,
+    REF and ALT) are written once.
+
+    Parameters
+    ----------
+    manifest_file : str
+        Manifest written by scatter, giving the contig order.
+
+    inputs : Sequence[str]
+        VCF (or GNU zip VCF) of every shard, with the header of the first
+        one used for the output.
+
+    output : str
+        Output VCF. If it ends in .gz, it is BGZF-compressed and indexed
+        with tabix (.tbi).
+
+    Returns
+    -------
+    int
+        Number of records written.
+    """
+    with open(manifest_file) as handle:
+        manifest = json.load(handle)
+    if len(inputs) != len(manifest['shards']):
+        raise ValueError(f"{len(inputs)} VCFs given for "
+                         f"{len(manifest['shards'])} shards")
+    rank = {name: i for i, name in enumerate(manifest['contigs'])}
+    with open_input(inputs[0]) as vcf:
+        header, _ = read_header(vcf)
+    if not header or not header[-1].startswith('#CHROM'):
+        raise ValueError(f"{inputs[0]} has no VCF header")
+
+    compress = output.endswith('.gz')
+    tmp = f"{output}.{os.getpid()}.tmp"
+    handle = BGZFWriter(tmp) if compress else open(tmp, 'wb')
+    closed = False
+    contigs = []
+    index = {}
+    written = 0
+    try:
+        handle.write(("\n".join(header) + "\n").encode())
+        position = None
+        alleles = set()
+        for contig_rank, pos, line in heapq.merge(
+                *(shard_records(path, rank) for path in inputs)):
+            fields = line.split('\t', 5)
+            if (contig_rank, pos) != position:
+                position = (contig_rank, pos)
+                alleles = set()
+            if (fields[3], fields[4]) in alleles:
+                continue
+            alleles.add((fields[3], fields[4]))
+
+            if compress:
+                if fields[0] not in index:
+                    contigs.append(fields[0])
+                    index[fields[0]] = []
+                start = handle.tell()
+                handle.write(line.encode())
+                index[fields[0]].append((pos - 1, pos - 1 + len(fields[3]),
+                                         start, handle.tell()))
+            else:
+                handle.write(line.encode())
+            written += 1
+        handle.close()
+        closed = True
+        if compress:
+            write_tabix(tmp + ".tbi", contigs, index)
+            os.replace(tmp + ".tbi", output + ".tbi")
+        os.replace(tmp, output)
+    except BaseException:
+        if not closed:
+            handle.close()
+        for path in (tmp, tmp + ".tbi"):
+            if os.path.exists(path):
+                os.remove(path)
+        raise
+    return written
+
+def main():
+    parser = argparse.ArgumentParser(description='scatter_gather')
+    commands = parser.add_subparsers(dest='command')
+
+    scatter_parser = commands.add_parser(
+        'scatter', help='Split a capture BED into balanced shards')
+    scatter_parser.add_argument('-b', '--bed', dest='bed',
+                                required=True, type=str)
+    scatter_parser.add_argument('-n', '--shards', dest='shards',
+                                required=True, type=int)
+    scatter_parser.add_argument('-o', '--output-dir', dest='output',
+                                required=True, type=str,
+                                help=f'Directory for the shard BEDs and '
+                                     f'{MANIFEST}')
+    scatter_parser.add_argument('-r', '--reference-index',
+                                dest='reference_index',
+                                required=False, type=str, default=None,
+                                help='FASTA index (.fai) giving contig order')
+    scatter_parser.add_argument('-p', '--padding', dest='padding',
+                                required=False, type=int, default=0,
+                                help='Bases added around every probe')
+
+    gather_parser = commands.add_parser(
+        'gather', help='Merge the VCFs of the shards in genomic order')
+    gather_parser.add_argument('-m', '--manifest', dest='manifest',
+                               required=True, type=str,
+                               help=f'{MANIFEST} written by scatter')
+    gather_parser.add_argument('-i', '--inputs', dest='inputs',
+                               required=True, type=str, nargs='+',
+                               help='VCF of every shard, in shard order')
+    gather_parser.add_argument('-o', '--output', dest='output',
+                               required=True, type=str,
+                               help='Output VCF (.vcf.gz for BGZF and tabix)')
+    args = parser.parse_args()
+
+    if args.command == 'scatter':
+        if args.shards < 1:
+            parser.error("--shards must be at least 1")
+        try:
+            manifest = scatter(args.bed, args.shards, args.output,
+                               args.reference_index, args.padding)
+        except (OSError, ValueError) as e:
+            print(f"ERROR: Failed to scatter {args.bed}: {e}",
+                  file=sys.stderr)
+            sys.exit(1)
+        for shard in manifest['shards']:
+            print(f"{os.path.join(args.output, shard['bed'])}\t"
+                  f"{shard['probes']}\t{shard['bases']}")
+
+    elif args.command == 'gather':
+        try:
+            gather(args.manifest, args.inputs, args.output)
+        except (OSError, ValueError, KeyError) as e:
+            print(f"ERROR: Failed to gather {args.output}: {e}",
+                  file=sys.stderr)
+            sys.exit(1)
+
+    else:
+        parser.print_help()
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,253 @@
+#!/usr/bin/python3
+#
+# tracing.py
+# v1.0
+# Last edit 2026/10/17
+#
+# Records a span (wall time, CPU time, peak RSS and I/O) for every stage and
+# per-sample job of the pipeline as JSON lines, and summarises the slowest
+# stages and samples. Tracing is enabled by setting CS4B_TRACE to the trace
+# file (pipeline.py uses <project>/Logs/trace.jsonl); otherwise commands run
+# untouched.
+
+import argparse
+import json
+import os
+import resource
+import socket
+import subprocess
+import sys
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional
+
+TRACE_ENV = "CS4B_TRACE"
+TRACE_NAME = "trace.jsonl"
+
+def read_io() -> Dict[str, int]:
+    """
+    Returns the I/O counters of this process, including those of the
+    children it has waited for, or zeros where /proc is not available.
+    """
+    counters = {'rchar': 0, 'wchar': 0, 'read_bytes': 0, 'write_bytes': 0}
+    try:
+        with open('/proc/self/io') as io:
+            for line in io:
+                key, value = line.split(':')
+                if key in counters:
+                    counters[key] = int(value)
+    except OSError:
+        pass
+    return counters
+
+def snapshot(who: int) -> Dict[str, float]:
+    """
+    Takes the resource usage (resource.RUSAGE_SELF or RUSAGE_CHILDREN) and
+    I/O counters a span is measured against.
+    """
+    usage = resource.getrusage(who)
+    return dict(read_io(), wall=time.time(), user=usage.ru_utime,
+                sys=usage.ru_stime, maxrss=usage.ru_maxrss)
+
+def write_span(trace_file: str, span: dict) -> None:
+    """
+    Appends a span to a trace file. Every span is written with a single
+    O_APPEND write, so concurrent jobs never interleave their lines.
+    """
+    line = (json.dumps(span, sort_keys=True) + "\n").encode()
+    fd = os.open(trace_file, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, line)
+    finally:
+        os.close(fd)
+
+def make_span(stage: str, sample: Optional[str], before: Dict[str, float],
+              after: Dict[str, float], status: int) -> dict:
+    """
+    Builds a span from the snapshots taken before and after a job.
+    """
+    return {
+        'stage': stage,
+        'sample': sample,
+        'start': round(before['wall'], 3),
+        'wall_s': round(after['wall'] - before['wall'], 3),
+        'user_s': round(after['user'] - before['user'], 3),
+        'sys_s': round(after['sys'] - before['sys'], 3),
+        'cpu_s': round(after['user'] + after['sys'] -
+                       before['user'] - before['sys'], 3),
+        'peak_rss_kb': after['maxrss'],
+        'read_bytes': after['read_bytes'] - before['read_bytes'],
+        'write_bytes': after['write_bytes'] - before['write_bytes'],
+        'read_chars': after['rchar'] - before['rchar'],
+        'write_chars': after['wchar'] - before['wchar'],
+        'status': status,
+        'host': socket.gethostname(),
+        'pid': os.getpid()
+    }
+
+@contextmanager
+def span(stage: str, sample: Optional[str] = None,
+         trace_file: Optional[str] = None) -> Iterator[None]:
+    """
+    Records a span for the code run inside it, for per-sample jobs of the
+    Python scripts. Does nothing unless a trace file is given or set in
+    CS4B_TRACE.
+
+    Peak RSS is that of the whole process so far, as the kernel does not
+    track it per span; CPU time and I/O are those of the span.
+    """
+    trace_file = trace_file or os.environ.get(TRACE_ENV)
+    if not trace_file:
+        yield
+        return
+
+    before = snapshot(resource.RUSAGE_SELF)
+    status = 1
+    try:
+        yield
+        status = 0
+    finally:
+        write_span(trace_file, make_span(stage, sample, before,
+                                         snapshot(resource.RUSAGE_SELF),
+                                         status))
+
+def run_traced(command: List[str], stage: str, sample: Optional[str] = None,
+               trace_file: Optional[str] = None) -> int:
+    """
+    Runs a command and records its span. Resources are those of the command
+    and every process it waited for, and peak RSS is that of the largest
+    of them. Without a trace file the command simply replaces this process.
+
+    Returns
+    -------
+    int
+        Exit status of the command.
+    """
+    trace_file = trace_file or os.environ.get(TRACE_ENV)
+    if not trace_file:
+        os.execvp(command[0], command)
+
+    before = snapshot(resource.RUSAGE_CHILDREN)
+    try:
+        status = subprocess.call(command)
+    except OSError as e:
+        print(f"ERROR: Failed to run {command[0]}: {e}", file=sys.stderr)
+        status = 127
+    write_span(trace_file, make_span(stage, sample, before,
+                                     snapshot(resource.RUSAGE_CHILDREN),
+                                     status))
+    return status
+
+def read_spans(trace_file: str) -> List[dict]:
+    """
+    Reads the spans of a trace file, skipping truncated lines.
+    """
+    spans = []
+    with open(trace_file) as trace:
+        for line in trace:
+            try:
+                spans.append(json.loads(line))
+            except ValueError:
+                continue
+    return spans
+
+def summary(spans: List[dict], top: int = 10) -> List[str]:
+    """
+    Formats the slowest stages (all their spans added up) and the slowest
+    per-sample jobs as tab-separated tables.
+
+    Parameters
+    ----------
+    spans : List[dict]
+        Spans as read by read_spans.
+
+    top : int
+        Number of rows of every table.
+
+    Returns
+    -------
+    List[str]
+        Lines of the summary.
+    """
+    stages = {}
+    for entry in spans:
+        total = stages.setdefault(entry['stage'], {
+            'jobs': 0, 'wall_s': 0.0, 'max_wall_s': 0.0, 'cpu_s': 0.0,
+            'peak_rss_kb': 0, 'read_bytes': 0, 'write_bytes': 0,
+            'failed': 0})
+        total['jobs'] += 1
+        total['wall_s'] += entry['wall_s']
+        total['max_wall_s'] = max(total['max_wall_s'], entry['wall_s'])
+        total['cpu_s'] += entry['cpu_s']
+        total['peak_rss_kb'] = max(total['peak_rss_kb'], entry['peak_rss_kb'])
+        total['read_bytes'] += entry['read_bytes']
+        total['write_bytes'] += entry['write_bytes']
+        total['failed'] += entry['status'] != 0
+
+    columns = ['jobs', 'wall_s', 'max_wall_s', 'cpu_s', 'peak_rss_kb',
+               'read_bytes', 'write_bytes', 'failed']
+    lines = ["Slowest stages",
+             "\t".join(["Stage"] + columns)]
+    for name, total in sorted(stages.items(), key=lambda item:
+                              -item[1]['wall_s'])[:top]:
+        lines.append("\t".join([name] + [str(round(total[column], 3))
+                                         for column in columns]))
+
+    columns = ['wall_s', 'cpu_s', 'peak_rss_kb', 'read_bytes',
+               'write_bytes', 'status']
+    lines += ["", "Slowest samples",
+              "\t".join(["Stage", "Sample"] + columns)]
+    samples = [entry for entry in spans if entry.get('sample')]
+    for entry in sorted(samples, key=lambda entry: -entry['wall_s'])[:top]:
+        lines.append("\t".join([entry['stage'], entry['sample']] +
+                               [str(entry[column]) for column in columns]))
+    return lines
+
+def main():
+    parser = argparse.ArgumentParser(description='tracing')
+    commands = parser.add_subparsers(dest='command')
+
+    run_parser = commands.add_parser('run', help='Run a command and record '
+                                                 'its span')
+    run_parser.add_argument('-s', '--stage', dest='stage',
+                            required=True, type=str)
+    run_parser.add_argument('-S', '--sample', dest='sample',
+                            required=False, type=str, default=None)
+    run_parser.add_argument('-t', '--trace', dest='trace',
+                            required=False, type=str, default=None,
+                            help=f'Trace file (default: ${TRACE_ENV})')
+    run_parser.add_argument('cmd', nargs=argparse.REMAINDER,
+                            help='Command to run, after --')
+
+    summary_parser = commands.add_parser('summary', help='List the slowest '
+                                                         'stages and samples')
+    summary_parser.add_argument('-t', '--trace', dest='trace',
+                                required=False, type=str, default=None,
+                                help=f'Trace file (default: ${TRACE_ENV})')
+    summary_parser.add_argument('-n', '--top', dest='top',
+                                required=False, type=int, default=10)
+    args = parser.parse_args()
+
+    if args.command == 'run':
+        command = args.cmd[1:] if args.cmd[:1] == ['--'] else args.cmd
+        if not command:
+            parser.error("run needs a command")
+        sys.exit(run_traced(command, args.stage, args.sample, args.trace))
+
+    elif args.command == 'summary':
+        trace_file = args.trace or os.environ.get(TRACE_ENV)
+        if not trace_file:
+            parser.error(f"summary needs -t or ${TRACE_ENV}")
+        try:
+            spans = read_spans(trace_file)
+        except OSError as e:
+            print(f"ERROR: Failed to read {trace_file}: {e}", file=sys.stderr)
+            sys.exit(1)
+        print("\n".join(summary(spans, args.top)))
+
+    else:
+        parser.print_help()
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,27 @@
+#!/usr/bin/bash
+# tracing.sh
+#
+# Last Edit: 2026/10/17
+# By: Alex Fernando Arita
+# Version 1.0
+#
+# Sourced by the simulation and variant calling scripts to record a span for
+# every per-sample job (see scripts/tracing.py). Commands run untouched unless
+# CS4B_TRACE is set, as pipeline.py does. CS4B_PYTHON points to the Python of
+# the tools environment, so tracing keeps working after other environments
+# (e.g. strelka2, with Python 2) are activated.
+
+# Usage: traced <stage> <sample> <command> [args...]
+traced() {
+    local stage="$1"
+    local sample="$2"
+    shift 2
+    if [ -n "$CS4B_TRACE" ]; then
+        "${CS4B_PYTHON:-python3}" scripts/tracing.py run \
+            -s "$stage" -S "$sample" -- "$@"
+    else
+        "$@"
+    fi
+}
+
+export -f traced
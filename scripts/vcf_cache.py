@@ -0,0 +1,411 @@
+#!/usr/bin/python3
+#
+# vcf_cache.py
+# v1.0
+# Last edit 2026/10/17
+#
+# Parses the VCF of a variant caller once into a compact binary record set
+# (contig, position, REF, ALT, caller-reported AF and DP, FILTER), with the
+# AF and DP of every caller normalised from its own fields. Record sets are
+# keyed by the content hash of the VCF and memory-mapped by later readers,
+# so repeated comparisons never decompress and parse the VCF text again.
+
+import argparse
+import array
+import gzip
+import hashlib
+import json
+import math
+import mmap
+import os
+import struct
+import sys
+from typing import Any, Callable, Dict, Iterator, Optional, Tuple
+
+# Record sets are kept in this folder next to the VCFs
+CACHE_DIR = ".calls"
+CACHE_SUFFIX = ".calls"
+CACHE_MAGIC = b'CS4BCAL1'
+CACHE_HEADER = struct.Struct('<8s32sQIQQ')
+# Content hash of every VCF, kept with its size and modification time
+DIGEST_SUFFIX = ".sha256"
+
+MISSING_DP = -1
+
+def content_hash(path: str) -> bytes:
+    """
+    Returns the SHA-256 digest of the contents of a file.
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as handle:
+        for chunk in iter(lambda: handle.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.digest()
+
+def file_digest(path: str, cache_dir: Optional[str] = None) -> bytes:
+    """
+    Returns the SHA-256 digest of a VCF, cached next to its record sets by
+    size and modification time (as pipeline.HashCache does), so an unchanged
+    VCF is not read again on every open.
+    """
+    cache_dir = cache_dir or os.path.join(os.path.dirname(path), CACHE_DIR)
+    digest_file = os.path.join(cache_dir,
+                               os.path.basename(path) + DIGEST_SUFFIX)
+    stat = os.stat(path)
+    try:
+        with open(digest_file) as handle:
+            entry = json.load(handle)
+        if entry['size'] == stat.st_size and \
+                entry['mtime_ns'] == stat.st_mtime_ns:
+            return bytes.fromhex(entry['sha256'])
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+
+    digest = content_hash(path)
+    tmp = f"{digest_file}.{os.getpid()}.tmp"
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        with open(tmp, 'w') as handle:
+            json.dump({'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns,
+                       'sha256': digest.hex()}, handle)
+        os.replace(tmp, digest_file)
+    except OSError:
+        pass
+    return digest
+
+def to_float(value: Optional[str]) -> float:
+    """
+    Parses a VCF number (the first one of a list), NaN if missing.
+    """
+    if value is None:
+        return math.nan
+    value = value.split(',')[0].rstrip('%')
+    try:
+        return float(value)
+    except ValueError:
+        return math.nan
+
+def to_depth(value: Optional[str]) -> int:
+    """
+    Parses a VCF depth, MISSING_DP if missing.
+    """
+    number = to_float(value)
+    return MISSING_DP if math.isnan(number) else int(number)
+
+def ratio(numerator: float, denominator: float) -> float:
+    return numerator / denominator if denominator > 0 else math.nan
+
+def freebayes_values(info: Dict[str, str], sample: Dict[str, str],
+                     ref: str, alt: str) -> Tuple[float, int]:
+    """
+    FreeBayes: AF is the alternate over total observations (AO / DP), as
+    its own AF field is the allele frequency of the genotype.
+    """
+    depth = to_depth(sample.get('DP', info.get('DP')))
+    return ratio(to_float(sample.get('AO', info.get('AO'))), depth), depth
+
+def lofreq_values(info: Dict[str, str], sample: Dict[str, str],
+                  ref: str, alt: str) -> Tuple[float, int]:
+    """
+    LoFreq: AF and DP in INFO.
+    """
+    return to_float(info.get('AF')), to_depth(info.get('DP'))
+
+def mutect2_values(info: Dict[str, str], sample: Dict[str, str],
+                   ref: str, alt: str) -> Tuple[float, int]:
+    """
+    Mutect2: AF and DP of the (tumour) sample.
+    """
+    return to_float(sample.get('AF')), \
+        to_depth(sample.get('DP', info.get('DP')))
+
+def strelka2_values(info: Dict[str, str], sample: Dict[str, str],
+                    ref: str, alt: str) -> Tuple[float, int]:
+    """
+    Strelka2: tier 1 allele counts (AU, CU, GU, TU) of somatic SNVs, or
+    allele depths (AD) of germline calls.
+    """
+    depth = to_depth(sample.get('DP', info.get('DP')))
+    tier_ref, tier_alt = sample.get(f"{ref[:1]}U"), sample.get(f"{alt[:1]}U")
+    if tier_ref is not None and tier_alt is not None:
+        ref_count, alt_count = to_float(tier_ref), to_float(tier_alt)
+        return ratio(alt_count, ref_count + alt_count), depth
+    counts = [to_float(count) for count in sample.get('AD', '').split(',')]
+    if len(counts) > 1:
+        return ratio(counts[1], sum(counts)), depth
+    return math.nan, depth
+
+def varscan2_values(info: Dict[str, str], sample: Dict[str, str],
+                    ref: str, alt: str) -> Tuple[float, int]:
+    """
+    VarScan2: FREQ as a percentage of the sample.
+    """
+    return to_float(sample.get('FREQ')) / 100, \
+        to_depth(sample.get('DP', sample.get('SDP')))
+
+def generic_values(info: Dict[str, str], sample: Dict[str, str],
+                   ref: str, alt: str) -> Tuple[float, int]:
+    """
+    Any other caller: AF and DP of the sample, or else of INFO.
+    """
+    return to_float(sample.get('AF', info.get('AF'))), \
+        to_depth(sample.get('DP', info.get('DP')))
+
+NORMALISERS = {
+    "FreeBayes": freebayes_values,
+    "LoFreq": lofreq_values,
+    "Mutect2": mutect2_values,
+    "Strelka2": strelka2_values,
+    "VarScan2": varscan2_values
+}
+
+def parse_record(line: str, values: Callable) -> Tuple[str, int, str, str,
+                                                         float, int, str]:
+    """
+    Parses a VCF record into its contig, position, REF, ALT, normalised AF
+    and DP, and FILTER. Only the first sample is read.
+    """
+    fields = line.rstrip('\n').split('\t')
+    fields += ['.'] * (10 - len(fields))
+    info = dict(entry.split('=', 1) if '=' in entry else (entry, '')
+                for entry in fields[7].split(';'))
+    sample = dict(zip(fields[8].split(':'), fields[9].split(':')))
+    af, dp = values(info, sample, fields[3], fields[4])
+    return fields[0], int(fields[1]), fields[3], fields[4], af, dp, fields[6]
+
+def _padding(size: int) -> bytes:
+    return b'\x00' * (-size % 8)
+
+class CallSet:
+    """
+    Records of a caller VCF read from a record set: a table of names
+    (contigs and FILTER values), then one column per field (contig code,
+    FILTER code, position, AF as float32, DP as int32) and the REF and ALT
+    of every record in a single blob, addressed by 2 * records + 1 offsets.
+    """
+
+    def __init__(self, buffer: Any) -> None:
+        self.buffer = buffer
+        view = memoryview(buffer)
+        _, self.digest, count, n_names, names_size, alleles_size = \
+            CACHE_HEADER.unpack_from(view)
+        position = CACHE_HEADER.size
+        names = bytes(view[position:position + names_size])
+        self.names = [name.decode() for name in names.split(b'\x00')[:-1]]
+        position += names_size + len(_padding(names_size))
+
+        columns = []
+        for typecode, length in (('I', count), ('I', count), ('q', count),
+                                 ('f', count), ('i', count),
+                                 ('Q', 2 * count + 1)):
+            size = length * array.array(typecode).itemsize
+            column = view[position:position + size]
+            if sys.byteorder == 'big':
+                column = array.array(typecode, bytes(column))
+                column.byteswap()
+            else:
+                column = column.cast(typecode)
+            columns.append(column)
+            position += size + len(_padding(size))
+        self.contigs, self.filters, self.positions, self.af, self.dp, \
+            self.allele_offsets = columns
+        self.alleles = view[position:position + alleles_size]
+
+    def __len__(self) -> int:
+        return len(self.positions)
+
+    def sites(self) -> Iterator[Tuple[str, int, float, int]]:
+        """
+        Yields the contig, position, AF and DP of every record, in file
+        order.
+        """
+        names = self.names
+        for code, position, af, dp in zip(self.contigs, self.positions,
+                                          self.af, self.dp):
+            yield names[code], position, af, dp
+
+    def record(self, i: int) -> Tuple[str, int, str, str, float, int, str]:
+        """
+        Returns a record as parse_record does.
+        """
+        offsets = self.allele_offsets
+        ref = bytes(self.alleles[offsets[2 * i]:offsets[2 * i + 1]])
+        alt = bytes(self.alleles[offsets[2 * i + 1]:offsets[2 * i + 2]])
+        return (self.names[self.contigs[i]], self.positions[i],
+                ref.decode(), alt.decode(), self.af[i], self.dp[i],
+                self.names[self.filters[i]])
+
+def encode_calls(path: str, caller: Optional[str], digest: bytes) -> bytes:
+    """
+    Parses a caller VCF into the layout read by CallSet.
+    """
+    values = NORMALISERS.get(caller, generic_values)
+    codes = {}
+    contigs, filters = array.array('I'), array.array('I')
+    positions = array.array('q')
+    afs, dps = array.array('f'), array.array('i')
+    offsets = array.array('Q', [0])
+    alleles = bytearray()
+
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rt') as vcf:
+        for line in vcf:
+            if line.startswith('#'):
+                continue
+            contig, position, ref, alt, af, dp, status = \
+                parse_record(line, values)
+            contigs.append(codes.setdefault(contig, len(codes)))
+            filters.append(codes.setdefault(status, len(codes)))
+            positions.append(position)
+            afs.append(af)
+            dps.append(dp)
+            alleles += ref.encode()
+            offsets.append(len(alleles))
+            alleles += alt.encode()
+            offsets.append(len(alleles))
+
+    names = b''.join(name.encode() + b'\x00' for name in codes)
+    out = bytearray(CACHE_HEADER.pack(CACHE_MAGIC, digest, len(positions),
+                                      len(codes), len(names), len(alleles)))
+    out += names + _padding(len(names))
+    for column in (contigs, filters, positions, afs, dps, offsets):
+        if sys.byteorder == 'big':
+            column.byteswap()
+        data = column.tobytes()
+        out += data + _padding(len(data))
+    out += alleles
+    return bytes(out)
+
+def cache_path(path: str, caller: Optional[str], digest: bytes,
+               cache_dir: Optional[str] = None) -> str:
+    """
+    Returns where the record set of a VCF is kept:
+    <cache_dir>/<VCF name>.<caller>.<content hash>.calls.
+    """
+    cache_dir = cache_dir or os.path.join(os.path.dirname(path), CACHE_DIR)
+    return os.path.join(cache_dir, f"{os.path.basename(path)}."
+                                   f"{caller or 'generic'}.{digest.hex()}"
+                                   f"{CACHE_SUFFIX}")
+
+def load_calls(cache_file: str, digest: bytes) -> Optional[CallSet]:
+    """
+    Memory-maps a record set.
+
+    Returns
+    -------
+    Optional[CallSet]
+        Records of the VCF, or None if the record set is missing or was
+        built from other contents.
+    """
+    try:
+        with open(cache_file, 'rb') as handle:
+            magic, stored = CACHE_HEADER.unpack(
+                handle.read(CACHE_HEADER.size))[:2]
+            if magic != CACHE_MAGIC or stored != digest:
+                return None
+            mapped = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+        return CallSet(mapped)
+    except (OSError, ValueError, TypeError, struct.error):
+        return None
+
+def build_calls(path: str, caller: Optional[str], digest: bytes,
+                cache_file: str) -> CallSet:
+    """
+    Parses a caller VCF and stores its record set, replacing the record sets
+    of previous contents of the same VCF.
+
+    Returns
+    -------
+    CallSet
+        Records of the VCF, kept in memory if the record set cannot be
+        written.
+    """
+    data = encode_calls(path, caller, digest)
+    stem = cache_file[:-len(CACHE_SUFFIX)].rsplit('.', 1)[0] + '.'
+    tmp = f"{cache_file}.{os.getpid()}.tmp"
+    try:
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        with open(tmp, 'wb') as handle:
+            handle.write(data)
+        os.replace(tmp, cache_file)
+        for name in os.listdir(os.path.dirname(cache_file)):
+            other = os.path.join(os.path.dirname(cache_file), name)
+            if other.startswith(stem) and other.endswith(CACHE_SUFFIX) and \
+                other != cache_file:
+                os.remove(other)
+    except OSError as e:
+        print(f"WARNING: Failed to write the record set {cache_file}: {e}",
+              file=sys.stderr)
+    return CallSet(data)
+
+def open_calls(path: str, caller: Optional[str] = None,
+               cache_dir: Optional[str] = None) -> CallSet:
+    """
+    Loads the record set of a caller VCF, parsing the VCF only if its
+    contents have changed. The VCF is only hashed again if its size or
+    modification time have changed (see file_digest).
+
+    Parameters
+    ----------
+    path : str
+        VCF (or GNU zip VCF) from a variant caller.
+
+    caller : Optional[str]
+        Caller name (see NORMALISERS), which selects the fields AF and DP are
+        read from.
+
+    cache_dir : Optional[str]
+        Folder of the record sets (default: .calls next to the VCF).
+
+    Returns
+    -------
+    CallSet
+        Records of the VCF.
+    """
+    digest = file_digest(path, cache_dir)
+    cache_file = cache_path(path, caller, digest, cache_dir)
+    calls = load_calls(cache_file, digest)
+    if calls is None:
+        calls = build_calls(path, caller, digest, cache_file)
+    return calls
+
+def main():
+    parser = argparse.ArgumentParser(description='vcf_cache')
+    parser.add_argument('-i', '--input', dest='input',
+                        required=True, type=str, nargs='+',
+                        help='Caller VCFs')
+    parser.add_argument('-c', '--caller', dest='caller',
+                        required=False, type=str, default=None,
+                        choices=list(NORMALISERS),
+                        help='Caller of the VCFs (default: the name of '
+                             'their folder, if known)')
+    parser.add_argument('-d', '--cache-dir', dest='cache_dir',
+                        required=False, type=str, default=None,
+                        help=f'Folder of the record sets (default: '
+                             f'{CACHE_DIR} next to every VCF)')
+    parser.add_argument('-p', '--print', dest='show',
+                        required=False, action='store_true',
+                        help='Print the normalised records')
+    args = parser.parse_args()
+
+    for path in args.input:
+        caller = args.caller or os.path.basename(
+            os.path.dirname(os.path.abspath(path)))
+        if caller not in NORMALISERS:
+            caller = None
+        try:
+            calls = open_calls(path, caller, args.cache_dir)
+        except (OSError, ValueError, IndexError) as e:
+            print(f"ERROR: Failed to read {path}: {e}", file=sys.stderr)
+            sys.exit(1)
+        if not args.show:
+            print(f"{path}\t{caller or 'generic'}\t{len(calls)}")
+            continue
+        for i in range(len(calls)):
+            contig, position, ref, alt, af, dp, status = calls.record(i)
+            print(f"{contig}\t{position}\t{ref}\t{alt}\t"
+                  f"{'NA' if math.isnan(af) else round(af, 4)}\t"
+                  f"{'NA' if dp == MISSING_DP else dp}\t{status}")
+
+if __name__ == "__main__":
+    main()
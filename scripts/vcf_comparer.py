@@ -0,0 +1,618 @@
+#!/usr/bin/python3
+#
+# vcf_comparer.py
+# v1.5
+# Last edit 2026/10/17
+#
+# Compares the truth set of a sample against every caller VCF in a single
+# pass per caller, replacing the vcf-compare runs of vcf_compare. Results are
+# written in the same format vcf-compare produced, so matrix_gen.py reads
+# them unchanged. Given the capture BED, truth sites and calls off the capture
+# regions are both left out, and the off-target calls are counted on OT lines
+# of the general results.
+# With a shard directory, every (sample, caller) pair is compared as a
+# separate shard on a pool of workers and the shards are merged in a fixed
+# order. Caller VCFs are read through their cached record sets (see
+# vcf_cache.py).
+
+import argparse
+import glob
+import gzip
+import json
+import logging
+import math
+import multiprocessing
+import os
+import shutil
+import sys
+from typing import Dict, IO, Iterator, List, Optional, Tuple
+
+from BED4SV import ProbeIndex, open_probe_index
+from tracing import span
+from vcf_cache import MISSING_DP, open_calls
+
+logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+
+VCS = ["FreeBayes", "LoFreq", "Mutect2", "Strelka2", "VarScan2"]
+
+MATCH_HEADER = ["Sample", "Caller", "Chrom", "Pos", "iAF", "AF", "DP", "Called",
+                "cAF", "cDP"]
+
+# Files of a shard directory (see compare_shards): <prefix>/callable.txt holds
+# the FL line of the sample and <prefix>/<caller>/ the results of a caller
+SHARD_FILES = {'general': "general.txt", 'detailed': "detailed.txt",
+               'matches': "matches.tsv"}
+SHARD_META = "inputs.json"
+# Bumped whenever the contents of a shard change, so older shards are redone
+SHARD_VERSION = 2
+CALLABLE_FILE = "callable.txt"
+
+# Same ranges vcf_generator.py uses to split the truth set
+AF_RANGES = [("_AF_0_to_002", 0.02), ("_AF_002_to_005", 0.05),
+             ("_AF_005_to_01", 0.1), ("_AF_01_to_1", float("inf"))]
+
+def open_vcf(input: str) -> IO:
+    """
+    Opens a VCF file, either uncompressed or compressed (.gz or bgzip).
+    """
+    if input.endswith('.gz'):
+        return gzip.open(input, 'rt')
+    return open(input, 'rt')
+
+def read_sites(input: str) -> Iterator[Tuple[str, int, str]]:
+    """
+    Reads the chromosome, position and INFO field of every record of a VCF.
+    """
+    with open_vcf(input) as vcf:
+        for line in vcf:
+            if line.startswith('#'):
+                continue
+            fields = line.split('\t', 8)
+            yield fields[0], int(fields[1]), \
+                fields[7].rstrip('\n') if len(fields) > 7 else '.'
+
+def af_range(info: str) -> Optional[int]:
+    """
+    Returns the index in AF_RANGES of a truth variant according to its input
+    allele frequency (iAF), or None if the INFO field does not carry it.
+    """
+    for entry in info.split(';'):
+        if entry.startswith('iAF='):
+            iaf = float(entry[4:])
+            for i, (_, upper) in enumerate(AF_RANGES):
+                if iaf < upper:
+                    return i
+    return None
+
+def info_values(info: str) -> Tuple[str, str, str]:
+    """
+    Returns the input allele frequency (iAF), output allele frequency (AF)
+    and output depth (DP) of a truth variant, with 'NA' for missing ones.
+    """
+    values = dict(entry.split('=', 1) for entry in info.split(';')
+                  if '=' in entry)
+    return (values.get('iAF', 'NA'), values.get('AF', 'NA'),
+            values.get('DP', 'NA'))
+
+def load_truth(truth_file: str) -> Dict[Tuple[str, int], Optional[int]]:
+    """
+    Loads a truth set generated by vcf_generator.py.
+
+    Returns
+    -------
+    Dict[Tuple[str, int], Optional[int]]
+        AF range index (see af_range) of every truth site.
+    """
+    return {(chrom, pos): af_range(info)
+            for chrom, pos, info in read_sites(truth_file)}
+
+def compare(truth: Dict[Tuple[str, int], Optional[int]],
+            caller_file: str, targets: Optional[ProbeIndex] = None,
+            padding: int = 0, caller: Optional[str] = None
+            ) -> Dict[str, object]:
+    """
+    Compares a caller VCF against a truth set by position, as vcf-compare
+    does, reading the record set of the caller VCF (see vcf_cache.py).
+    Repeated positions in the caller VCF are counted once. If capture
+    regions are given, calls outside them are skipped as they are read.
+
+    Parameters
+    ----------
+    truth : Dict[Tuple[str, int], Optional[int]]
+        Truth set as returned by load_truth.
+
+    caller_file : str
+        Sorted VCF (or GNU zip VCF) from a variant caller.
+
+    targets : Optional[ProbeIndex]
+        Capture regions the calls are restricted to. The truth set is
+        expected to be restricted to the same regions (see compare_sample).
+
+    padding : int
+        Bases around every capture region still counted as on target.
+
+    caller : Optional[str]
+        Caller name, which selects where its AF and DP are read from.
+
+    Returns
+    -------
+    Dict[str, object]
+        'TP', 'FN', 'FP' and 'called' (on-target sites in the caller VCF) for
+        the whole truth set, 'off_target' with the sites skipped, 'ranges'
+        with the [TP, FN] of every AF range and 'found' with the AF and DP
+        the caller reported for every truth site that was called.
+    """
+    ranges = [[0, 0] for _ in AF_RANGES]
+    tp = called = off_target = 0
+    found = {}
+    last = None
+    for chrom, pos, af, dp in open_calls(caller_file, caller).sites():
+        key = (chrom, pos)
+        if key == last:
+            continue
+        last = key
+        if targets is not None and \
+            not targets.in_target(chrom, pos - 1, padding):
+            off_target += 1
+            continue
+        called += 1
+        if key in truth and key not in found:
+            found[key] = (af, dp)
+            tp += 1
+            if truth[key] is not None:
+                ranges[truth[key]][0] += 1
+
+    for key, index in truth.items():
+        if index is not None:
+            ranges[index][1] += 1
+    for counts in ranges:
+        counts[1] -= counts[0]
+
+    return {'TP': tp, 'FN': len(truth) - tp, 'FP': called - tp,
+            'called': called, 'off_target': off_target, 'ranges': ranges,
+            'found': found}
+
+def venn_lines(caller: str, truth_label: str, truth_total: int,
+               caller_label: str, caller_total: int, shared: int,
+               truth_only: int, caller_only: int) -> List[str]:
+    """
+    Formats the Venn numbers of a comparison as vcf-compare prints its VN
+    lines, with the caller name in place of VN.
+    """
+    def pct(n: int, total: int) -> str:
+        return f"({100 * n / total:.1f}%)" if total else "(0.0%)"
+
+    lines = []
+    if shared:
+        lines.append(f"{caller}\t{shared}\t{truth_label} "
+                     f"{pct(shared, truth_total)}\t{caller_label} "
+                     f"{pct(shared, caller_total)}")
+    if caller_only:
+        lines.append(f"{caller}\t{caller_only}\t{caller_label} "
+                     f"{pct(caller_only, caller_total)}")
+    if truth_only:
+        lines.append(f"{caller}\t{truth_only}\t{truth_label} "
+                     f"{pct(truth_only, truth_total)}")
+    return lines
+
+def load_sample(truth_file: str, targets: Optional[ProbeIndex] = None,
+                padding: int = 0) -> Dict[str, object]:
+    """
+    Loads the truth set of a sample for compare_caller, leaving out the
+    sites off the capture regions if they are given.
+
+    Returns
+    -------
+    Dict[str, object]
+        'prefix' and 'base' of the truth set, 'truth' as returned by
+        load_truth, 'values' with the iAF, AF and DP of every truth site (see
+        info_values) and 'range_totals' with the sites of every AF range.
+    """
+    sites = list(read_sites(truth_file))
+    if targets is not None:
+        sites = [(chrom, pos, info) for chrom, pos, info in sites
+                 if targets.in_target(chrom, pos - 1, padding)]
+    truth = {(chrom, pos): af_range(info) for chrom, pos, info in sites}
+    values = {(chrom, pos): info_values(info) for chrom, pos, info in sites}
+    range_totals = [0] * len(AF_RANGES)
+    for index in truth.values():
+        if index is not None:
+            range_totals[index] += 1
+    return {'file': truth_file,
+            'prefix': os.path.basename(truth_file)[:-len("_all.vcf.gz")],
+            'base': truth_file[:-len("_all.vcf.gz")],
+            'truth': truth, 'values': values, 'range_totals': range_totals}
+
+def caller_vcf(vcf_dir: str, vc: str, prefix: str) -> Optional[str]:
+    """
+    Returns the VCF of a caller for a sample, or None if there is none.
+    """
+    # The prefix is followed by a '.', so sample S1 never picks the VCF of
+    # sample S10
+    candidates = sorted(glob.glob(os.path.join(
+        vcf_dir, vc, f"{glob.escape(prefix)}.*vcf.gz")))
+    return candidates[0] if candidates else None
+
+def compare_caller(sample: Dict[str, object], vc: str, caller_file: str,
+                   general: IO, detailed: IO, matches: Optional[IO] = None,
+                   targets: Optional[ProbeIndex] = None,
+                   padding: int = 0) -> None:
+    """
+    Compares the truth set of a sample (see load_sample) against the VCF of
+    a caller and writes its general and per-AF-range results and,
+    optionally, its match table rows.
+    """
+    truth = sample['truth']
+    result = compare(truth, caller_file, targets, padding, vc)
+
+    for line in venn_lines(vc, sample['file'], len(truth), caller_file,
+                           result['called'], result['TP'], result['FN'],
+                           result['FP']):
+        general.write(line + "\n")
+    if targets is not None:
+        general.write(f"OT\t{vc}\t{result['called']}\t"
+                      f"{result['off_target']}\n")
+
+    for (name, _), total, (tp, fn) in zip(AF_RANGES, sample['range_totals'],
+                                          result['ranges']):
+        detailed.write(name + "\n")
+        for line in venn_lines(vc, sample['base'] + name + ".vcf.gz", total,
+                               caller_file, result['called'], tp, fn,
+                               result['called'] - tp):
+            detailed.write(line + "\n")
+        detailed.write("\n")
+
+    if matches is not None:
+        found = result['found']
+        prefix = sample['prefix']
+        for (chrom, pos), (iaf, af, dp) in sample['values'].items():
+            caller_af, caller_dp = found.get((chrom, pos),
+                                             (math.nan, MISSING_DP))
+            caller_af = "NA" if math.isnan(caller_af) else \
+                f"{caller_af:.4g}"
+            caller_dp = "NA" if caller_dp == MISSING_DP else caller_dp
+            matches.write(f"{prefix}\t{vc}\t{chrom}\t{pos}\t{iaf}\t{af}\t"
+                          f"{dp}\t{int((chrom, pos) in found)}\t"
+                          f"{caller_af}\t{caller_dp}\n")
+
+def compare_sample(truth_file: str, vcf_dir: str, general: IO,
+                   detailed: IO, matches: Optional[IO] = None,
+                   targets: Optional[ProbeIndex] = None,
+                   padding: int = 0) -> None:
+    """
+    Compares the truth set of a sample against the VCF of every caller and
+    appends the general and per-AF-range results and, optionally, one row
+    per truth variant and caller to a match table.
+
+    Parameters
+    ----------
+    truth_file : str
+        Path to the <prefix>_all.vcf.gz truth set.
+
+    vcf_dir : str
+        Directory holding one subdirectory per caller (VCFs/<Method>).
+
+    general, detailed : IO
+        Raw general and detailed results files, opened for appending.
+
+    matches : Optional[IO]
+        Match table (see MATCH_HEADER), opened for appending. It holds the
+        input and output VAF, depth and called flag of every truth variant,
+        and the VAF and depth the caller reported, so matrix_gen.py can
+        re-bin sensitivity without comparing again.
+
+    targets, padding :
+        Capture regions and padding the truth set and the calls are both
+        restricted to (see compare), so an off-target truth site counts
+        neither as found nor as missed. The on- and off-target calls of every
+        caller are appended to the general results as
+        "OT <caller> <on> <off>" lines.
+    """
+    sample = load_sample(truth_file, targets, padding)
+    for vc in VCS:
+        caller_file = caller_vcf(vcf_dir, vc, sample['prefix'])
+        if caller_file is None:
+            logging.warning(f"No VCF files found for {vc} matching "
+                            f"{sample['prefix']}")
+            continue
+        compare_caller(sample, vc, caller_file, general, detailed, matches,
+                       targets, padding)
+
+def file_key(path: Optional[str]) -> Optional[List[int]]:
+    """
+    Returns the size and modification time of a file, or None.
+    """
+    if not path:
+        return None
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+def shard_key(truth_file: str, caller_file: str, bed: Optional[str],
+              padding: int, with_matches: bool) -> Dict[str, object]:
+    """
+    Describes the inputs of a shard, so a shard is only computed again when
+    they change.
+    """
+    return {'version': SHARD_VERSION, 'truth': file_key(truth_file),
+            'caller': caller_file,
+            'caller_key': file_key(caller_file), 'bed': file_key(bed),
+            'padding': padding if bed else 0, 'matches': with_matches}
+
+def shard_done(shard: str, key: Dict[str, object]) -> bool:
+    """
+    Checks if a shard is complete and was computed from the same inputs.
+    """
+    try:
+        with open(os.path.join(shard, SHARD_META)) as meta:
+            return json.load(meta) == key
+    except (OSError, ValueError):
+        return False
+
+def write_shard(sample: Dict[str, object], vc: str, caller_file: str,
+                shard: str, key: Dict[str, object],
+                targets: Optional[ProbeIndex], padding: int) -> None:
+    """
+    Compares a sample against a caller into a shard directory. The shard is
+    written under a temporary name and renamed once complete, so an
+    interrupted run never leaves a partial shard behind.
+    """
+    tmp = f"{shard}.{os.getpid()}.tmp"
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+    try:
+        with open(os.path.join(tmp, SHARD_FILES['general']), 'w') as general, \
+             open(os.path.join(tmp, SHARD_FILES['detailed']), 'w') \
+                as detailed:
+            if key['matches']:
+                with open(os.path.join(tmp, SHARD_FILES['matches']), 'w') \
+                        as matches:
+                    compare_caller(sample, vc, caller_file, general,
+                                   detailed, matches, targets, padding)
+            else:
+                compare_caller(sample, vc, caller_file, general, detailed,
+                               targets=targets, padding=padding)
+        with open(os.path.join(tmp, SHARD_META), 'w') as meta:
+            json.dump(key, meta)
+        shutil.rmtree(shard, ignore_errors=True)
+        os.replace(tmp, shard)
+    except BaseException:
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise
+
+_SHARDS = {}
+
+def shard_task(task: Tuple[str, str, str]) -> Tuple[str, str, Optional[str]]:
+    """
+    Computes a single shard, retrying it alone if it fails. Runs in the
+    parent process or in a forked worker.
+
+    Returns
+    -------
+    Tuple[str, str, Optional[str]]
+        Prefix, caller and the last error, or None on success.
+    """
+    truth_file, vc, caller_file = task
+    settings = _SHARDS
+    prefix = os.path.basename(truth_file)[:-len("_all.vcf.gz")]
+    shard = os.path.join(settings['shard_dir'], prefix, vc)
+    error = None
+    for attempt in range(1, settings['retries'] + 2):
+        try:
+            with span("vcf_comparer", f"{settings['method']}/{prefix}/{vc}"):
+                key = shard_key(truth_file, caller_file, settings['bed'],
+                                settings['padding'], settings['matches'])
+                sample = load_sample(truth_file, settings['targets'],
+                                     settings['padding'])
+                write_shard(sample, vc, caller_file, shard, key,
+                            settings['targets'], settings['padding'])
+            return prefix, vc, None
+        except Exception as e:
+            error = str(e)
+            logging.warning(f"Shard {prefix}/{vc} failed (attempt "
+                            f"{attempt}): {e}")
+    return prefix, vc, error
+
+def compare_shards(truth_files: List[str], vcf_dir: str, shard_dir: str,
+                   bed: Optional[str] = None, padding: int = 0,
+                   with_matches: bool = False, jobs: int = 1,
+                   retries: int = 2) -> List[Tuple[str, str]]:
+    """
+    Compares every sample against every caller as independent shards,
+    <shard_dir>/<prefix>/<caller>, on a pool of worker processes. Shards
+    that are complete and whose inputs have not changed are kept, so a run
+    after a failure only computes the failed shards again.
+
+    Parameters
+    ----------
+    truth_files : List[str]
+        Paths to the <prefix>_all.vcf.gz truth sets.
+
+    vcf_dir : str
+        Directory holding one subdirectory per caller (VCFs/<Method>).
+
+    shard_dir : str
+        Directory where the shards are written.
+
+    bed, padding :
+        Capture BED and padding the truth sets and the calls are restricted
+        to (see compare_sample).
+
+    with_matches : bool
+        If True, shards hold match table rows too.
+
+    jobs : int
+        Number of worker processes.
+
+    retries : int
+        Times a failed shard is computed again before giving up.
+
+    Returns
+    -------
+    List[Tuple[str, str]]
+        Prefix and caller of every shard that failed.
+    """
+    tasks = []
+    for truth_file in sorted(truth_files):
+        prefix = os.path.basename(truth_file)[:-len("_all.vcf.gz")]
+        for vc in VCS:
+            shard = os.path.join(shard_dir, prefix, vc)
+            caller_file = caller_vcf(vcf_dir, vc, prefix)
+            if caller_file is None:
+                logging.warning(f"No VCF files found for {vc} matching "
+                                f"{prefix}")
+                shutil.rmtree(shard, ignore_errors=True)
+                continue
+            key = shard_key(truth_file, caller_file, bed, padding,
+                            with_matches)
+            if not shard_done(shard, key):
+                tasks.append((truth_file, vc, caller_file))
+        os.makedirs(os.path.join(shard_dir, prefix), exist_ok=True)
+
+    _SHARDS.update(shard_dir=shard_dir, bed=bed, padding=padding,
+                   matches=with_matches, retries=retries,
+                   method=os.path.basename(os.path.normpath(vcf_dir)),
+                   targets=open_probe_index(bed) if bed else None)
+
+    # Workers are forked so they share the memory-mapped capture regions
+    if jobs > 1 and len(tasks) > 1:
+        context = multiprocessing.get_context('fork')
+        with context.Pool(min(jobs, len(tasks))) as pool:
+            results = pool.map(shard_task, tasks, chunksize=1)
+    else:
+        results = [shard_task(task) for task in tasks]
+
+    return [(prefix, vc) for prefix, vc, error in results if error]
+
+def shard_lines(shard_dir: str, kind: str,
+                samples: Optional[List[str]] = None) -> Iterator[str]:
+    """
+    Reads the shards of a shard directory as the raw results vcf_compare
+    used to append, in a stable order: samples sorted by prefix and callers
+    in VCS order.
+
+    Parameters
+    ----------
+    shard_dir : str
+        Directory written by compare_shards.
+
+    kind : str
+        'general', 'detailed' or 'matches'.
+
+    samples : Optional[List[str]]
+        Prefixes of the samples to read; all of them if None.
+
+    Returns
+    -------
+    Iterator[str]
+        Lines of the raw results, with their line endings.
+    """
+    if samples is None:
+        samples = [name for name in os.listdir(shard_dir)
+                   if os.path.isdir(os.path.join(shard_dir, name))]
+    if kind == 'matches':
+        yield "\t".join(MATCH_HEADER) + "\n"
+
+    for prefix in sorted(samples):
+        sample_dir = os.path.join(shard_dir, prefix)
+        if kind == 'general':
+            try:
+                with open(os.path.join(sample_dir, CALLABLE_FILE)) as fl:
+                    line = fl.read().strip()
+            except OSError:
+                line = ""
+            yield (line or f"FL\t{prefix}\t") + "\n"
+        elif kind == 'detailed':
+            yield f"FL\t{prefix}\t\n"
+
+        for vc in VCS:
+            path = os.path.join(sample_dir, vc, SHARD_FILES[kind])
+            if not os.path.exists(path):
+                continue
+            with open(path) as shard:
+                yield from shard
+
+def merge_shards(shard_dir: str, kind: str, output_file: str,
+                 samples: Optional[List[str]] = None) -> None:
+    """
+    Writes the raw results of a shard directory (see shard_lines) to a file,
+    replacing it only once complete.
+    """
+    tmp = f"{output_file}.{os.getpid()}.tmp"
+    with open(tmp, 'w') as output:
+        output.writelines(shard_lines(shard_dir, kind, samples))
+    os.replace(tmp, output_file)
+
+def main():
+    parser = argparse.ArgumentParser(description='vcf_comparer')
+    parser.add_argument('-t', '--truth', dest='truth',
+                        required=True, type=str, nargs='+',
+                        help='Truth sets (<prefix>_all.vcf.gz)')
+    parser.add_argument('-i', '--input-dir', dest='input',
+                        required=True, type=str,
+                        help='Directory with one folder per caller')
+    parser.add_argument('-o1', '--output-file1', dest='general',
+                        required=True, type=str)
+    parser.add_argument('-o2', '--output-file2', dest='detailed',
+                        required=True, type=str)
+    parser.add_argument('-o3', '--output-file3', dest='matches',
+                        required=False, type=str, default=None,
+                        help='Per-variant match table (optional)')
+    parser.add_argument('-T', '--targets', dest='targets',
+                        required=False, type=str, default=None,
+                        help='Capture BED to restrict the truth set and the '
+                             'calls to (optional)')
+    parser.add_argument('-p', '--padding', dest='padding',
+                        required=False, type=int, default=0,
+                        help='Bases around the capture regions still on '
+                             'target (default: 0)')
+    parser.add_argument('-s', '--shards', dest='shards',
+                        required=False, type=str, default=None,
+                        help='Shard directory: compare every sample and '
+                             'caller as a separate shard and merge them into '
+                             'the outputs, which are overwritten')
+    parser.add_argument('-j', '--jobs', dest='jobs',
+                        required=False, type=int, default=1,
+                        help='Worker processes for --shards')
+    parser.add_argument('-r', '--retries', dest='retries',
+                        required=False, type=int, default=2,
+                        help='Retries of a failed shard (default: 2)')
+    args = parser.parse_args()
+
+    if args.shards:
+        failed = compare_shards(args.truth, args.input, args.shards,
+                                args.targets, args.padding,
+                                args.matches is not None,
+                                args.jobs, args.retries)
+        if failed:
+            for prefix, vc in failed:
+                logging.error(f"Shard {prefix}/{vc} failed; run again to "
+                              f"compute the failed shards only")
+            sys.exit(1)
+
+        samples = [os.path.basename(truth_file)[:-len("_all.vcf.gz")]
+                   for truth_file in args.truth]
+        merge_shards(args.shards, 'general', args.general, samples)
+        merge_shards(args.shards, 'detailed', args.detailed, samples)
+        if args.matches:
+            merge_shards(args.shards, 'matches', args.matches, samples)
+        return
+
+    method = os.path.basename(os.path.normpath(args.input))
+    targets = open_probe_index(args.targets) if args.targets else None
+    for truth_file in args.truth:
+        prefix = os.path.basename(truth_file)[:-len("_all.vcf.gz")]
+        with span("vcf_comparer", f"{method}/{prefix}"), \
+             open(args.general, 'a') as general, \
+             open(args.detailed, 'a') as detailed:
+            if args.matches is None:
+                compare_sample(truth_file, args.input, general, detailed,
+                               targets=targets, padding=args.padding)
+                continue
+            with open(args.matches, 'a') as matches:
+                if matches.tell() == 0:
+                    matches.write("\t".join(MATCH_HEADER) + "\n")
+                compare_sample(truth_file, args.input, general, detailed,
+                               matches, targets, args.padding)
+
+if __name__ == "__main__":
+    main()
@@ -1,23 +1,147 @@
 #!/usr/bin/python3
 #
 # vcf_generator.py
-# Last Edited: 2024/12/29
-# Version: 1.0
+# Last Edited: 2026/10/17
+# Version: 1.1
 #
 # This script generates a general VCF (Variant Call Format) file and child VCFs
 # with variants separated into specific VAF (Variant Allele Frequency) ranges.
 # The resulting files are useful as benchmarks in evaluating somatic variant 
-# calling performance.
+# calling performance. Output VCFs are sorted, bgzipped and tabix-indexed.
 
 import argparse
+import glob
+import multiprocessing
+import os
+import sys
 from datetime import datetime
+from typing import Dict, List, Optional, Tuple
 
-def create_vcf_from_somatosim(somatosim_file: str, output_file: str) -> None:
+from bgzf import BGZFWriter, write_tabix
+from tracing import span
+
+# GRCh38 primary contigs, used when no reference index is given
+GRCH38_CONTIGS = [
+    ("chr1", 248956422), ("chr2", 242193529), ("chr3", 198295559),
+    ("chr4", 190214555), ("chr5", 181538259), ("chr6", 170805979),
+    ("chr7", 159345973), ("chr8", 145138636), ("chr9", 138394717),
+    ("chr10", 133797422), ("chr11", 135086622), ("chr12", 133275309),
+    ("chr13", 114364328), ("chr14", 107043718), ("chr15", 101991189),
+    ("chr16", 90338345), ("chr17", 83257441), ("chr18", 80373285),
+    ("chr19", 58617616), ("chr20", 64444167), ("chr21", 46709983),
+    ("chr22", 50818468), ("chrX", 156040895), ("chrY", 57227415),
+    ("chrM", 16569)
+]
+
+INFO_LINES = [
+    '##INFO=<ID=iAF,Number=1,Type=Float,Description="Input allele frequency">',
+    '##INFO=<ID=iDP,Number=1,Type=Integer,Description="Input depth">',
+    '##INFO=<ID=AF,Number=1,Type=Float,Description="Output allele frequency">',
+    '##INFO=<ID=DP,Number=1,Type=Integer,Description="Output depth">'
+]
+
+# Suffix and upper bound (exclusive) of every VAF range
+VAF_RANGES = [("_AF_0_to_002", 0.02), ("_AF_002_to_005", 0.05),
+              ("_AF_005_to_01", 0.1), ("_AF_01_to_1", float("inf"))]
+
+def read_contigs(reference_index: str) -> List[Tuple[str, int]]:
+    """
+    Reads the name and length of every contig from a FASTA index (.fai), in
+    reference order.
+    """
+    contigs = []
+    with open(reference_index) as fai:
+        for line in fai:
+            fields = line.split('\t')
+            if len(fields) > 1:
+                contigs.append((fields[0], int(fields[1])))
+    return contigs
+
+def write_vcf(output: str, header: List[str], order: Dict[str, int],
+              records: List[Tuple[str, int, str, str]]) -> None:
+    """
+    Sorts records by contig order and position, and writes them as a
+    BGZF-compressed VCF along with its tabix index (.tbi).
+
+    Parameters
+    ----------
+    output : str
+        Path to the compressed VCF (.vcf.gz).
+
+    header : List[str]
+        Header lines, including the #CHROM line.
+
+    order : Dict[str, int]
+        Rank of every contig. Contigs missing from it are sorted last, in
+        order of appearance.
+
+    records : List[Tuple[str, int, str, str]]
+        Contig, position, REF and full VCF line of every record.
+    """
+    unknown = {}
+    for chrom, _, _, _ in records:
+        if chrom not in order and chrom not in unknown:
+            unknown[chrom] = len(order) + len(unknown)
+    rank = dict(order, **unknown)
+    records = sorted(records, key=lambda record: (rank[record[0]], record[1]))
+
+    contigs = []
+    index = {}
+    with BGZFWriter(output) as vcf:
+        vcf.write(("\n".join(header) + "\n").encode())
+        for chrom, pos, ref, line in records:
+            if chrom not in index:
+                contigs.append(chrom)
+                index[chrom] = []
+            start = vcf.tell()
+            vcf.write(line.encode())
+            index[chrom].append((pos - 1, pos - 1 + len(ref), start,
+                                 vcf.tell()))
+    write_tabix(output + ".tbi", contigs, index)
+
+def vcf_header(reference_index: Optional[str] = None
+               ) -> Tuple[List[str], Dict[str, int]]:
+    """
+    Builds the header lines shared by every truth VCF.
+
+    Parameters
+    ----------
+    reference_index : Optional[str]
+        FASTA index (.fai) of the reference, giving the contigs and their
+        order. GRCh38 primary contigs are used if not given.
+
+    Returns
+    -------
+    Tuple[List[str], Dict[str, int]]
+        Header lines, including the #CHROM line, and the rank of every
+        contig.
+    """
+    contigs = read_contigs(reference_index) if reference_index \
+        else GRCH38_CONTIGS
+    contig_lines = [f"##contig=<ID={name},length={length}>"
+                    for name, length in contigs]
+    order = {name: i for i, (name, _) in enumerate(contigs)}
+
+    # Get current date
+    date = datetime.now()
+
+    header = ["##fileformat=VCFv4.2",
+              f"##fileDate={date.year}{date.month:02}{date.day:02}",
+              "##source=SomatoSim"] + contig_lines + INFO_LINES + \
+             ["#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO"]
+    return header, order
+
+def create_vcf_from_somatosim(somatosim_file: str, output_file: str,
+                              reference_index: Optional[str] = None,
+                              header: Optional[Tuple[List[str],
+                                                     Dict[str, int]]] = None
+                              ) -> None:
     """
     Generates a VCF file from the specified SomatoSim output file, along with
     separate VCFs for variants within specific VAF ranges: <0.02, 0.02-0.05,
     0.05-0.1, and >0.1. Each VCF file is saved with a unique name indicating
-    its respective VAF range.
+    its respective VAF range. Every VCF is sorted, BGZF-compressed and
+    indexed with tabix.
 
     Parameters
     ----------
@@ -25,61 +149,20 @@ def create_vcf_from_somatosim(somatosim_file: str, output_file: str) -> None:
         Path to the input file generated by SomatoSim.
     output_file : str
         Path where the output VCF files will be saved.
+    reference_index : Optional[str]
+        FASTA index (.fai) of the reference, giving the contigs and their
+        order. GRCh38 primary contigs are used if not given.
+    header : Optional[Tuple[List[str], Dict[str, int]]]
+        Header already built with vcf_header, shared by several samples.
+        reference_index is ignored if given.
     """
 
-    # Define contig lines and INFO fields
-    contig_lines = [
-        "##contig=<ID=chr1,length=248956422>",
-        "##contig=<ID=chr2,length=242193529>",
-        "##contig=<ID=chr3,length=198295559>",
-        "##contig=<ID=chr4,length=190214555>",
-        "##contig=<ID=chr5,length=181538259>",
-        "##contig=<ID=chr6,length=170805979>",
-        "##contig=<ID=chr7,length=159345973>",
-        "##contig=<ID=chr8,length=145138636>",
-        "##contig=<ID=chr9,length=138394717>",
-        "##contig=<ID=chr10,length=133797422>",
-        "##contig=<ID=chr11,length=135086622>",
-        "##contig=<ID=chr12,length=133275309>",
-        "##contig=<ID=chr13,length=114364328>",
-        "##contig=<ID=chr14,length=107043718>",
-        "##contig=<ID=chr15,length=101991189>",
-        "##contig=<ID=chr16,length=90338345>",
-        "##contig=<ID=chr17,length=83257441>",
-        "##contig=<ID=chr18,length=80373285>",
-        "##contig=<ID=chr19,length=58617616>",
-        "##contig=<ID=chr20,length=64444167>",
-        "##contig=<ID=chr21,length=46709983>",
-        "##contig=<ID=chr22,length=50818468>",
-        "##contig=<ID=chrX,length=156040895>",
-        "##contig=<ID=chrY,length=57227415>",
-        "##contig=<ID=chrM,length=16569>",
-        '##INFO=<ID=iAF,Number=1,Type=Float,Description="Input allele frequency">',
-        '##INFO=<ID=iDP,Number=1,Type=Integer,Description="Input depth">',
-        '##INFO=<ID=AF,Number=1,Type=Float,Description="Output allele frequency">',
-        '##INFO=<ID=DP,Number=1,Type=Integer,Description="Output depth">'
-    ]
-
-    # Get current date
-    date = datetime.now()
+    # Define VCF headers
+    header, order = header or vcf_header(reference_index)
 
-    # Define output files for each VAF range
-    vaf_ranges = {
-        "all": open(f"{output_file}_all.vcf", 'w'),
-        "0_to_002": open(f"{output_file}_AF_0_to_002.vcf", 'w'),
-        "002_to_005": open(f"{output_file}_AF_002_to_005.vcf", 'w'),
-        "005_to_01": open(f"{output_file}_AF_005_to_01.vcf", 'w'),
-        "01_to_1.vcf": open(f"{output_file}_AF_01_to_1.vcf", 'w')
-    }
-
-    # Write VCF headers
-    for vcf_file in vaf_ranges.values():
-        vcf_file.write("##fileformat=VCFv4.2\n")
-        vcf_file.write(f"##fileDate={date.year}{date.month:02}{date.day:02}\n")
-        vcf_file.write("##source=SomatoSim\n")
-        for line in contig_lines:
-            vcf_file.write(f"{line}\n")
-        vcf_file.write("#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n")
+    # Records for the general file and for each VAF range
+    all_records = []
+    range_records = [[] for _ in VAF_RANGES]
 
     # Process the input SomatoSim file
     with open(somatosim_file, 'r') as infile:
@@ -95,23 +178,99 @@ def create_vcf_from_somatosim(somatosim_file: str, output_file: str) -> None:
             # Create INFO field
             info = f"iAF={input_VAF};iDP={input_cov};AF={output_VAF};DP={output_cov}"
             vcf_line = f"{chrom}\t{pos}\t.\t{ref}\t{alt}\t.\tPASS\t{info}\n"
+            record = (chrom, int(pos), ref, vcf_line)
+
+            all_records.append(record)
+            for i, (_, upper) in enumerate(VAF_RANGES):
+                if input_VAF < upper:
+                    range_records[i].append(record)
+                    break
+
+    # Write the general file and specific VAF range files
+    write_vcf(f"{output_file}_all.vcf.gz", header, order, all_records)
+    for (suffix, _), records in zip(VAF_RANGES, range_records):
+        write_vcf(f"{output_file}{suffix}.vcf.gz", header, order, records)
 
-            # Write to the general file
-            vaf_ranges["all"].write(vcf_line)
+def find_simulations(project_dir: str) -> List[Tuple[str, str]]:
+    """
+    Finds every SomatoSim output of a project.
+
+    Returns
+    -------
+    List[Tuple[str, str]]
+        Path to each BAMs_mutated/<Method>/<sample>/simulation_output.txt and
+        the base name of its VCFs in VCFs/<Method>/REFs/<sample>.
+    """
+    simulations = []
+    for method in ("Guided", "Stochastic"):
+        pattern = os.path.join(project_dir, "BAMs_mutated", method, "*",
+                               "simulation_output.txt")
+        for somatosim_file in sorted(glob.glob(pattern)):
+            sample = os.path.basename(os.path.dirname(somatosim_file))
+            simulations.append((somatosim_file,
+                                os.path.join(project_dir, "VCFs", method,
+                                             "REFs", sample)))
+    return simulations
+
+def convert_simulation(somatosim_file: str, output_file: str,
+                       header: Tuple[List[str], Dict[str, int]]
+                       ) -> Optional[str]:
+    """
+    Runs create_vcf_from_somatosim for a single sample of a project.
+
+    Returns
+    -------
+    Optional[str]
+        None on success, or the error message.
+    """
+    method = os.path.basename(os.path.dirname(os.path.dirname(output_file)))
+    try:
+        with span("vcf_generator", f"{method}/{os.path.basename(output_file)}"):
+            create_vcf_from_somatosim(somatosim_file, output_file,
+                                      header=header)
+        return None
+    except Exception as e:
+        return str(e)
+
+def create_project_vcfs(project_dir: str,
+                        reference_index: Optional[str] = None,
+                        jobs: int = 1) -> int:
+    """
+    Generates the truth VCFs of every SomatoSim output in a project,
+    converting samples concurrently in a pool of worker processes. The
+    header is built once and shared by every sample.
+
+    Parameters
+    ----------
+    project_dir : str
+        Project directory, as laid out by create_directories.sh.
+    reference_index : Optional[str]
+        FASTA index (.fai) of the reference.
+    jobs : int
+        Number of worker processes.
+
+    Returns
+    -------
+    int
+        Number of samples that failed.
+    """
+    header = vcf_header(reference_index)
+    tasks = [(somatosim_file, output_file, header)
+             for somatosim_file, output_file in find_simulations(project_dir)]
 
-            # Write to specific VAF range files
-            if input_VAF < 0.02:
-                vaf_ranges["0_to_002"].write(vcf_line)
-            elif 0.02 <= input_VAF < 0.05:
-                vaf_ranges["002_to_005"].write(vcf_line)
-            elif 0.05 <= input_VAF < 0.1:
-                vaf_ranges["005_to_01"].write(vcf_line)
-            elif input_VAF >= 0.1:
-                vaf_ranges["01_to_1.vcf"].write(vcf_line)
+    if jobs > 1 and len(tasks) > 1:
+        with multiprocessing.Pool(min(jobs, len(tasks))) as pool:
+            errors = pool.starmap(convert_simulation, tasks)
+    else:
+        errors = [convert_simulation(*task) for task in tasks]
 
-    # Close all files
-    for vcf_file in vaf_ranges.values():
-        vcf_file.close()
+    failed = 0
+    for (somatosim_file, _, _), error in zip(tasks, errors):
+        if error is not None:
+            print(f"ERROR: Failed to convert {somatosim_file}: {error}",
+                  file=sys.stderr)
+            failed += 1
+    return failed
 
 def main():
     """
@@ -119,13 +278,30 @@ def main():
     """
     parser = argparse.ArgumentParser(description = \
         'Generate a VCF and VAF-specific VCF files from SomatoSim output')
-    parser.add_argument('-i', '--input', dest='input', required=True,
+    parser.add_argument('-i', '--input', dest='input', required=False,
                         type=str, help='Input SomatoSim file')
-    parser.add_argument('-o', '--output', dest='output', required=True,
+    parser.add_argument('-o', '--output', dest='output', required=False,
                         type=str, help='Base name for output VCF files')
+    parser.add_argument('-p', '--project', dest='project', required=False,
+                        type=str, help='Project directory; converts every '
+                        'BAMs_mutated/<Method>/*/simulation_output.txt')
+    parser.add_argument('-j', '--jobs', dest='jobs', required=False,
+                        type=int, default=1,
+                        help='Worker processes for --project')
+    parser.add_argument('-r', '--reference-index', dest='reference_index',
+                        required=False, type=str, default=None,
+                        help='FASTA index (.fai) giving contig order')
     args = parser.parse_args()
 
-    create_vcf_from_somatosim(args.input, args.output)
+    if args.project:
+        sys.exit(1 if create_project_vcfs(args.project, args.reference_index,
+                                          args.jobs) else 0)
+    elif args.input and args.output:
+        create_vcf_from_somatosim(args.input, args.output,
+                                  args.reference_index)
+    else:
+        parser.error("either --project or both --input and --output are "
+                     "required")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,43 @@
+import gzip
+import random
+
+import pytest
+
+from vcf_generator import write_vcf
+
+pysam = pytest.importorskip("pysam")
+
+HEADER = ["##fileformat=VCFv4.2", "##contig=<ID=chr1,length=5000000>",
+          "##contig=<ID=chr2,length=5000000>",
+          "#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO"]
+
+def records(n, seed=1):
+    rng = random.Random(seed)
+    out = []
+    for chrom in ("chr2", "chr1"):
+        for pos in rng.sample(range(1, 5000000), n):
+            line = f"{chrom}\t{pos}\t.\tA\tC\t.\tPASS\tAF=0.1\n"
+            out.append((chrom, pos, "A", line))
+    return out
+
+def test_truth_set_is_sorted_and_indexed(tmp_path):
+    # Enough records for many BGZF blocks and tabix bins
+    data = records(20000)
+    output = str(tmp_path / "truth_all.vcf.gz")
+    write_vcf(output, HEADER, {"chr1": 0, "chr2": 1}, data)
+
+    with gzip.open(output, 'rt') as vcf:
+        lines = [line for line in vcf if not line.startswith('#')]
+    keys = [(line.split('\t')[0], int(line.split('\t')[1])) for line in lines]
+    assert keys == sorted(keys)
+    assert len(keys) == len(data)
+
+    tabix = pysam.TabixFile(output)
+    assert set(tabix.contigs) == {"chr1", "chr2"}
+    for chrom, start, end in [("chr1", 0, 5000000), ("chr2", 1000, 1500000),
+                              ("chr1", 2500000, 2600000), ("chr2", 10, 20)]:
+        expected = sorted(pos for name, pos, _, _ in data
+                          if name == chrom and start < pos <= end)
+        found = [int(row.split('\t')[1])
+                 for row in tabix.fetch(chrom, start, end)]
+        assert found == expected
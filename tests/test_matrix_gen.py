@@ -0,0 +1,113 @@
+import gzip
+import io
+import os
+
+import numpy as np
+import pytest
+
+from matrix_gen import bootstrap_interval, detailed_matrix, general_matrix, \
+    incremental_detailed_matrix, incremental_general_matrix, metrics, ratio, \
+    STATE_SUFFIX, wilson_interval
+from vcf_comparer import compare_sample
+
+def test_metrics_match_scalar_formulas():
+    TP, TN, FP, FN = (np.array([8, 0]), np.array([90, 5]), np.array([2, 0]),
+                      np.array([2, 0]))
+    values = metrics(TP, TN, FP, FN)
+    assert values["Sensitivity"].tolist() == pytest.approx([0.8, 0.0])
+    assert values["Specificity"].tolist() == pytest.approx([90 / 92, 1.0])
+    assert values["Precision"].tolist() == pytest.approx([0.8, 0.0])
+    assert values["Accuracy"].tolist() == pytest.approx([98 / 102, 1.0])
+    assert values["FPR"].tolist() == pytest.approx([2 / 92, 0.0])
+    assert values["FNR"].tolist() == pytest.approx([0.2, 0.0])
+    assert values["F1 Score"].tolist() == pytest.approx([0.8, 0.0])
+
+def test_ratio_of_zero_denominator_is_zero():
+    assert ratio(np.array([1, 0]), np.array([0, 0])).tolist() == [0.0, 0.0]
+
+def test_wilson_interval():
+    low, high = wilson_interval(np.array([8, 0, 0]), np.array([10, 10, 0]))
+    # 8 of 10 at 95%: 0.4902 to 0.9433
+    assert low[0] == pytest.approx(0.4902, abs=1e-4)
+    assert high[0] == pytest.approx(0.9433, abs=1e-4)
+    assert low[1] == pytest.approx(0.0, abs=1e-12)
+    assert 0 < high[1] < 0.35
+    assert (low[2], high[2]) == (0.0, 0.0)
+
+def test_bootstrap_interval():
+    counts = np.array([[8, 90, 2, 2], [6, 80, 4, 4], [9, 95, 1, 1]])
+    first = bootstrap_interval(counts, rng=np.random.default_rng(1))
+    again = bootstrap_interval(counts, rng=np.random.default_rng(1))
+    assert first == again
+
+    pooled = metrics(*counts.sum(axis=0))
+    for name, (low, high) in first.items():
+        assert low <= float(pooled[name]) <= high
+
+    # Identical samples leave nothing to resample
+    same = bootstrap_interval(np.array([[8, 90, 2, 2]] * 4),
+                              rng=np.random.default_rng(1))
+    assert same["Sensitivity"] == pytest.approx((0.8, 0.8))
+
+def write_vcf(path, positions, info):
+    with gzip.open(path, 'wt') as vcf:
+        vcf.write("##fileformat=VCFv4.2\n"
+                  "#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n")
+        for pos in positions:
+            vcf.write(f"chr1\t{pos}\t.\tA\tC\t.\tPASS\t{info}\n")
+    return str(path)
+
+def raw_results(tmp_path, sample, calls):
+    """
+    Raw general and detailed results of a sample, as vcf_compare appends
+    them: its FL line, then the lines of every caller.
+    """
+    truth = write_vcf(tmp_path / f"{sample}_all.vcf.gz",
+                      range(100, 1100, 100), "iAF=0.04;AF=0.04;DP=100")
+    for vc, positions in calls.items():
+        os.makedirs(tmp_path / vc, exist_ok=True)
+        write_vcf(tmp_path / vc / f"{sample}.{vc.lower()}.vcf.gz", positions,
+                  "DP=100")
+    general, detailed = io.StringIO(), io.StringIO()
+    general.write(f"FL\t{sample}\t5000\n")
+    detailed.write(f"FL\t{sample}\t\n")
+    compare_sample(truth, str(tmp_path), general, detailed)
+    return general.getvalue(), detailed.getvalue()
+
+def test_incremental_matches_full_run(tmp_path):
+    samples = [raw_results(tmp_path, "S1", {"LoFreq": [100, 200, 150]}),
+               raw_results(tmp_path, "S2", {"LoFreq": [300],
+                                            "Mutect2": [300, 400, 999]}),
+               raw_results(tmp_path, "S3", {"Mutect2": [500, 600]})]
+
+    outputs = {}
+    for mode in ("full", "incremental"):
+        folder = tmp_path / mode
+        folder.mkdir()
+        general, detailed = folder / "general.txt", folder / "detailed.txt"
+        # The incremental run sees two samples first, then the third one
+        # appended
+        batches = [samples] if mode == "full" else [samples[:2], samples[2:]]
+        for batch in batches:
+            with open(general, 'a') as g, open(detailed, 'a') as d:
+                for general_lines, detailed_lines in batch:
+                    g.write(general_lines)
+                    d.write(detailed_lines)
+            if mode == "full":
+                general_matrix(str(general), str(folder / "general.tsv"),
+                               None, str(folder / "general_summary.tsv"),
+                               200, 0.95, 1)
+                detailed_matrix(str(detailed), str(folder / "detailed.tsv"))
+            else:
+                incremental_general_matrix(
+                    str(general), str(folder / "general.tsv"), None,
+                    str(folder / "general_summary.tsv"), 200, 0.95, 1)
+                incremental_detailed_matrix(str(detailed),
+                                            str(folder / "detailed.tsv"))
+        outputs[mode] = {name: (folder / name).read_bytes() for name in
+                         ("general.tsv", "general_summary.tsv",
+                          "detailed.tsv")}
+
+    assert outputs["full"]["general.tsv"].count(b"\n") == 5
+    assert (tmp_path / "incremental" / f"general.tsv{STATE_SUFFIX}").exists()
+    assert outputs["incremental"] == outputs["full"]
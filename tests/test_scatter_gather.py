@@ -0,0 +1,36 @@
+import bisect
+import os
+
+from scatter_gather import MANIFEST, read_probes, scatter
+
+TOY_BED = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..",
+                       "toy_dataset", "Probes_IDT_xGen_v2_chr22.bed")
+
+def read_intervals(path):
+    with open(path) as bed:
+        return [(contig, int(start), int(end)) for contig, start, end
+                in (line.rstrip('\n').split('\t')[:3] for line in bed)]
+
+def test_padded_shards_are_sorted_and_merged(tmp_path):
+    padding = 100
+    manifest = scatter(TOY_BED, 4, str(tmp_path), padding=padding)
+    assert os.path.exists(tmp_path / MANIFEST)
+    assert len(manifest['shards']) == 4
+
+    covered = []
+    for shard in manifest['shards']:
+        intervals = read_intervals(tmp_path / shard['bed'])
+        assert len(intervals) == shard['intervals']
+        for previous, current in zip(intervals, intervals[1:]):
+            if previous[0] == current[0]:
+                # Sorted, with a gap between neighbouring intervals
+                assert previous[2] < current[1]
+        covered += intervals
+
+    # Every padded probe lies inside a merged interval of the shard BEDs
+    covered.sort()
+    probes, _ = read_probes(TOY_BED)
+    for contig, start, end, _ in probes:
+        start, end = max(0, start - padding), end + padding
+        i = bisect.bisect_right(covered, (contig, start, float('inf'))) - 1
+        assert i >= 0 and covered[i][0] == contig and end <= covered[i][2]
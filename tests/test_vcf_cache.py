@@ -0,0 +1,61 @@
+import gzip
+import os
+
+import pytest
+
+import vcf_cache
+from vcf_cache import CACHE_DIR, CACHE_SUFFIX, NORMALISERS, open_calls, \
+    parse_record
+
+def record(info, fmt, sample, ref="A", alt="C"):
+    return f"chr1\t100\t.\t{ref}\t{alt}\t.\tPASS\t{info}\t{fmt}\t{sample}\n"
+
+@pytest.mark.parametrize("caller, line, af, dp", [
+    # LoFreq: AF and DP in INFO
+    ("LoFreq", record("DP=80;AF=0.25;SB=0", "", ""), 0.25, 80),
+    # VarScan2: FREQ is a percentage of the sample
+    ("VarScan2", record("DP=50", "GT:DP:FREQ", "0/1:50:12.5%"), 0.125, 50),
+    # Strelka2: tier 1 counts of the REF (AU) and ALT (CU) bases
+    ("Strelka2", record("SOMATIC", "DP:AU:CU:GU:TU",
+                        "40:30,28:10,9:0,0:0,0"), 0.25, 40),
+    # Mutect2: AF and DP of the sample
+    ("Mutect2", record("DP=70", "GT:AF:DP", "0/1:0.3:60"), 0.3, 60)])
+def test_normalised_values(caller, line, af, dp):
+    assert parse_record(line, NORMALISERS[caller]) == \
+        ("chr1", 100, "A", "C", pytest.approx(af), dp, "PASS")
+
+def write_vcf(path, afs):
+    with gzip.open(path, 'wt') as vcf:
+        vcf.write("##fileformat=VCFv4.2\n"
+                  "#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n")
+        for i, af in enumerate(afs):
+            vcf.write(f"chr1\t{100 + i}\t.\tA\tC\t.\tPASS\t"
+                      f"DP=40;AF={af}\n")
+    return str(path)
+
+def record_sets(path):
+    folder = os.path.join(os.path.dirname(path), CACHE_DIR)
+    return sorted(name for name in os.listdir(folder)
+                  if name.endswith(CACHE_SUFFIX))
+
+def test_stale_record_sets_removed(tmp_path):
+    path = write_vcf(tmp_path / "S1.lofreq.vcf.gz", [0.1, 0.2])
+    assert len(open_calls(path, "LoFreq")) == 2
+    first = record_sets(path)
+    assert len(first) == 1
+
+    write_vcf(path, [0.1, 0.2, 0.3])
+    calls = open_calls(path, "LoFreq")
+    assert [af for _, _, af, _ in calls.sites()] == \
+        [pytest.approx(af) for af in (0.1, 0.2, 0.3)]
+    second = record_sets(path)
+    assert len(second) == 1 and second != first
+
+def test_digest_memoised(tmp_path, monkeypatch):
+    path = write_vcf(tmp_path / "S1.lofreq.vcf.gz", [0.1])
+    open_calls(path, "LoFreq")
+
+    def content_hash(path):
+        raise AssertionError("unchanged VCF hashed again")
+    monkeypatch.setattr(vcf_cache, "content_hash", content_hash)
+    assert len(open_calls(path, "LoFreq")) == 1
@@ -0,0 +1,84 @@
+import gzip
+
+from vcf_comparer import AF_RANGES, compare, compare_sample, load_truth
+
+HEADER = "##fileformat=VCFv4.2\n" \
+         "#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n"
+
+def write_vcf(path, records):
+    with gzip.open(path, 'wt') as vcf:
+        vcf.write(HEADER)
+        for chrom, pos, info in records:
+            vcf.write(f"{chrom}\t{pos}\t.\tA\tC\t.\tPASS\t{info}\n")
+    return str(path)
+
+# One truth variant per AF range, plus one in the highest range
+TRUTH = [("chr1", 100, "iAF=0.01"), ("chr1", 200, "iAF=0.03"),
+         ("chr1", 300, "iAF=0.07"), ("chr1", 400, "iAF=0.2"),
+         ("chr2", 50, "iAF=0.5")]
+
+# Two true calls (one repeated), and two calls at positions not in the truth
+CALLS = [("chr1", 100, "DP=40"), ("chr1", 150, "DP=40"),
+         ("chr1", 400, "DP=40"), ("chr1", 400, "DP=40"),
+         ("chr2", 60, "DP=40")]
+
+def test_compare_counts(tmp_path):
+    truth = load_truth(write_vcf(tmp_path / "S1_all.vcf.gz", TRUTH))
+    result = compare(truth, write_vcf(tmp_path / "calls.vcf.gz", CALLS))
+
+    # vcf-compare on these files: 2 shared, 3 truth-only, 2 caller-only
+    assert (result['TP'], result['FN'], result['FP']) == (2, 3, 2)
+    assert result['called'] == 4
+    assert len(result['ranges']) == len(AF_RANGES)
+    assert result['ranges'] == [[1, 0], [0, 1], [0, 1], [1, 1]]
+
+def test_compare_sample_lines(tmp_path):
+    truth_file = write_vcf(tmp_path / "S1_all.vcf.gz", TRUTH)
+    for vc in ("FreeBayes", "LoFreq", "Mutect2", "Strelka2", "VarScan2"):
+        (tmp_path / vc).mkdir()
+    caller_file = write_vcf(tmp_path / "LoFreq" / "S1.lofreq.vcf.gz", CALLS)
+    # Another sample whose name starts with S1 is never picked for S1
+    write_vcf(tmp_path / "LoFreq" / "S10.lofreq.vcf.gz", TRUTH)
+    write_vcf(tmp_path / "FreeBayes" / "S10.freebayes.filtered.vcf.gz", TRUTH)
+
+    general = tmp_path / "general.txt"
+    detailed = tmp_path / "detailed.txt"
+    with open(general, 'w') as g, open(detailed, 'w') as d:
+        compare_sample(truth_file, str(tmp_path), g, d)
+
+    # The VN lines vcf-compare printed for the same pair of files
+    assert general.read_text().splitlines() == [
+        f"LoFreq\t2\t{truth_file} (40.0%)\t{caller_file} (50.0%)",
+        f"LoFreq\t2\t{caller_file} (50.0%)",
+        f"LoFreq\t3\t{truth_file} (60.0%)"]
+
+    lines = detailed.read_text().splitlines()
+    assert [line for line in lines if line.startswith("_AF")] == \
+        [name for name, _ in AF_RANGES]
+    base = truth_file[:-len("_all.vcf.gz")]
+    assert f"LoFreq\t1\t{base}_AF_0_to_002.vcf.gz (100.0%)\t" \
+           f"{caller_file} (25.0%)" in lines
+    assert f"LoFreq\t1\t{base}_AF_002_to_005.vcf.gz (100.0%)" in lines
+
+def test_targets_restrict_truth_and_calls(tmp_path):
+    from BED4SV import open_probe_index
+
+    bed = tmp_path / "targets.bed"
+    bed.write_text("chr1\t90\t160\nchr1\t390\t410\n")
+    truth_file = write_vcf(tmp_path / "S1_all.vcf.gz", TRUTH)
+    for vc in ("FreeBayes", "LoFreq", "Mutect2", "Strelka2", "VarScan2"):
+        (tmp_path / vc).mkdir()
+    caller_file = write_vcf(tmp_path / "LoFreq" / "S1.lofreq.vcf.gz", CALLS)
+
+    general = tmp_path / "general.txt"
+    detailed = tmp_path / "detailed.txt"
+    with open(general, 'w') as g, open(detailed, 'w') as d:
+        compare_sample(truth_file, str(tmp_path), g, d,
+                       targets=open_probe_index(str(bed)))
+
+    # Truth sites 100 and 400 and calls 100, 150 and 400 are on target; the
+    # rest of both sets is left out
+    assert general.read_text().splitlines() == [
+        f"LoFreq\t2\t{truth_file} (100.0%)\t{caller_file} (66.7%)",
+        f"LoFreq\t1\t{caller_file} (33.3%)",
+        "OT\tLoFreq\t3\t1"]